@@ -1,7 +1,9 @@
 import os
 import sqlite3
+import argparse
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 def explore_sqlite_databases(base_path):
     """
@@ -90,19 +92,201 @@ def explore_sqlite_databases(base_path):
         print("No database information collected.")
         return None
 
+def connect_read_only(db_path):
+    """
+    Open a SQLite database read-only and immutable, so SQLite skips locking
+    and change detection. The BIRD databases are never written by the pipeline.
+    
+    Args:
+        db_path (str or Path): Path to the SQLite file
+        
+    Returns:
+        sqlite3.Connection
+    """
+    uri = f"{Path(db_path).resolve().as_uri()}?mode=ro&immutable=1"
+    return sqlite3.connect(uri, uri=True)
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _stat1_row_counts(cursor):
+    """Read row estimates recorded by ANALYZE in sqlite_stat1, if present."""
+    try:
+        cursor.execute("SELECT tbl, stat FROM sqlite_stat1;")
+    except sqlite3.Error:
+        return {}
+    row_counts = {}
+    for table, stat in cursor.fetchall():
+        # The first integer of "stat" is the number of rows in the table
+        if stat and table not in row_counts:
+            row_counts[table] = int(stat.split()[0])
+    return row_counts
+
+def _dbstat_page_counts(cursor):
+    """
+    Read per-table page counts from the dbstat virtual table, if compiled in.
+    dbstat visits every page of the file, so this is a full read of the database.
+    """
+    try:
+        cursor.execute("SELECT name, COUNT(*) FROM dbstat GROUP BY name;")
+    except sqlite3.Error:
+        return {}
+    return {name: page_count for name, page_count in cursor.fetchall()}
+
+def survey_database(db_path, exact_counts=False, page_counts=False):
+    """
+    Collect table/column information for a single SQLite database without
+    scanning table contents.
+    
+    Row counts come from sqlite_stat1 when the database has been analyzed,
+    otherwise from MAX(rowid), which is a b-tree lookup rather than a full scan
+    and an upper bound on the row count (deleted rows still advance rowid).
+    Tables declared WITHOUT ROWID fall back to an exact COUNT(*).
+    The file size comes from PRAGMA page_count and page_size; per-table sizes
+    need dbstat, which reads the whole file, so they are opt-in.
+    
+    Args:
+        db_path (str or Path): Path to the SQLite file
+        exact_counts (bool): Always run SELECT COUNT(*) instead of estimating
+        page_counts (bool): Also read per-table page counts from dbstat
+        
+    Returns:
+        list: One dict per table
+    """
+    db_path = Path(db_path)
+    db_name = db_path.stem
+    db_info = []
+    
+    try:
+        conn = connect_read_only(db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
+        tables = [table[0] for table in cursor.fetchall()]
+        
+        stat1_rows = {} if exact_counts else _stat1_row_counts(cursor)
+        table_pages = _dbstat_page_counts(cursor) if page_counts else {}
+        cursor.execute("PRAGMA page_size;")
+        page_size = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_count;")
+        database_bytes = cursor.fetchone()[0] * page_size
+        
+        for table in tables:
+            escaped_table = quote_identifier(table)
+            
+            if exact_counts:
+                cursor.execute(f"SELECT COUNT(*) FROM {escaped_table};")
+                row_count, row_source = cursor.fetchone()[0], "count"
+            elif table in stat1_rows:
+                row_count, row_source = stat1_rows[table], "sqlite_stat1"
+            else:
+                try:
+                    cursor.execute(f"SELECT MAX(rowid) FROM {escaped_table};")
+                    row_count, row_source = cursor.fetchone()[0] or 0, "max_rowid_upper_bound"
+                except sqlite3.Error:
+                    # WITHOUT ROWID table
+                    cursor.execute(f"SELECT COUNT(*) FROM {escaped_table};")
+                    row_count, row_source = cursor.fetchone()[0], "count"
+            
+            cursor.execute(f"PRAGMA table_info({escaped_table});")
+            column_names = [col[1] for col in cursor.fetchall()]
+            page_count = table_pages.get(table)
+            
+            db_info.append({
+                'Database': db_name,
+                'Table': table,
+                'Rows': row_count,
+                'Row Source': row_source,
+                'Columns': len(column_names),
+                'Column Names': ', '.join(column_names),
+                'Pages': page_count,
+                'Bytes': page_count * page_size if page_count is not None else None,
+                'Database Bytes': database_bytes,
+                'SQLite Path': str(db_path)
+            })
+    except sqlite3.Error as e:
+        print(f"  Error accessing {db_name}: {str(e)}")
+    finally:
+        if 'conn' in locals():
+            conn.close()
+    
+    return db_info
+
+def survey_sqlite_databases(base_path, exact_counts=False, max_workers=None, page_counts=False):
+    """
+    Fast version of explore_sqlite_databases: databases are opened read-only
+    and surveyed in parallel, and row counts are estimated from catalog
+    statistics unless exact_counts is set.
+    
+    Args:
+        base_path (str): Path to the main database directory
+        exact_counts (bool): Use SELECT COUNT(*) for every table
+        page_counts (bool): Read per-table page counts from dbstat (full file read)
+        max_workers (int): Number of worker processes (defaults to CPU count)
+        
+    Returns:
+        pandas.DataFrame or None: One row per table
+    """
+    base_dir = Path(base_path)
+    sqlite_files = sorted(base_dir.glob("*/*.sqlite"))
+    print(f"Found {len(sqlite_files)} SQLite databases")
+    
+    all_db_info = []
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        for db_info in executor.map(survey_database, sqlite_files, [exact_counts] * len(sqlite_files),
+                                    [page_counts] * len(sqlite_files)):
+            all_db_info.extend(db_info)
+    
+    if all_db_info:
+        return pd.DataFrame(all_db_info)
+    else:
+        print("No database information collected.")
+        return None
+
+def save_summary(df, output_path):
+    """
+    Save the summary in a columnar format (Parquet) so later stages can read
+    only the columns they need, e.g. Rows/Database Bytes for scheduling.
+    Falls back to CSV if no Parquet engine is installed.
+    
+    Returns:
+        str: The path actually written
+    """
+    output_path = Path(output_path)
+    try:
+        df.to_parquet(output_path.with_suffix(".parquet"), index=False)
+        return str(output_path.with_suffix(".parquet"))
+    except ImportError:
+        df.to_csv(output_path.with_suffix(".csv"), index=False)
+        return str(output_path.with_suffix(".csv"))
+
 # Example usage
 if __name__ == "__main__":
-    # Replace with your actual database directory path
-    db_directory = "./database"
+    parser = argparse.ArgumentParser(description="Summarize tables in a directory of SQLite databases")
+    parser.add_argument("--db_directory", default="./database", help="Directory with one sub-directory per database")
+    parser.add_argument("--survey", action="store_true", help="Read-only parallel survey using catalog row estimates")
+    parser.add_argument("--exact", action="store_true", help="With --survey, use exact COUNT(*) row counts")
+    parser.add_argument("--page_counts", action="store_true", help="With --survey, per-table sizes from dbstat (reads every page)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for --survey")
+    parser.add_argument("--output", default="database_summary", help="Output path without extension")
+    args = parser.parse_args()
+    db_directory = args.db_directory
     
     print(f"Starting exploration of databases in {db_directory}")
-    result_df = explore_sqlite_databases(db_directory)
+    if args.survey:
+        result_df = survey_sqlite_databases(db_directory, exact_counts=args.exact, max_workers=args.workers,
+                                            page_counts=args.page_counts)
+    else:
+        result_df = explore_sqlite_databases(db_directory)
     
     if result_df is not None:
         # Display the summary
         print("\n\nSummary of all databases:")
         print(result_df)
         
-        # Optionally save to CSV
-        result_df.to_csv("database_summary.csv", index=False)
-        print("Summary saved to database_summary.csv")
\ No newline at end of file
+        if args.survey:
+            summary_path = save_summary(result_df, args.output)
+        else:
+            summary_path = f"{args.output}.csv"
+            result_df.to_csv(summary_path, index=False)
+        print(f"Summary saved to {summary_path}")
@@ -25,9 +25,79 @@ Q = "quantitative"
 C = "category"
 
 database_dir = "./database_csv_filtered/"
+# Per-table column statistics sidecar read by part2 instead of the raw CSVs
+column_stats_dir = "./column_stats/"
+TOP_K = 10
+DISTINCT_SAMPLE_SIZE = 100
+QUANTILES = [0.0, 0.25, 0.5, 0.75, 1.0]
 save_metadata = {}
 total_csv_processed = 0
 
+def sorted_unique(series):
+    """Sorted distinct non-null values, falling back to string order for mixed types."""
+    unique_values = list(series.dropna().unique())
+    try:
+        return sorted(unique_values)
+    except TypeError:
+        return sorted(unique_values, key=str)
+
+def compute_column_stats(df):
+    """
+    Compute a compact statistics summary for every column of a table.
+    
+    Args:
+        df: DataFrame of the table
+        
+    Returns:
+        dict: num_rows, num_columns and per-column min/max, quantiles,
+        top-k values and a bounded, sorted distinct-value sample that always
+        keeps the true min and max
+    """
+    # Separate generator so the sidecar does not shift the seeded examples above
+    rng = random.Random(0)
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        unique_values = sorted_unique(series)
+        
+        if len(unique_values) > DISTINCT_SAMPLE_SIZE:
+            middle = sorted(rng.sample(range(1, len(unique_values) - 1), DISTINCT_SAMPLE_SIZE - 2))
+            distinct_sample = [unique_values[0]] + [unique_values[i] for i in middle] + [unique_values[-1]]
+        else:
+            distinct_sample = unique_values
+        
+        quantiles = None
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+            if series.notna().any():
+                quantiles = dict(zip([str(q) for q in QUANTILES], series.quantile(QUANTILES).tolist()))
+        
+        top_k = series.value_counts(dropna=True).head(TOP_K)
+        
+        columns[column] = {
+            "dtype": str(series.dtype),
+            "null_count": int(series.isna().sum()),
+            "distinct_count": len(unique_values),
+            "min": unique_values[0] if unique_values else None,
+            "max": unique_values[-1] if unique_values else None,
+            "quantiles": quantiles,
+            "top_k": [[value, int(count)] for value, count in top_k.items()],
+            "distinct_sample": distinct_sample,
+            "distinct_sample_complete": len(unique_values) <= DISTINCT_SAMPLE_SIZE,
+        }
+    
+    return {
+        "num_rows": int(df.shape[0]),
+        "num_columns": int(df.shape[1]),
+        "columns": columns,
+    }
+
+def save_column_stats(filename, df):
+    """Write the column statistics sidecar for one table."""
+    stats = convert_numpy_types(compute_column_stats(df))
+    os.makedirs(column_stats_dir, exist_ok=True)
+    with open(os.path.join(column_stats_dir, f"{filename}.json"), "w") as json_file:
+        json.dump(stats, json_file)
+
 def process_csv_file(filename):
     """Process a single CSV file to extract metadata without ambiguity."""
     global total_csv_processed
@@ -40,6 +110,11 @@ def process_csv_file(filename):
         logger.error(f"Failed to read {filename}: {e}")
         return None
 
+    try:
+        save_column_stats(filename, df)
+    except Exception as e:
+        logger.error(f"Failed to save column stats for {filename}: {e}")
+
     # Type assignment and value examples in a single pass
     field_by_type = {T: [], Q: [], C: []}
     type_by_field = {}
@@ -1,6 +1,10 @@
 import json
 import os
-from llm_gpt_call import call_gpt_4, call_gpt_3_5
+import asyncio
+from llm_gpt_call import call_gpt_4, call_gpt_3_5, estimate_tokens
+from llm_async_call import AsyncLLMClient
+from llm_cache import forget_response
+from llm_output_parser import extract_json
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
@@ -39,35 +43,120 @@ Now, provide descriptions for all columns in the following table:
 # Output:
 """
 
-def extract_json_from_response(response):
+batch_prompt = """You are an expert data analyst. Your task is to provide clear, concise descriptions for all columns in several database tables based on their names and example values.
+
+# Instructions:
+1. Analyze each column name and its example values to understand the data type and purpose.
+2. Provide a brief (1-2 sentences) description for each column that explains what it represents.
+3. Include information about the data type and format if relevant.
+4. Be specific but concise.
+5. Describe every column of every table, and key the output by the exact table_name given in the input.
+
+# Example Input:
+[
+  {{
+    "table_name": "patients",
+    "columns": {{
+      "birthdate": ["1928-04-12", "1921-10-11", "1930-04-10"],
+      "patient_id": ["P12345", "P67890", "P24680"]
+    }}
+  }},
+  {{
+    "table_name": "visits",
+    "columns": {{
+      "visit_date": ["2019-01-02", "2019-03-15", "2020-07-30"]
+    }}
+  }}
+]
+
+# Example Output:
+{{
+  "patients": {{
+    "birthdate": "A date field representing a person's date of birth in YYYY-MM-DD format.",
+    "patient_id": "A unique identifier for each patient, starting with 'P' followed by a numeric sequence."
+  }},
+  "visits": {{
+    "visit_date": "A date field recording when the visit took place, in YYYY-MM-DD format."
+  }}
+}}
+
+Now, provide descriptions for all columns in the following tables:
+
+# Input:
+{0}
+
+# Output:
+"""
+
+# Tokens per batched request: instructions + packed tables + expected descriptions
+BATCH_TOKEN_BUDGET = 4000
+# Expected completion tokens for one column description
+DESCRIPTION_TOKENS_PER_COLUMN = 30
+# Send the requests from one event loop with AsyncLLMClient instead of one
+# blocking call per worker process
+USE_ASYNC = True
+MAX_IN_FLIGHT = 16
+
+def save_table_output(output_dir, table_name, descriptions, result, token_usage, batch_size=1):
+    output_data = {
+        "table_name": table_name,
+        "descriptions": descriptions,
+        "original_response": result,
+        "token_usage": token_usage,
+        "batch_size": batch_size
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, f"{table_name}.json")
+    try:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(output_data, f, indent=2)
+    except Exception as e:
+        print(f"Error saving results for {table_name}: {e}")
+
+def load_table_output(output_dir, table_name, table_data):
+    """Descriptions saved by an earlier run, or None if there are none or they miss a column."""
+    output_file = os.path.join(output_dir, f"{table_name}.json")
+    if not os.path.exists(output_file):
+        return None
+    try:
+        with open(output_file, "r", encoding="utf-8") as f:
+            descriptions = json.load(f).get("descriptions")
+    except (OSError, json.JSONDecodeError, AttributeError):
+        return None
+    if not isinstance(descriptions, dict) or missing_columns(table_data, descriptions):
+        return None
+    return descriptions
+
+def missing_columns(table_data, descriptions):
+    """Columns of the table without a description."""
+    return [column for column in table_data["data_value_example"] if column not in descriptions]
+
+def table_tokens(table_name, table_data):
+    """Estimated tokens of a table's part of a batched request: its input plus expected descriptions."""
+    portion = {"table_name": table_name, "columns": table_data["data_value_example"]}
+    return estimate_tokens(json.dumps(portion, indent=2)) + DESCRIPTION_TOKENS_PER_COLUMN * len(table_data["data_value_example"])
+
+def share_token_usage(token_usage, weights):
     """
-    Extract JSON from a response that might contain markdown code blocks or other formatting.
-    Raises json.JSONDecodeError if parsing fails.
-    
-    Args:
-        response: String containing a potential JSON response
-        
-    Returns:
-        Dictionary containing the parsed JSON
+    Split the token usage of a batched request between its tables in
+    proportion to weights; the shares add up to the request's usage.
     """
-    import re
-    
-    # Check if the response contains a code block
-    code_block_match = re.search(r'```(?:json)?\s*([^\s\S]*?)\s*```', response)
-    if code_block_match and code_block_match.group(1):
-        json_str = code_block_match.group(1).strip()
-    else:
-        # If no code block, try to find json-like content between braces
-        braces_match = re.search(r'\{[^\s\S]*\}|[^\s\S]*', response)
-        if braces_match:
-            json_str = braces_match.group(0)
-        else:
-            # If no clear JSON structure is found, assume the whole response might be JSON
-            # This might raise an error if the response is not valid JSON, which is now intended
-            json_str = response
-    
-    # Try to parse the JSON - will raise JSONDecodeError if invalid
-    return json.loads(json_str)
+    total_weight = sum(weights) or 1
+    shares = [{} for _ in weights]
+    for key in ("prompt_tokens", "completion_tokens"):
+        amount = token_usage.get(key, 0)
+        parts = [amount * weight // total_weight for weight in weights]
+        parts[0] += amount - sum(parts)
+        for share, part in zip(shares, parts):
+            share[key] = part
+    for share in shares:
+        share["total_tokens"] = share["prompt_tokens"] + share["completion_tokens"]
+    return shares
+
+def add_token_usage(usage, other):
+    if usage is None:
+        return other
+    return {key: usage.get(key, 0) + other.get(key, 0) for key in ("prompt_tokens", "completion_tokens", "total_tokens")}
 
 def process_table(args):
     """
@@ -80,20 +169,19 @@ def process_table(args):
         tuple: (table_name, column_descriptions)
     """
     table_name, table_data, output_dir, sys_content = args
+    return table_name, describe_table(table_name, table_data, output_dir, sys_content)
+
+def describe_table(table_name, table_data, output_dir, sys_content, described=None, usage_share=None):
+    """
+    Describe the columns of one table with one request, or only the columns
+    missing from described, the partial answer of a batched request whose
+    token usage share is usage_share.
     
-    # Extract column names and example values
-    columns = table_data["field_list"]
-    examples = table_data["data_value_example"]
-    
-    # Format the input JSON
-    input_data = {
-        "table_name": table_name,
-        "columns": examples
-    }
-    
-    # Format the prompt with the input data
-    json_str = json.dumps(input_data, indent=2)
-    user_content = prompt.format(json_str)
+    Returns:
+        dict: Column descriptions, described alone if the request fails
+    """
+    described = described or {}
+    user_content = build_table_prompt(table_name, table_data, missing_columns(table_data, described))
     
     # Call GPT
     try:
@@ -102,43 +190,206 @@ def process_table(args):
         result, token_usage = call_gpt_4(user_content, sys_content)
     except Exception as e:
         print(f"Error calling GPT for table {table_name}: {e}")
-        return table_name, {}
+        return described
     
-    # Extract descriptions from the result
+    return parse_table_result(table_name, result, token_usage, output_dir,
+                              lambda: forget_response("gpt-4", user_content, sys_content),
+                              described, usage_share)
+
+def build_table_prompt(table_name, table_data, columns=None):
+    """Prompt describing the columns of one table, or only the given ones."""
+    examples = table_data["data_value_example"]
+    input_data = {
+        "table_name": table_name,
+        "columns": examples if columns is None else {column: examples[column] for column in columns}
+    }
+    return prompt.format(json.dumps(input_data, indent=2))
+
+def parse_table_result(table_name, result, token_usage, output_dir, forget=None, described=None, usage_share=None):
+    """
+    Descriptions parsed from a single-table response and merged into described
+    (saved to output_dir). If the response is unparsable, forget() drops it
+    from the cache and described (or {}) is returned unsaved.
+    """
+    described = described or {}
     try:
-        descriptions = extract_json_from_response(result)
+        descriptions = extract_json(result)
     except json.JSONDecodeError as e:
         print(f"Failed to parse JSON response for table '{table_name}'. Error: {e}")
         print(f"Original response content:\n{result}") # Log the response that failed
-        return table_name, {} # Return empty dict for this table on parsing failure
-    
-    # Prepare output data
-    output_data = {
-        "table_name": table_name,
-        "descriptions": descriptions,
-        "original_response": result,
-        "token_usage": token_usage
-    }
+        if forget is not None:
+            forget()
+        return described # Keep what the batch described for this table on parsing failure
+    if not isinstance(descriptions, dict):
+        descriptions = {}
+    descriptions = {**described, **descriptions}
     
     # Save to file
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, f"{table_name}.json")
+    save_table_output(output_dir, table_name, descriptions, result, add_token_usage(usage_share, dict(token_usage)))
+    
+    return descriptions
+
+def make_batches(metadata, token_budget=BATCH_TOKEN_BUDGET):
+    """
+    Greedily pack tables, in order, into batches whose prompt plus expected
+    output stays within token_budget. A table that does not fit in a batch on
+    its own gets a batch of one.
+    
+    Args:
+        metadata: Dictionary containing table metadata
+        token_budget: Maximum estimated tokens per request
+    
+    Returns:
+        list: Batches, each a list of (table_name, table_data)
+    """
+    preamble_tokens = estimate_tokens(batch_prompt)
+    batches = []
+    current, current_tokens = [], preamble_tokens
+    for table_name, table_data in metadata.items():
+        portion_tokens = table_tokens(table_name, table_data)
+        if current and current_tokens + portion_tokens > token_budget:
+            batches.append(current)
+            current, current_tokens = [], preamble_tokens
+        current.append((table_name, table_data))
+        current_tokens += portion_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def process_batch(args):
+    """
+    Describe the columns of several tables with one request. Tables whose part of
+    the response is missing, not a JSON object or lacks some columns get a
+    single request for the columns still undescribed.
+    
+    Args:
+        args: Tuple containing (batch, output_dir, sys_content)
+    
+    Returns:
+        list: (table_name, column_descriptions) per table in the batch
+    """
+    batch, output_dir, sys_content = args
+    if len(batch) == 1:
+        table_name, table_data = batch[0]
+        return [process_table((table_name, table_data, output_dir, sys_content))]
+    
+    result, token_usage = None, None
+    user_content = build_batch_prompt(batch)
     try:
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(output_data, f, indent=2)
+        result, token_usage = call_gpt_4(user_content, sys_content)
     except Exception as e:
-        print(f"Error saving results for {table_name}: {e}")
+        print(f"Error calling GPT for a batch of {len(batch)} tables: {e}")
+    results, incomplete = split_batch_result(batch, result, token_usage, output_dir,
+                                             lambda: forget_response("gpt-4", user_content, sys_content))
+    # Fall back to a single request for the columns the batch did not describe
+    for table_name, table_data, described, usage_share in incomplete:
+        results.append((table_name, describe_table(table_name, table_data, output_dir, sys_content,
+                                                   described, usage_share)))
+    return results
+
+def build_batch_prompt(batch):
+    """Prompt describing the columns of every table in the batch."""
+    input_data = [
+        {"table_name": table_name, "columns": table_data["data_value_example"]}
+        for table_name, table_data in batch
+    ]
+    return batch_prompt.format(json.dumps(input_data, indent=2))
+
+def split_batch_result(batch, result, token_usage, output_dir, forget=None):
+    """
+    Split a batched response into per-table descriptions, saving each with its
+    share of the request's token usage. An unparsable response is dropped
+    from the cache with forget().
     
-    return table_name, descriptions
+    Returns:
+        tuple: ((table_name, descriptions) list of the fully described tables,
+        (table_name, table_data, partial descriptions, token usage share) list
+        of the tables whose part is missing, not a JSON object or incomplete)
+    """
+    parsed = None
+    if result is not None:
+        try:
+            parsed = extract_json(result)
+        except json.JSONDecodeError as e:
+            print(f"Failed to parse batched JSON response for {len(batch)} tables. Error: {e}")
+        if not isinstance(parsed, dict) and forget is not None:
+            forget()
+    if not isinstance(parsed, dict):
+        parsed = {}
+    if token_usage is not None:
+        shares = share_token_usage(dict(token_usage), [table_tokens(name, data) for name, data in batch])
+    else:
+        shares = [None] * len(batch)
+    
+    results, incomplete = [], []
+    for (table_name, table_data), usage_share in zip(batch, shares):
+        descriptions = parsed.get(table_name)
+        if not isinstance(descriptions, dict):
+            descriptions = {}
+        if descriptions and not missing_columns(table_data, descriptions):
+            save_table_output(output_dir, table_name, descriptions, result, usage_share, batch_size=len(batch))
+            results.append((table_name, descriptions))
+        else:
+            incomplete.append((table_name, table_data, descriptions, usage_share))
+    return results, incomplete
 
-def generate_column_descriptions(metadata, output_dir="./llm_column_descriptions"):
+async def describe_batches_async(batches, output_dir, sys_content):
+    """
+    Async equivalent of mapping process_batch over batches: every request is
+    sent from one event loop through AsyncLLMClient.
+    
+    Returns:
+        dict: table_name -> column descriptions
+    """
+    client = AsyncLLMClient(model="gpt-4", max_in_flight=MAX_IN_FLIGHT)
+    
+    async def run_table(table_name, table_data, described=None, usage_share=None):
+        described = described or {}
+        user_content = build_table_prompt(table_name, table_data, missing_columns(table_data, described))
+        try:
+            result, token_usage = await client.chat(user_content, sys_content)
+        except Exception as e:
+            print(f"Error calling GPT for table {table_name}: {e}")
+            return table_name, described
+        return table_name, parse_table_result(table_name, result, token_usage, output_dir,
+                                              lambda: client.forget(user_content, sys_content),
+                                              described, usage_share)
+    
+    async def run_batch(batch):
+        if len(batch) == 1:
+            return [await run_table(*batch[0])]
+        result, token_usage = None, None
+        user_content = build_batch_prompt(batch)
+        try:
+            result, token_usage = await client.chat(user_content, sys_content)
+        except Exception as e:
+            print(f"Error calling GPT for a batch of {len(batch)} tables: {e}")
+        results, incomplete = split_batch_result(batch, result, token_usage, output_dir,
+                                                 lambda: client.forget(user_content, sys_content))
+        results.extend(await asyncio.gather(*[run_table(*table) for table in incomplete]))
+        return results
+    
+    results = {}
+    async with client:
+        tasks = [run_batch(batch) for batch in batches]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing table batches"):
+            for table_name, descriptions in await future:
+                results[table_name] = descriptions
+    return results
+
+def generate_column_descriptions(metadata, output_dir="./llm_column_descriptions", batch_token_budget=None):
     """
     Generate descriptions for all columns in each table using LLM and save results.
-    Uses multiprocessing for parallel execution.
+    Requests run concurrently on AsyncLLMClient (USE_ASYNC), or else in a process pool.
     
     Args:
         metadata: Dictionary containing table metadata
         output_dir: Directory to save output JSON files
+        batch_token_budget: If set, pack several tables into each request up to
+            this many prompt tokens instead of sending one request per table
+    
+    Tables whose saved output in output_dir already describes every column are
+    not requested again.
         
     Returns:
         Dictionary containing all table metadata with added column descriptions
@@ -149,24 +400,54 @@ def generate_column_descriptions(metadata, output_dir="./llm_column_descriptions
     # System content for GPT
     sys_content = "You are an expert data analyst. Provide clear, concise descriptions for database columns."
     
-    # Prepare arguments for multiprocessing
-    process_args = [
-        (table_name, table_data, output_dir, sys_content)
-        for table_name, table_data in metadata.items()
-    ]
-    
     # Determine number of workers (use at most 75% of available cores)
     max_workers = max(1, int(multiprocessing.cpu_count() * 0.75))
     
-    # Process tables in parallel with progress bar
-    results = {}
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        for table_name, descriptions in tqdm(
-            executor.map(process_table, process_args),
-            total=len(process_args),
-            desc="Processing tables"
-        ):
+    # Tables fully described by an earlier run are not requested again
+    results, pending = {}, {}
+    for table_name, table_data in metadata.items():
+        descriptions = load_table_output(output_dir, table_name, table_data)
+        if descriptions is not None:
             results[table_name] = descriptions
+        else:
+            pending[table_name] = table_data
+    if results:
+        print(f"Reusing the saved descriptions of {len(results)} tables from {output_dir}")
+    
+    if USE_ASYNC:
+        if batch_token_budget:
+            batches = make_batches(pending, batch_token_budget)
+            print(f"Packed {len(pending)} tables into {len(batches)} requests")
+        else:
+            batches = [[(table_name, table_data)] for table_name, table_data in pending.items()]
+        results.update(asyncio.run(describe_batches_async(batches, output_dir, sys_content)))
+    elif batch_token_budget:
+        batches = make_batches(pending, batch_token_budget)
+        print(f"Packed {len(pending)} tables into {len(batches)} requests")
+        batch_args = [(batch, output_dir, sys_content) for batch in batches]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for batch_results in tqdm(
+                executor.map(process_batch, batch_args),
+                total=len(batch_args),
+                desc="Processing table batches"
+            ):
+                for table_name, descriptions in batch_results:
+                    results[table_name] = descriptions
+    else:
+        # Prepare arguments for multiprocessing
+        process_args = [
+            (table_name, table_data, output_dir, sys_content)
+            for table_name, table_data in pending.items()
+        ]
+        
+        # Process tables in parallel with progress bar
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for table_name, descriptions in tqdm(
+                executor.map(process_table, process_args),
+                total=len(process_args),
+                desc="Processing tables"
+            ):
+                results[table_name] = descriptions
     
     # Save consolidated results
     with open(os.path.join(output_dir, "all_descriptions.json"), "w", encoding="utf-8") as f:
@@ -195,7 +476,7 @@ if __name__ == "__main__":
         exit(1)
     
     # Generate column descriptions and save results
-    metadata_with_descriptions = generate_column_descriptions(metadata)
+    metadata_with_descriptions = generate_column_descriptions(metadata, batch_token_budget=BATCH_TOKEN_BUDGET)
     
     # Save the updated metadata to a new file
     try:
@@ -1,7 +1,16 @@
 import json
 import os
-from llm_gpt_call import call_gpt_4, call_gpt_3_5
+import re
+import argparse
+import hashlib
+from collections import defaultdict
+from llm_gpt_call import call_gpt_4, call_gpt_3_5, estimate_tokens
+from llm_output_parser import extract_json
+from ambiguity_prefilter import propose_candidate_groups, prefilter_recall
 import uuid
+import asyncio
+from llm_async_call import AsyncLLMClient
+from llm_cache import forget_response
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
@@ -61,31 +70,62 @@ Now, process the following input and provide the output:
 # Output:
 """
 
+# Used with the lexical prefilter: the model only confirms or rejects the
+# candidate groups instead of scanning every column of the table
+candidate_prompt = """You are an expert data analyst. The candidate groups below were proposed from column names alone. Each group contains columns that might be ambiguously referred to by a single natural language term. Use the descriptions and example values to confirm or reject each group.
+
+# Instructions:
+1. Keep a group only if a single natural language term could reasonably refer to each of its columns, e.g. "name": ["firstname", "lastname"], "player": ["playername", "playerid"], "location": ["city", "province"], "date": ["start_date", "end_date"].
+2. You may drop columns from a group or split a group, but only use columns listed in the candidate groups.
+3. Each confirmed group should only include 2 or 3 columns, and groups must be mutually exclusive - a column should only appear in one group. Give each group a specific natural language name.
+4. Return the output in valid JSON format with one section, "ambiguous_columns_groups". Return {{"ambiguous_columns_groups": {{}}}} if no group is confirmed.
+
+# Example Input:
+{{
+  "candidate_groups": {{
+    "player": ["playerid", "playername"],
+    "location": ["city", "province"],
+    "score": ["home_score", "score_date"]
+  }},
+  "values": {{
+    "playername": ["Mike Jordan", "LeBron James"],
+    "playerid": ["12345", "67890"],
+    "city": ["Toronto", "Vancouver"],
+    "province": ["Ontario", "British Columbia"],
+    "home_score": ["98", "105"],
+    "score_date": ["2020-01-03", "2020-02-11"]
+  }},
+  "descriptions": {{
+    "playername": "A text field containing the full name of the player",
+    "playerid": "A unique identifier for each player in the system",
+    "city": "The city where the game was played",
+    "province": "The province or state where the game was played",
+    "home_score": "Points scored by the home team",
+    "score_date": "Date the score was recorded"
+  }}
+}}
+
+# Example Output:
+{{
+  "ambiguous_columns_groups": {{
+    "player": ["playername", "playerid"],
+    "location": ["city", "province"]
+  }}
+}}
+
+Now, process the following input and provide the output:
+
+# Input:
+{0}
+
+# Output:
+"""
+
+# Send the requests from one event loop with AsyncLLMClient instead of one
+# blocking call per worker process
+USE_ASYNC = True
+MAX_IN_FLIGHT = 16
 
-def extract_json_from_response(response):
-    """
-    Extract JSON from a response that might contain markdown code blocks or other formatting.
-    
-    Args:
-        response: String containing a potential JSON response
-        
-    Returns:
-        String containing only the JSON part of the response
-    """
-    import re
-    
-    # Check if the response contains a code block
-    code_block_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', response)
-    if code_block_match and code_block_match.group(1):
-        return code_block_match.group(1).strip()
-    
-    # If no code block, try to find json-like content between braces
-    braces_match = re.search(r'\{[\s\S]*\}', response)
-    if braces_match:
-        return braces_match.group(0)
-    
-    # Return the original if no patterns match
-    return response
 
 def process_table(args):
     """
@@ -99,20 +139,8 @@ def process_table(args):
     """
     table_name, table_data, output_dir, sys_content = args
     
-    # Extract column names, descriptions, and example values
-    columns = table_data["field_list"]
-    examples = table_data["data_value_example"]
-    descriptions = table_data.get("descriptions", {})
-    
-    # Format the input JSON
-    input_data = {
-        "columns": columns,
-        "values": examples,
-        "descriptions": descriptions
-    }
-    
-    # Format the prompt with the input data
-    user_content = prompt.format(json.dumps(input_data, indent=2))
+    # Format the prompt with the column names, descriptions, and example values
+    user_content = build_full_prompt(table_data)
     
     # Call GPT-4
     try:
@@ -121,18 +149,22 @@ def process_table(args):
         print(f"Error calling GPT for table {table_name}: {e}")
         return table_name, None
     
-    # Extract JSON from the result (handles markdown code blocks)
-    cleaned_result = extract_json_from_response(result)
-    
-    # Try to parse the cleaned result as JSON
+    return table_name, save_full_result(table_name, result, token_usage, output_dir,
+                                        lambda: forget_response("gpt-4", user_content, sys_content))
+
+def save_full_result(table_name, result, token_usage, output_dir, forget=None):
+    """Parse and save the response to the full prompt; an unparsable one is dropped from the cache with forget()."""
+    # Extract JSON from the result (handles markdown code blocks and near-JSON)
     try:
-        parsed_result = json.loads(cleaned_result)
+        parsed_result = extract_json(result)
     except json.JSONDecodeError:
         parsed_result = {
             "ambiguous_columns_groups": {},
             "unambiguous_columns": []
         }
         print(f"Failed to parse GPT output for table {table_name}")
+        if forget is not None:
+            forget()
     
     # Prepare output data
     output_data = {
@@ -150,16 +182,239 @@ def process_table(args):
     except Exception as e:
         print(f"Error saving results for {table_name}: {e}")
     
-    return table_name, parsed_result
+    return parsed_result
+
+def build_full_prompt(table_data):
+    """Prompt listing every column of the table."""
+    input_data = {
+        "columns": table_data["field_list"],
+        "values": table_data["data_value_example"],
+        "descriptions": table_data.get("descriptions", {})
+    }
+    return prompt.format(json.dumps(input_data, indent=2))
+
+def build_candidate_prompt(table_data, candidates):
+    """Prompt listing only the candidate groups and the values/descriptions of their columns."""
+    candidate_columns = {column for group in candidates.values() for column in group}
+    columns = [column for column in table_data["field_list"] if column in candidate_columns]
+    examples = table_data["data_value_example"]
+    descriptions = table_data.get("descriptions", {})
+    input_data = {
+        "candidate_groups": candidates,
+        "values": {column: examples[column] for column in columns if column in examples},
+        "descriptions": {column: descriptions[column] for column in columns if column in descriptions}
+    }
+    return candidate_prompt.format(json.dumps(input_data, indent=2))
 
-def generate_ambiguity_pairs(metadata, output_dir="./llm_ambiguity_pairs"):
+def validate_confirmed_groups(parsed_result, table_data, candidates):
+    """
+    Keep confirmed groups that only use candidate columns, with each column in
+    at most one group, and derive the unambiguous columns locally.
+    """
+    candidate_columns = {column for group in candidates.values() for column in group}
+    groups, used = {}, set()
+    for group_name, columns in parsed_result.get("ambiguous_columns_groups", {}).items():
+        if not isinstance(columns, list):
+            continue
+        columns = [c for c in dict.fromkeys(columns) if c in candidate_columns and c not in used]
+        if len(columns) >= 2:
+            groups[group_name] = columns
+            used.update(columns)
+    return {
+        "ambiguous_columns_groups": groups,
+        "unambiguous_columns": [c for c in table_data["field_list"] if c not in used]
+    }
+
+def process_table_with_candidates(args):
+    """
+    Like process_table, but only asks the LLM to confirm or reject the groups
+    proposed by the lexical prefilter. Tables without candidates skip the call.
+    
+    Args:
+        args: Tuple containing (table_name, table_data, output_dir, sys_content)
+    
+    Returns:
+        tuple: (table_name, parsed_result) - Name of the processed table and its parsed result
+    """
+    table_name, table_data, output_dir, sys_content = args
+    candidates = propose_candidate_groups(table_data)
+    if not candidates:
+        return table_name, save_skipped_table(table_name, table_data, output_dir)
+    
+    user_content = build_candidate_prompt(table_data, candidates)
+    try:
+        result, token_usage = call_gpt_4(user_content, sys_content)
+    except Exception as e:
+        print(f"Error calling GPT for table {table_name}: {e}")
+        return table_name, None
+    
+    return table_name, save_candidate_result(table_name, table_data, candidates, result, token_usage, output_dir,
+                                             lambda: forget_response("gpt-4", user_content, sys_content))
+
+def save_skipped_table(table_name, table_data, output_dir):
+    """Result of a table without candidate groups: every column unambiguous, no LLM call."""
+    parsed_result = {"ambiguous_columns_groups": {}, "unambiguous_columns": list(table_data["field_list"])}
+    with open(os.path.join(output_dir, f"{table_name}.csv.json"), "w", encoding="utf-8") as f:
+        json.dump({"table_name": table_name, "candidate_groups": {}, "skipped": True,
+                   "parsed_response": parsed_result}, f, indent=2)
+    return parsed_result
+
+def save_candidate_result(table_name, table_data, candidates, result, token_usage, output_dir, forget=None):
+    """Parse, validate and save the response to the candidate prompt; an unparsable one is dropped from the cache with forget()."""
+    output_file = os.path.join(output_dir, f"{table_name}.csv.json")
+    try:
+        confirmed = extract_json(result)
+    except json.JSONDecodeError:
+        confirmed = {}
+        print(f"Failed to parse GPT output for table {table_name}")
+        if forget is not None:
+            forget()
+    parsed_result = validate_confirmed_groups(confirmed, table_data, candidates)
+    
+    output_data = {
+        "table_name": table_name,
+        "candidate_groups": candidates,
+        "original_response": result,
+        "parsed_response": parsed_result,
+        "token_usage": token_usage
+    }
+    try:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(output_data, f, indent=2)
+    except Exception as e:
+        print(f"Error saving results for {table_name}: {e}")
+    
+    return parsed_result
+
+async def query_tables_async(tables, metadata, output_dir, sys_content, use_prefilter):
+    """
+    Async equivalent of mapping process_table (or process_table_with_candidates)
+    over tables: every request is sent from one event loop through AsyncLLMClient.
+    
+    Returns:
+        dict: table_name -> parsed result, for the tables whose call succeeded
+    """
+    client = AsyncLLMClient(model="gpt-4", max_in_flight=MAX_IN_FLIGHT)
+    
+    async def run_table(table_name):
+        table_data = metadata[table_name]
+        candidates = propose_candidate_groups(table_data) if use_prefilter else None
+        if use_prefilter and not candidates:
+            return table_name, save_skipped_table(table_name, table_data, output_dir)
+        user_content = build_candidate_prompt(table_data, candidates) if use_prefilter else build_full_prompt(table_data)
+        try:
+            result, token_usage = await client.chat(user_content, sys_content)
+        except Exception as e:
+            print(f"Error calling GPT for table {table_name}: {e}")
+            return table_name, None
+        forget = lambda: client.forget(user_content, sys_content)
+        if use_prefilter:
+            return table_name, save_candidate_result(table_name, table_data, candidates, result, token_usage,
+                                                     output_dir, forget)
+        return table_name, save_full_result(table_name, result, token_usage, output_dir, forget)
+    
+    results = {}
+    async with client:
+        tasks = [run_table(table_name) for table_name in tables]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing tables"):
+            table_name, parsed_result = await future
+            if parsed_result is not None:
+                results[table_name] = parsed_result
+    return results
+
+def load_gold_groups(gold_path):
+    """Table name -> labelled ambiguity groups, from a metadata file such as BIRD_metadata_AMBI.json."""
+    with open(gold_path, "r", encoding="utf-8") as f:
+        gold = json.load(f)
+    return {
+        table_name: table_data.get("ambiguous_pairs") or table_data.get("ambiguous_columns_groups") or {}
+        for table_name, table_data in gold.items()
+    }
+
+def prefilter_report(metadata, tables_to_query, gold_groups=None):
+    """
+    Calls skipped and prompt tokens saved by the prefilter and, given
+    gold_groups (see load_gold_groups), its recall on the labelled tables.
+    """
+    skipped = full_tokens = candidate_tokens = 0
+    for table_name in tables_to_query:
+        table_data = metadata[table_name]
+        candidates = propose_candidate_groups(table_data)
+        full_tokens += estimate_tokens(build_full_prompt(table_data))
+        if candidates:
+            candidate_tokens += estimate_tokens(build_candidate_prompt(table_data, candidates))
+        else:
+            skipped += 1
+    report = {
+        "tables_queried": len(tables_to_query),
+        "llm_calls_skipped": skipped,
+        "prompt_tokens_full": full_tokens,
+        "prompt_tokens_prefiltered": candidate_tokens,
+        "prompt_token_reduction": 1 - candidate_tokens / full_tokens if full_tokens else None,
+    }
+    if gold_groups is not None:
+        # Candidates come from this run's metadata, gold groups from the labelled file
+        labelled = {name: dict(metadata[name], ambiguous_pairs=groups)
+                    for name, groups in gold_groups.items() if name in metadata}
+        report["recall_tables"] = len(labelled)
+        report["recall"] = prefilter_recall(labelled) if labelled else None
+    return report
+
+def normalize_column_name(name):
+    """Lowercase a column name and collapse punctuation/spaces to single underscores."""
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+def schema_signature(table_data):
+    """
+    Hash of the table's sorted (normalised column name, column type) pairs.
+    Tables with the same signature get the same ambiguity groups.
+    """
+    type_by_field = table_data.get("type_by_field", {})
+    columns = sorted(
+        (normalize_column_name(column), type_by_field.get(column, ""))
+        for column in table_data["field_list"]
+    )
+    return hashlib.sha1(json.dumps(columns).encode("utf-8")).hexdigest()
+
+def group_tables_by_signature(metadata):
+    """
+    Returns:
+        dict: signature -> list of table names, in metadata order; the first
+        table of each group is the one sent to the LLM
+    """
+    groups = defaultdict(list)
+    for table_name, table_data in metadata.items():
+        groups[schema_signature(table_data)].append(table_name)
+    return dict(groups)
+
+def remap_result(parsed_result, target_data):
+    """Rename columns in a parsed LLM result to the target table's spelling of the same columns."""
+    target_by_normalized = {normalize_column_name(c): c for c in target_data["field_list"]}
+    rename = lambda column: target_by_normalized.get(normalize_column_name(column), column)
+    return {
+        "ambiguous_columns_groups": {
+            group: [rename(column) for column in columns]
+            for group, columns in parsed_result.get("ambiguous_columns_groups", {}).items()
+        },
+        "unambiguous_columns": [rename(column) for column in parsed_result.get("unambiguous_columns", [])]
+    }
+
+def generate_ambiguity_pairs(metadata, output_dir="./llm_ambiguity_pairs", dedup_by_signature=True, use_prefilter=False,
+                             gold_path=None):
     """
     Generate ambiguity pairs and unambiguous columns for each table using GPT-4 and save results.
-    Uses multiprocessing for parallel execution.
+    Requests run concurrently on AsyncLLMClient (USE_ASYNC), or else in a process pool.
     
     Args:
         metadata: Dictionary containing table metadata with descriptions
         output_dir: Directory to save output JSON files
+        dedup_by_signature: Call the LLM once per unique schema signature and
+            copy the result to every table that shares it
+        use_prefilter: Only send the lexical candidate groups to the LLM for
+            confirmation, and skip tables that have none. Off by default: check
+            its recall on labelled tables (gold_path) first
+        gold_path: Metadata file with labelled ambiguity groups (e.g.
+            BIRD_metadata_AMBI.json) used to measure the prefilter's recall
     
     Returns:
         Dictionary: Updated metadata with ambiguity information
@@ -170,25 +425,75 @@ def generate_ambiguity_pairs(metadata, output_dir="./llm_ambiguity_pairs"):
     # System content for GPT
     sys_content = "You are an expert data analyst. Provide the output in valid JSON format as specified in the prompt."
     
+    if dedup_by_signature:
+        signature_groups = group_tables_by_signature(metadata)
+        tables_to_query = [tables[0] for tables in signature_groups.values()]
+    else:
+        signature_groups = {}
+        tables_to_query = list(metadata)
+    
     # Prepare arguments for multiprocessing
     process_args = [
-        (table_name, table_data, output_dir, sys_content)
-        for table_name, table_data in metadata.items()
+        (table_name, metadata[table_name], output_dir, sys_content)
+        for table_name in tables_to_query
     ]
     
+    if use_prefilter:
+        report = prefilter_report(metadata, tables_to_query, load_gold_groups(gold_path) if gold_path else None)
+        with open(os.path.join(output_dir, "prefilter_report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Prefilter: {report['llm_calls_skipped']} of {report['tables_queried']} LLM calls skipped, "
+              f"prompt tokens {report['prompt_tokens_full']} -> {report['prompt_tokens_prefiltered']}")
+        if report.get("recall"):
+            print(f"Prefilter recall on {report['recall_tables']} labelled tables: "
+                  f"groups {report['recall']['group_recall']}, pairs {report['recall']['pair_recall']}")
+        elif not gold_path:
+            print("Prefilter recall not measured: pass a labelled metadata file as gold_path")
+    worker = process_table_with_candidates if use_prefilter else process_table
+    
     # Determine number of workers (use at most 75% of available cores)
     max_workers = max(1, int(multiprocessing.cpu_count() * 0.75))
     
     # Process tables in parallel with progress bar and collect results
     results = {}
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        for table_name, parsed_result in tqdm(
-            executor.map(process_table, process_args),
-            total=len(process_args),
-            desc="Processing tables"
-        ):
-            if parsed_result is not None:
-                results[table_name] = parsed_result
+    if USE_ASYNC:
+        results = asyncio.run(query_tables_async(tables_to_query, metadata, output_dir, sys_content, use_prefilter))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for table_name, parsed_result in tqdm(
+                executor.map(worker, process_args),
+                total=len(process_args),
+                desc="Processing tables"
+            ):
+                if parsed_result is not None:
+                    results[table_name] = parsed_result
+    
+    # Fan the representative's result out to the other tables with its signature
+    for signature, tables in signature_groups.items():
+        representative = tables[0]
+        if representative not in results:
+            continue
+        for table_name in tables[1:]:
+            results[table_name] = remap_result(results[representative], metadata[table_name])
+            with open(os.path.join(output_dir, f"{table_name}.csv.json"), "w", encoding="utf-8") as f:
+                json.dump({
+                    "table_name": table_name,
+                    "signature_representative": representative,
+                    "parsed_response": results[table_name]
+                }, f, indent=2)
+    
+    if dedup_by_signature:
+        report = {
+            "tables": len(metadata),
+            "unique_signatures": len(signature_groups),
+            "llm_calls": len(tables_to_query),
+            "llm_calls_saved": len(metadata) - len(tables_to_query),
+            "shared_signatures": {s: tables for s, tables in signature_groups.items() if len(tables) > 1}
+        }
+        with open(os.path.join(output_dir, "schema_dedup_report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Schema dedup: {report['llm_calls']} LLM calls for {report['tables']} tables "
+              f"({report['llm_calls_saved']} saved)")
     
     # Update metadata with ambiguity information
     metadata_with_ambiguity = {}
@@ -205,6 +510,13 @@ def generate_ambiguity_pairs(metadata, output_dir="./llm_ambiguity_pairs"):
     return metadata_with_ambiguity
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find ambiguous column groups with GPT-4")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Only ask the LLM to confirm lexical candidate groups (see ambiguity_prefilter.py)")
+    parser.add_argument("--gold", default=None,
+                        help="Labelled metadata (e.g. BIRD_metadata_AMBI.json) to measure the prefilter's recall on")
+    args = parser.parse_args()
+    
     # Load the BIRD metadata with descriptions
     try:
         with open("BIRD_metadata_w_description.json", "r", encoding="utf-8") as f:
@@ -217,5 +529,5 @@ if __name__ == "__main__":
         exit(1)
     
     # Generate ambiguity pairs, unambiguous columns, and save results
-    updated_metadata = generate_ambiguity_pairs(metadata)
+    updated_metadata = generate_ambiguity_pairs(metadata, use_prefilter=args.prefilter, gold_path=args.gold)
     print(f"Saved combined metadata to BIRD_metadata_w_ambiguity.json")
\ No newline at end of file
@@ -0,0 +1,182 @@
+import re
+import sys
+import json
+import math
+from collections import Counter, defaultdict
+
+# Column name families that are referred to by one word even though the names share no token
+SEMANTIC_FAMILIES = {
+    "location": ["city", "state", "province", "country", "county", "region", "street", "address", "zipcode", "zip", "postcode"],
+    "name": ["firstname", "lastname", "surname", "fullname", "nickname", "givenname"],
+    "time": ["year", "month", "day", "date", "time", "hour"],
+}
+
+MIN_AFFIX_LENGTH = 4
+TFIDF_THRESHOLD = 0.5
+
+
+def tokenize_column_name(name):
+    """Split a column name on punctuation, camelCase and digit boundaries."""
+    name = re.sub(r'([a-z])([A-Z])', r'\1 \2', name)
+    return [t for t in re.split(r'[^a-z]+', name.lower()) if t]
+
+
+def _compact(name):
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def _char_ngrams(text, n=3):
+    text = f" {text} "
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def _tfidf_vectors(documents):
+    """TF-IDF vectors (dicts) over character trigrams, IDF computed within the table."""
+    grams = [Counter(_char_ngrams(doc)) for doc in documents]
+    df = Counter(g for counts in grams for g in counts)
+    n = len(documents)
+    vectors = []
+    for counts in grams:
+        vector = {g: tf * math.log((1 + n) / (1 + df[g])) for g, tf in counts.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        vectors.append({g: v / norm for g, v in vector.items()})
+    return vectors
+
+
+def _cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(g, 0.0) for g, v in a.items())
+
+
+def propose_candidate_groups(table_data):
+    """
+    Propose groups of columns that one natural-language term could refer to.
+
+    Columns are only grouped with columns of the same type. Candidates come from
+    a shared head or tail token (home_score/home_record, start_date/end_date),
+    a shared raw prefix or suffix (playername/playerid, firstname/lastname),
+    a shared semantic family (city/province) and TF-IDF similarity of the
+    names and descriptions.
+
+    Args:
+        table_data: Table metadata with field_list, type_by_field and optionally descriptions
+
+    Returns:
+        dict: candidate name -> sorted list of columns (2 or more), without duplicate sets
+    """
+    columns = table_data["field_list"]
+    type_by_field = table_data.get("type_by_field", {})
+    descriptions = table_data.get("descriptions") or table_data.get("column_description") or {}
+
+    keyed = defaultdict(set)
+    tokens = {c: tokenize_column_name(c) for c in columns}
+    for column in columns:
+        column_type = type_by_field.get(column, "")
+        if len(tokens[column]) > 1:
+            keyed[(column_type, tokens[column][0])].add(column)
+            keyed[(column_type, tokens[column][-1])].add(column)
+        compact = _compact(column)
+        for family, members in SEMANTIC_FAMILIES.items():
+            if compact in members or (tokens[column] and tokens[column][-1] in members):
+                keyed[(column_type, family)].add(column)
+
+    # Shared raw prefixes/suffixes catch names written without separators
+    for i, a in enumerate(columns):
+        for b in columns[i + 1:]:
+            if type_by_field.get(a, "") != type_by_field.get(b, ""):
+                continue
+            ca, cb = _compact(a), _compact(b)
+            prefix = _common_prefix(ca, cb)
+            suffix = _common_prefix(ca[::-1], cb[::-1])[::-1]
+            if len(prefix) >= MIN_AFFIX_LENGTH and prefix != ca and prefix != cb:
+                keyed[(type_by_field.get(a, ""), prefix)].update([a, b])
+            if len(suffix) >= MIN_AFFIX_LENGTH and suffix != ca and suffix != cb:
+                keyed[(type_by_field.get(a, ""), suffix)].update([a, b])
+
+    # TF-IDF similarity of names (and descriptions when available)
+    documents = [" ".join(tokens[c]) + " " + str(descriptions.get(c, "")).lower() for c in columns]
+    vectors = _tfidf_vectors(documents) if len(columns) > 1 else []
+    for i, a in enumerate(columns):
+        for j in range(i + 1, len(columns)):
+            b = columns[j]
+            if type_by_field.get(a, "") != type_by_field.get(b, ""):
+                continue
+            if _cosine(vectors[i], vectors[j]) >= TFIDF_THRESHOLD:
+                keyed[(type_by_field.get(a, ""), f"{a}|{b}")].update([a, b])
+
+    candidates = {}
+    seen = set()
+    for (_, key), group in sorted(keyed.items(), key=lambda item: (-len(item[1]), item[0][1])):
+        group = tuple(sorted(group))
+        if len(group) < 2 or group in seen:
+            continue
+        seen.add(group)
+        # TF-IDF pairs have no shared key; name them after the first column's last token
+        name = key if "|" not in key else (tokens[group[0]] or [group[0]])[-1]
+        while name in candidates:
+            name += "_"
+        candidates[name] = list(group)
+    return candidates
+
+
+def _common_prefix(a, b):
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+
+def group_is_covered(gold_group, candidates):
+    gold = set(gold_group)
+    return any(gold <= set(group) for group in candidates.values())
+
+
+def prefilter_recall(metadata, gold_key="ambiguous_pairs"):
+    """
+    How well the prefilter recalls existing ambiguity groups.
+
+    Args:
+        metadata: Table metadata with gold groups under gold_key
+            (ambiguous_pairs in BIRD_metadata_AMBI.json)
+
+    Returns:
+        dict: group recall (gold group inside one candidate), pair recall
+        (each column pair of a gold group inside one candidate), tables
+        skipped, and candidate columns sent compared with all columns
+    """
+    gold_groups = covered_groups = gold_pairs = covered_pairs = 0
+    tables = tables_without_candidates = missed_tables = 0
+    candidate_columns = all_columns = 0
+    for table_data in metadata.values():
+        tables += 1
+        candidates = propose_candidate_groups(table_data)
+        all_columns += len(table_data["field_list"])
+        candidate_columns += len({c for group in candidates.values() for c in group})
+        gold = table_data.get(gold_key) or table_data.get("ambiguous_columns_groups") or {}
+        if not candidates:
+            tables_without_candidates += 1
+            if gold:
+                missed_tables += 1
+        for group in gold.values():
+            gold_groups += 1
+            covered_groups += group_is_covered(group, candidates)
+            for i, a in enumerate(group):
+                for b in group[i + 1:]:
+                    gold_pairs += 1
+                    covered_pairs += group_is_covered([a, b], candidates)
+    return {
+        "tables": tables,
+        "tables_without_candidates": tables_without_candidates,
+        "tables_without_candidates_but_gold_groups": missed_tables,
+        "group_recall": covered_groups / gold_groups if gold_groups else None,
+        "pair_recall": covered_pairs / gold_pairs if gold_pairs else None,
+        "candidate_column_ratio": candidate_columns / all_columns if all_columns else None,
+    }
+
+
+if __name__ == "__main__":
+    metadata_path = sys.argv[1] if len(sys.argv) > 1 else "BIRD_metadata_AMBI.json"
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    print(json.dumps(prefilter_recall(metadata), indent=2))
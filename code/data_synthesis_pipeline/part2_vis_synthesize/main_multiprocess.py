@@ -18,7 +18,9 @@ import draco
 from asp import solve_chart, convert_format, process_ambiguous_pairs
 from date_column import load_and_parse_csv
 from state import State, VQLState, transform_state_to_chart_config
-from table import TableInfo
+from table import TableInfo, load_column_stats
+from table_store import TableStore
+from table_source import SqliteTableSource
 from utils.print_utils import suppress_stdout
 
 # Define directories
@@ -28,6 +30,12 @@ output_dir = "./vis_output/"
 # Create output directory if it doesn't exist
 os.makedirs(output_dir, exist_ok=True)
 
+# Set to the BIRD train_databases directory to read tables straight from SQLite
+bird_db_dir = None
+
+# Arrow copies of the CSVs, built once in the main process and memory-mapped by workers
+table_store = TableStore()
+
 class Node:
     def __init__(self, state: State, parent: Optional['Node'] = None, action: Optional[int] = None):
         self.state = state
@@ -161,8 +169,12 @@ class RandomSelectTree:
 
 def get_run_number(csv_path):
     """Calculate number of solutions and simulations based on CSV column count."""
-    df = pd.read_csv(csv_path)
-    num_solution = 2 * df.shape[1]
+    column_stats = load_column_stats(csv_path)
+    if column_stats is not None:
+        num_columns = column_stats["num_columns"]
+    else:
+        num_columns = len(pd.read_csv(csv_path, nrows=0).columns)
+    num_solution = 2 * num_columns
     num_simulation = max(10, 25 * num_solution)
     return num_solution, num_simulation
 
@@ -183,7 +195,8 @@ def resolve_pie_y_theta(actions):
 
 def run_tree(csv_path="example.csv"):
     # Initialize
-    table_info = TableInfo(csv_path)
+    table_source = SqliteTableSource.from_csv_name(bird_db_dir, csv_path) if bird_db_dir else None
+    table_info = TableInfo(csv_path, table_store=table_store, table_source=table_source)
     initial_state = VQLState(table_info, [], 0)
     num_solutions, num_simulations = get_run_number(csv_path)
     random_tree = RandomSelectTree(initial_state)
@@ -261,6 +274,12 @@ if __name__ == "__main__":
     max_workers = os.cpu_count()
     with suppress_stdout():
         print(f"Using {max_workers} worker processes")
+
+    # Parse every CSV once; workers attach to the Arrow files by table name
+    if bird_db_dir is None:
+        failed_tables = table_store.build(csv_dir, csv_files, max_workers=max_workers)
+        with suppress_stdout():
+            print(f"Table store ready ({len(failed_tables)} tables fall back to CSV)")
     
     # Process files in parallel using ProcessPoolExecutor
     with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
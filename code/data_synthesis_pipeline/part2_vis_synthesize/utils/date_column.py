@@ -1,7 +1,35 @@
 import pandas as pd
 from datetime import datetime
+import calendar
 import re
 
+# Date patterns accepted by detect_date_columns, combined into one compiled
+# regex so a whole sample is matched in a single vectorized pass.
+# Each named group maps to the strftime format used to parse the column.
+DATE_PATTERN = re.compile(
+    r'^(?:'
+    r'(?P<ymd_dash>\d{4}-\d{1,2}-\d{1,2})'               # YYYY-MM-DD
+    r'|(?P<mdy_slash>\d{1,2}/\d{1,2}/\d{4})'             # MM/DD/YYYY or DD/MM/YYYY
+    r'|(?P<mdy_dash>\d{1,2}-\d{1,2}-\d{4})'              # MM-DD-YYYY
+    r'|(?P<ymd_slash>\d{4}/\d{1,2}/\d{1,2})'             # YYYY/MM/DD
+    r'|(?P<month_name>[A-Za-z]{3,9}\s+\d{1,2},\s+\d{4})'  # Month DD, YYYY
+    r')$'
+)
+
+DATE_FORMATS = {
+    'ymd_dash': '%Y-%m-%d',
+    'mdy_slash': '%m/%d/%Y',
+    'mdy_dash': '%m-%d-%Y',
+    'ymd_slash': '%Y/%m/%d',
+}
+
+FULL_MONTH_NAMES = {name.lower() for name in calendar.month_name if name}
+
+# Column name patterns that suggest dates
+DATE_NAME_PATTERNS = [
+    'date', 'dt', 'day', 'month', 'year', 'time'
+]
+
 def parse_date_columns(df, date_cols=None):
     """
     Parse columns that contain date strings to datetime type
@@ -21,20 +49,22 @@ def parse_date_columns(df, date_cols=None):
     """
     # If date_cols is not provided, try to detect date columns
     if date_cols is None:
-        date_cols = detect_date_columns(df)
+        date_formats = detect_date_formats(df)
+    else:
+        date_formats = {col: infer_date_format(df[col]) for col in date_cols if col in df.columns}
     
     # Try to convert each detected date column
-    for col in date_cols:
+    for col, date_format in date_formats.items():
         if col in df.columns:
             try:
-                # First try pandas to_datetime with error handling
-                df[col] = pd.to_datetime(df[col], errors='coerce')
+                original = df[col]
+                df[col] = to_datetime_with_fallback(original, date_format)
                 
                 # If more than 80% of the values were successfully parsed, keep the conversion
                 if df[col].notna().mean() < 0.8:
                     print(f"Warning: Column '{col}' had too many parsing failures, skipping conversion")
                     # Revert to original data
-                    df[col] = df[col].astype('object')
+                    df[col] = original.astype('object')
                 else:
                     print(f"Successfully converted column '{col}' to datetime")
             except Exception as e:
@@ -42,9 +72,72 @@ def parse_date_columns(df, date_cols=None):
     
     return df
 
-def detect_date_columns(df, sample_size=100):
+def parse_mixed_dates(values):
+    """Parse each value on its own, as pandas did before per-column format inference."""
+    try:
+        return pd.to_datetime(values, format='mixed', errors='coerce')
+    except (TypeError, ValueError):
+        # pandas < 2.0 has no format='mixed' and already parses element by element
+        return pd.to_datetime(values, errors='coerce')
+
+def to_datetime_with_fallback(values, date_format=None):
     """
-    Attempt to detect columns that contain date values
+    Parse a column with its inferred format in one vectorized pass, then
+    parse the values that format missed (a minority format, "Sept", ...)
+    one by one, so no value that used to parse becomes NaT.
+    """
+    if date_format is None:
+        return parse_mixed_dates(values)
+    parsed = pd.to_datetime(values, format=date_format, errors='coerce', cache=True)
+    missed = parsed.isna() & values.notna()
+    if missed.any():
+        parsed[missed] = parse_mixed_dates(values[missed])
+    return parsed
+
+def infer_date_format(values, sample_size=100):
+    """
+    Infer an explicit strftime format from a sample of date strings
+    
+    Parameters:
+    -----------
+    values : pandas.Series
+        Column values
+    sample_size : int, optional
+        Number of non-null values to inspect
+        
+    Returns:
+    --------
+    str or None
+        Format matched by most of the sample, or None if no known format
+        matches, in which case pandas falls back to its own inference
+    """
+    sample = values.dropna().head(sample_size)
+    if sample.empty or not (pd.api.types.is_object_dtype(sample) or pd.api.types.is_string_dtype(sample)):
+        return None
+    matches = sample.astype(str).str.strip().str.extract(DATE_PATTERN)
+    counts = matches.notna().sum()
+    if counts.max() == 0:
+        return None
+    group = counts.idxmax()
+    
+    if group == 'month_name':
+        months = matches[group].dropna().str.split().str[0]
+        if (months.str.len() == 3).all():
+            return '%b %d, %Y'
+        if months.str.lower().isin(FULL_MONTH_NAMES).all():
+            return '%B %d, %Y'
+        return None
+    if group == 'mdy_slash':
+        # MM/DD/YYYY and DD/MM/YYYY share a pattern; a first field above 12
+        # can only be a day
+        first = matches[group].dropna().str.split('/').str[0].astype(int)
+        if (first > 12).any():
+            return '%d/%m/%Y'
+    return DATE_FORMATS[group]
+
+def detect_date_formats(df, sample_size=100):
+    """
+    Detect date columns and the format each one should be parsed with
     
     Parameters:
     -----------
@@ -55,31 +148,11 @@ def detect_date_columns(df, sample_size=100):
         
     Returns:
     --------
-    list
-        List of column names that appear to contain dates
+    dict
+        Column name -> strftime format (None if only the name suggests a date
+        and no format could be inferred)
     """
-    date_cols = []
-    
-    # Common date patterns to check
-    date_patterns = [
-        # YYYY-MM-DD
-        r'^\d{4}-\d{1,2}-\d{1,2}$',
-        # MM/DD/YYYY
-        r'^\d{1,2}/\d{1,2}/\d{4}$',
-        # DD/MM/YYYY
-        r'^\d{1,2}/\d{1,2}/\d{4}$',
-        # MM-DD-YYYY
-        r'^\d{1,2}-\d{1,2}-\d{4}$',
-        # YYYY/MM/DD
-        r'^\d{4}/\d{1,2}/\d{1,2}$',
-        # Month DD, YYYY
-        r'^[A-Za-z]{3,9}\s+\d{1,2},\s+\d{4}$',
-    ]
-    
-    # Column name patterns that suggest dates
-    date_name_patterns = [
-        'date', 'dt', 'day', 'month', 'year', 'time'
-    ]
+    date_formats = {}
     
     # Get a sample of the DataFrame
     sample_df = df.head(min(sample_size, len(df)))
@@ -88,8 +161,8 @@ def detect_date_columns(df, sample_size=100):
     for col in df.columns:
         # Check if column name suggests a date
         col_lower = col.lower()
-        if any(pattern in col_lower for pattern in date_name_patterns):
-            date_cols.append(col)
+        if any(pattern in col_lower for pattern in DATE_NAME_PATTERNS):
+            date_formats[col] = infer_date_format(sample_df[col], sample_size)
             continue
         
         # Skip numeric columns
@@ -99,21 +172,34 @@ def detect_date_columns(df, sample_size=100):
         # Check if values match date patterns
         if df[col].dtype == 'object':
             # Convert to string to ensure we can check patterns
-            sample_values = sample_df[col].astype(str)
+            sample_values = sample_df[col].astype(str).str.strip()
             
             # Calculate what percentage of values match date patterns
-            match_count = 0
-            for value in sample_values:
-                if any(re.match(pattern, value.strip()) for pattern in date_patterns):
-                    match_count += 1
-            
-            match_percentage = match_count / len(sample_values) if len(sample_values) > 0 else 0
+            match_percentage = sample_values.str.match(DATE_PATTERN).mean() if len(sample_values) > 0 else 0
             
             # If more than 70% of values match date patterns, consider it a date column
             if match_percentage > 0.7:
-                date_cols.append(col)
+                date_formats[col] = infer_date_format(sample_df[col], sample_size)
+    
+    return date_formats
+
+def detect_date_columns(df, sample_size=100):
+    """
+    Attempt to detect columns that contain date values
     
-    return date_cols
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Input DataFrame
+    sample_size : int, optional
+        Number of rows to sample for date detection
+        
+    Returns:
+    --------
+    list
+        List of column names that appear to contain dates
+    """
+    return list(detect_date_formats(df, sample_size))
 
 def load_and_parse_csv(file_path, date_cols=None):
     """
@@ -4,11 +4,18 @@ import random
 import pandas as pd
 import numpy as np
 from tqdm import tqdm  # Import tqdm for progress tracking
+from table_store import TableStore
+from table import load_column_stats
 
 # Set directories
 csv_dir = "../part1.nvbench_tables/database_csv"
+# Column statistics of these tables (3.generate_metadata.py run over csv_dir), not the BIRD ones
+column_stats_dir = "../part1.nvbench_tables/column_stats"
 output_dir = "./vis_output_multiprocess/"
 
+# Arrow copies of the CSVs built by main_multiprocess.py (table_store.default_table_store_dir)
+table_store = TableStore()
+
 # save by csv_filename
 save_dir = "./nl_generation_input_multiprocess/"
 
@@ -35,8 +42,31 @@ def convert_int64_to_int(data):
         return int(data)
     return data
 
+def get_info_by_field_from_stats(column_stats):
+    """Build info_by_field from the column statistics sidecar instead of the CSV.
+
+    distinct_sample is sorted and keeps the true min and max, so it can stand
+    in for the full list of unique values when sampling filter values.
+    """
+    info_by_field = {}
+    for column, stats in column_stats["columns"].items():
+        info_by_field[column] = {
+            "unique_values": stats["distinct_sample"],
+            "min": stats["min"],
+            "max": stats["max"]
+        }
+    return info_by_field
+
 def get_info_by_field(csv_path):
-    df = pd.read_csv(csv_path)
+    # column statistics sidecar written by part1 (3.generate_metadata.py), used only if it matches the CSV header
+    column_stats = load_column_stats(csv_path, column_stats_dir, columns=pd.read_csv(csv_path, nrows=0).columns)
+    if column_stats is not None:
+        return get_info_by_field_from_stats(column_stats)
+
+    if table_store.has(csv_path):
+        df = table_store.get_dataframe(csv_path)
+    else:
+        df = pd.read_csv(csv_path)
     info_by_field = {}
 
     for column in df.columns:
@@ -3,16 +3,41 @@ from datetime import datetime
 import json
 import os
 import draco
+from table_source import apply_field_types
 
 T = "temporal"
 Q = "quantitative"
 C = "category"
 
 default_ambi_metadata_path = "../part1.database_tables/BIRD_metadata_AMBI.json"
+default_column_stats_dir = "../part1.database_tables/column_stats"
+
+def load_column_stats(csv_path, column_stats_dir=default_column_stats_dir, columns=None):
+    """
+    Load the per-table column statistics written by part1, or None if missing.
+
+    Sidecars are keyed by CSV basename only, so when columns (the CSV header)
+    is given, a sidecar whose column names or num_columns differ is treated as
+    belonging to another table and None is returned.
+    """
+    stats_path = os.path.join(column_stats_dir, os.path.basename(csv_path) + ".json")
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path, 'r') as f:
+        column_stats = json.load(f)
+    if columns is not None:
+        columns = list(columns)
+        if list(column_stats.get("columns", {})) != columns or column_stats.get("num_columns") != len(columns):
+            return None
+    return column_stats
 
 class TableInfo(object):
-    def __init__(self, csv_path: str = None, ambi_metadata_path=default_ambi_metadata_path):
+    def __init__(self, csv_path: str = None, ambi_metadata_path=default_ambi_metadata_path, table_store=None, table_source=None):
         self.csv_path = csv_path
+        # Optional TableStore; when it holds this table the CSV is not re-parsed
+        self.table_store = table_store
+        # Optional TableSource (e.g. SqliteTableSource); takes precedence over the CSV and store
+        self.table_source = table_source
         with open(ambi_metadata_path, 'r') as f:
             csv_metadata = json.load(f)
         # Load the CSV metadata for the given CSV path
@@ -29,21 +54,25 @@ class TableInfo(object):
         # self.set_data_schema()
 
     def get_data_schema(self, more_ignore_column_list=[]):
+        if self.table_source is not None:
+            # Only the columns Draco will see are read, and the statistics are
+            # computed by the source (SQL aggregates for SqliteTableSource)
+            columns = [
+                column for column in self.field_list
+                if column not in self.ignore_column_list and column not in more_ignore_column_list
+            ]
+            return self.table_source.get_data_schema(columns, self.type_by_field)
+
         # Load DataFrame from CSV path
         # print(self.csv_path)
-        df = pd.read_csv(self.csv_path)
+        if self.table_store is not None and self.table_store.has(self.csv_path):
+            df = self.table_store.get_dataframe(self.csv_path)
+        else:
+            df = pd.read_csv(self.csv_path)
         
         # set column type
         # flag = False
-        for column in self.field_list:
-            if self.type_by_field[column] == T: 
-                df[column] = pd.to_datetime(df[column], errors='coerce')  # set column type to datetime 64
-            elif self.type_by_field[column] == C: 
-                df[column] = df[column].astype(str)  # set column type to string
-            # if column in more_ignore_column_list or column in self.ignore_column_list:
-            #     print(more_ignore_column_list)
-            #     print(self.ignore_column_list)
-            #     flag = True
+        df = apply_field_types(df, self.type_by_field)
 
         df.drop(columns=self.ignore_column_list, inplace=True, errors='ignore')  # Remove columns in ignore_column_list
 
@@ -0,0 +1,223 @@
+import os
+import math
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+import draco
+
+T = "temporal"
+Q = "quantitative"
+C = "category"
+
+# One read-only connection per (worker process, database file)
+_connection_pool = {}
+
+
+def get_read_only_connection(sqlite_path):
+    """Return this process's pooled read-only connection to a SQLite file."""
+    key = (os.getpid(), str(sqlite_path))
+    if key not in _connection_pool:
+        uri = f"{Path(sqlite_path).resolve().as_uri()}?mode=ro&immutable=1"
+        _connection_pool[key] = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    return _connection_pool[key]
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def normalize_column_name(name):
+    """Column name cleaning applied by part1 2.table_filter.py."""
+    return name.lower().replace(" ", "_").replace("-", "_")
+
+
+def apply_field_types(df, type_by_field):
+    """Set column dtypes from the metadata types before building a draco schema."""
+    for column in df.columns:
+        if type_by_field.get(column) == T:
+            df[column] = pd.to_datetime(df[column], errors='coerce')  # set column type to datetime 64
+        elif type_by_field.get(column) == C:
+            df[column] = df[column].astype(str)  # set column type to string
+    return df
+
+
+def coerce_filtered_dates(df):
+    """
+    Date coercion part1 2.table_filter.py applies before writing the filtered
+    CSVs: columns named like a date whose values are strings (or look like
+    YYYY-MM-DD) are parsed with format='%Y-%m-%d', and other values become NaT.
+    """
+    keywords = ["date", "year", "month"]
+    for name in df.columns:
+        if any(keyword in name.lower() for keyword in keywords):
+            sample = df[name].dropna().head(5)
+            if sample.empty:
+                continue
+            if df[name].dtype == "object" or sample.astype(str).str.match(r'\d{4}-\d{2}-\d{2}').all():
+                df[name] = pd.to_datetime(df[name], format='%Y-%m-%d', errors='coerce')
+    return df
+
+
+def entropy_from_counts(counts):
+    """Entropy as computed by draco.schema_from_dataframe, from value counts."""
+    total = sum(counts)
+    if total == 0:
+        return 0
+    entropy = -sum((c / total) * math.log(c / total) for c in counts)
+    return round(entropy * 1000)
+
+
+class TableSource(object):
+    """Where TableInfo gets the rows of a table from."""
+    def column_names(self):
+        raise NotImplementedError
+
+    def get_dataframe(self, columns=None):
+        raise NotImplementedError
+
+    def get_data_schema(self, columns, type_by_field):
+        """Draco data schema of the given columns, in the given order."""
+        df = apply_field_types(self.get_dataframe(columns), type_by_field)
+        return draco.schema_from_dataframe(df)
+
+
+class CsvTableSource(TableSource):
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+
+    def column_names(self):
+        return list(pd.read_csv(self.csv_path, nrows=0).columns)
+
+    def get_dataframe(self, columns=None):
+        return pd.read_csv(self.csv_path, usecols=columns)
+
+
+class SqliteTableSource(TableSource):
+    """
+    Reads a table straight from its original BIRD SQLite file.
+
+    Columns are exposed under the cleaned names used by the filtered CSVs, only
+    the requested columns are selected, and the statistics Draco needs are
+    computed with SQL aggregates so the rows never reach pandas. Fields are
+    cached per column, so repeated get_data_schema calls reuse them.
+    """
+    def __init__(self, sqlite_path, table_name):
+        self.sqlite_path = sqlite_path
+        self.table_name = table_name
+        self._source_columns = None
+        self._row_count = None
+        self._fields = {}
+
+    @classmethod
+    def from_csv_name(cls, db_root, csv_name):
+        """Locate the SQLite table for a "database@table.csv" file name."""
+        db_name, table_name = os.path.splitext(os.path.basename(csv_name))[0].split("@", 1)
+        return cls(os.path.join(db_root, db_name, f"{db_name}.sqlite"), table_name)
+
+    @property
+    def connection(self):
+        return get_read_only_connection(self.sqlite_path)
+
+    @property
+    def source_columns(self):
+        """Cleaned column name -> column name in the SQLite table."""
+        if self._source_columns is None:
+            cursor = self.connection.execute(f"PRAGMA table_info({quote_identifier(self.table_name)});")
+            self._source_columns = {normalize_column_name(col[1]): col[1] for col in cursor.fetchall()}
+        return self._source_columns
+
+    def column_names(self):
+        return list(self.source_columns)
+
+    def _select_list(self, columns):
+        return ", ".join(
+            f"{quote_identifier(self.source_columns[c])} AS {quote_identifier(c)}" for c in columns
+        )
+
+    def get_dataframe(self, columns=None):
+        if columns is None:
+            columns = self.column_names()
+        query = f"SELECT {self._select_list(columns)} FROM {quote_identifier(self.table_name)};"
+        return coerce_filtered_dates(pd.read_sql_query(query, self.connection))
+
+    def count_rows(self):
+        if self._row_count is None:
+            query = f"SELECT COUNT(*) FROM {quote_identifier(self.table_name)};"
+            self._row_count = self.connection.execute(query).fetchone()[0]
+        return self._row_count
+
+    def _value_counts(self, expression, where=None):
+        query = (
+            f"SELECT COUNT(*) FROM {quote_identifier(self.table_name)} "
+            f"WHERE {where or f'{expression} IS NOT NULL'} GROUP BY {expression};"
+        )
+        return [row[0] for row in self.connection.execute(query).fetchall()]
+
+    def _number_field(self, column):
+        source = quote_identifier(self.source_columns[column])
+        # BIRD declares many numeric columns TEXT, where MIN/MAX would compare
+        # strings ('10' < '9'); aggregate the values as REAL, keeping only
+        # values that are numbers or numeric text, as pandas reads them from the CSV
+        value = f"CAST({source} AS REAL)"
+        numeric = (
+            f"(typeof({source}) IN ('integer', 'real') OR (typeof({source}) = 'text' "
+            f"AND trim({source}) GLOB '*[0-9]*' AND NOT trim({source}) GLOB '*[^0-9.eE+-]*'))"
+        )
+        table = quote_identifier(self.table_name)
+        query = f"SELECT MIN({value}), MAX({value}), AVG({value}), COUNT(*) FROM {table} WHERE {numeric};"
+        min_value, max_value, mean, count = self.connection.execute(query).fetchone()
+        if count == 0:
+            return None
+        # Second pass around the mean: the sum-of-squares shortcut cancels catastrophically
+        query = f"SELECT SUM(({value} - ?) * ({value} - ?)) FROM {table} WHERE {numeric};"
+        squared_deviations = self.connection.execute(query, (mean, mean)).fetchone()[0]
+        # Sample standard deviation, as pandas computes it
+        std = math.sqrt(squared_deviations / (count - 1)) if count > 1 else 0
+        counts = self._value_counts(value, where=numeric)
+        # min/max are floats as on the CSV path; draco.schema_from_dataframe truncates them with int()
+        return {
+            "name": column,
+            "type": "number",
+            "unique": len(counts),
+            "entropy": entropy_from_counts(counts),
+            "min": int(min_value),
+            "max": int(max_value),
+            "std": int(std),
+        }
+
+    def _string_field(self, column):
+        # Category columns are cast with astype(str) on the pandas path, which
+        # turns missing values into the string "nan"
+        expression = f"COALESCE(CAST({quote_identifier(self.source_columns[column])} AS TEXT), 'nan')"
+        counts = self._value_counts(expression)
+        return {
+            "name": column,
+            "type": "string",
+            "unique": len(counts),
+            "entropy": entropy_from_counts(counts),
+            "freq": max(counts) if counts else 0,
+        }
+
+    def _fields_of(self, column, field_type):
+        """Draco fields of one column (usually one, none for an empty temporal column)."""
+        key = (column, field_type)
+        if key not in self._fields:
+            field = None
+            if field_type == Q:
+                field = self._number_field(column)
+            elif field_type == C:
+                field = self._string_field(column)
+            if field is not None:
+                self._fields[key] = [field]
+            else:
+                # Temporal columns depend on pandas date coercion, so load just this column
+                df = apply_field_types(self.get_dataframe([column]), {column: field_type})
+                self._fields[key] = draco.schema_from_dataframe(df)["field"]
+        return self._fields[key]
+
+    def get_data_schema(self, columns, type_by_field):
+        fields = []
+        for column in columns:
+            fields.extend(self._fields_of(column, type_by_field.get(column)))
+        return {"number_rows": self.count_rows(), "field": fields}
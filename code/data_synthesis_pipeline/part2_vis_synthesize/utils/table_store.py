@@ -0,0 +1,164 @@
+import os
+import concurrent.futures
+
+import pandas as pd
+import pyarrow as pa
+
+default_table_store_dir = "../part1.database_tables/table_store"
+
+# Schema metadata keys recording the CSV an Arrow file was built from
+SOURCE_MTIME_KEY = b"nvbench.source_mtime_ns"
+SOURCE_SIZE_KEY = b"nvbench.source_size"
+
+
+def source_signature(csv_path):
+    """(mtime_ns, size) of a CSV, as recorded in the Arrow file built from it."""
+    stat = os.stat(csv_path)
+    return str(stat.st_mtime_ns).encode(), str(stat.st_size).encode()
+
+
+def build_table_file(csv_path, arrow_path):
+    """
+    Parse a CSV once and write it as an Arrow IPC file
+
+    Parameters:
+    -----------
+    csv_path : str
+        Source CSV file
+    arrow_path : str
+        Destination .arrow file
+
+    Returns:
+    --------
+    str
+        arrow_path
+    """
+    # Taken before reading, so a CSV rewritten during the build is rebuilt next time
+    mtime_ns, size = source_signature(csv_path)
+    df = pd.read_csv(csv_path)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Object columns that mix numbers and strings cannot be typed by Arrow;
+        # store them as strings and keep the missing values missing
+        for column in df.columns:
+            if df[column].dtype == "object":
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata.update({SOURCE_MTIME_KEY: mtime_ns, SOURCE_SIZE_KEY: size})
+    table = table.replace_schema_metadata(metadata)
+
+    # Write to a temporary file first so a crashed build never leaves a
+    # truncated file that workers would attach to
+    tmp_path = arrow_path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, arrow_path)
+    return arrow_path
+
+
+class TableStore(object):
+    """
+    Tables parsed once into memory-mapped Arrow IPC files.
+
+    The parent process calls build() before starting a worker pool; workers
+    then attach to a table by name. Mapping the file is zero-copy, so the
+    Arrow tables of all workers share one page-cache copy of the column
+    buffers and no worker re-parses the CSV. get_dataframe converts to pandas,
+    which copies the projected columns into the calling process.
+
+    Each file records the mtime and size of its CSV; a table whose CSV has
+    changed since is rebuilt by build() and not reported by has().
+    """
+    def __init__(self, store_dir=default_table_store_dir):
+        self.store_dir = store_dir
+        self._tables = {}
+
+    def path(self, table_name):
+        return os.path.join(self.store_dir, os.path.basename(table_name) + ".arrow")
+
+    def has(self, table_name):
+        """
+        Whether the store holds the table. When table_name is the path of the
+        CSV, a copy built from an older version of that file does not count.
+        """
+        if not os.path.exists(self.path(table_name)):
+            return False
+        if os.path.isfile(table_name):
+            return self.is_fresh(table_name, table_name)
+        return True
+
+    def is_fresh(self, table_name, csv_path):
+        """Whether the Arrow file of table_name was built from the current csv_path."""
+        try:
+            with pa.memory_map(self.path(table_name), "r") as source:
+                metadata = pa.ipc.open_file(source).schema.metadata or {}
+        except (OSError, pa.ArrowInvalid):
+            return False
+        mtime_ns, size = source_signature(csv_path)
+        return metadata.get(SOURCE_MTIME_KEY) == mtime_ns and metadata.get(SOURCE_SIZE_KEY) == size
+
+    def build(self, csv_dir, csv_files=None, max_workers=None):
+        """
+        Convert CSV files to Arrow IPC files, skipping tables already built
+        from the current version of their CSV
+
+        Parameters:
+        -----------
+        csv_dir : str
+            Directory containing the CSV files
+        csv_files : list, optional
+            File names to convert. Defaults to every .csv in csv_dir
+        max_workers : int, optional
+            Number of worker processes
+
+        Returns:
+        --------
+        list
+            Names of the tables that failed to convert
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        if csv_files is None:
+            csv_files = [f for f in os.listdir(csv_dir) if f.endswith('.csv')]
+        pending = [
+            f for f in csv_files
+            if not (os.path.exists(self.path(f)) and self.is_fresh(f, os.path.join(csv_dir, f)))
+        ]
+        for f in pending:
+            # A stale mapping cached in this process must not outlive the rebuild
+            self._tables.pop(os.path.basename(f), None)
+
+        failed = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            future_to_file = {
+                executor.submit(build_table_file, os.path.join(csv_dir, f), self.path(f)): f
+                for f in pending
+            }
+            for future in concurrent.futures.as_completed(future_to_file):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed to build table store entry for {future_to_file[future]}: {e}")
+                    failed.append(future_to_file[future])
+        return failed
+
+    def get_table(self, table_name):
+        """Attach to a table by name; the mapping is cached for this process."""
+        table_name = os.path.basename(table_name)
+        if table_name not in self._tables:
+            source = pa.memory_map(self.path(table_name), "r")
+            self._tables[table_name] = pa.ipc.open_file(source).read_all()
+        return self._tables[table_name]
+
+    def get_dataframe(self, table_name, columns=None):
+        """
+        Return a pandas DataFrame for a table, optionally projected to columns.
+        The conversion copies the selected columns out of the shared mapping,
+        so project to the columns needed.
+        """
+        table = self.get_table(table_name)
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.column_names])
+        return table.to_pandas()
@@ -0,0 +1,261 @@
+# Async GPT calling: many requests in flight from one event loop, instead of
+# one blocking call per worker process.
+import time
+import random
+import asyncio
+import argparse
+
+import aiohttp
+import openai
+import llm_gpt_call  # shares openai.api_base / openai.api_key with the sync calls
+from llm_gpt_call import estimate_tokens
+from llm_cache import LLMCache, get_default_cache
+from llm_telemetry import LLMTelemetry, get_default_telemetry
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled continuously at per_minute / 60 units per second.
+
+    Waiters are served in order. adjust() may push the balance below zero when
+    a request turns out to cost more than was reserved, which delays the next
+    waiters instead of overrunning the budget. The lock is recreated for each
+    event loop, so one bucket can serve successive asyncio.run() calls.
+    """
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reset_lock(self):
+        """Bind a fresh lock to the running event loop."""
+        self._lock, self._loop = asyncio.Lock(), asyncio.get_running_loop()
+
+    async def acquire(self, amount=1):
+        """
+        Wait until amount units are available and take them.
+
+        Returns:
+            The amount taken: requests larger than the capacity are clipped to
+            it, and that is what a refund through adjust() must give back
+        """
+        amount = min(amount, self.capacity)
+        if self._lock is None or self._loop is not asyncio.get_running_loop():
+            self.reset_lock()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return amount
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+
+class AsyncLLMClient(object):
+    """
+    Chat completion client that keeps up to max_in_flight requests open and
+    stays within requests/min and tokens/min budgets.
+
+    Args:
+        model: Model name, e.g. "gpt-3.5-turbo" or "gpt-4"
+        max_in_flight: Maximum concurrent requests
+        requests_per_minute: Request budget
+        tokens_per_minute: Prompt + completion token budget
+        max_retries: Attempts after the first one for retryable errors
+        base_delay: Initial backoff in seconds; doubles per attempt, with full jitter
+        max_delay: Backoff cap in seconds
+        expected_completion_tokens: Completion tokens reserved per request before
+            the real usage is known
+        request_timeout: Per-request timeout in seconds
+        cache: LLMCache shared with the sync calls; defaults to the process-wide cache
+        telemetry: LLMTelemetry log; defaults to the process-wide log
+    """
+    def __init__(self, model="gpt-3.5-turbo", max_in_flight=16, requests_per_minute=3500,
+                 tokens_per_minute=90000, max_retries=6, base_delay=1.0, max_delay=60.0,
+                 expected_completion_tokens=256, request_timeout=120, cache=None, telemetry=None):
+        self.model = model
+        self.cache = cache if cache is not None else get_default_cache()
+        self.telemetry = telemetry if telemetry is not None else get_default_telemetry()
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.expected_completion_tokens = expected_completion_tokens
+        self.request_timeout = request_timeout
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._semaphore = None
+        self._loop = None
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    async def chat(self, user_content, sys_content="", **params):
+        """
+        Async equivalent of call_gpt_3_5 / call_gpt_4.
+
+        Returns:
+            tuple: (result, token_usage)
+        """
+        if self._semaphore is None or self._loop is not asyncio.get_running_loop():
+            self._bind_loop()
+        start = time.perf_counter()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(self.model, sys_content, user_content, params)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self._record(start, cached[1], cache_hit=True)
+                return cached
+        reserved = estimate_tokens(sys_content) + estimate_tokens(user_content) + self.expected_completion_tokens
+
+        wait = 0.0
+        for attempt in range(self.max_retries + 1):
+            wait_start = time.perf_counter()
+            await self.request_bucket.acquire(1)
+            taken = await self.token_bucket.acquire(reserved)
+            try:
+                async with self._semaphore:
+                    wait += time.perf_counter() - wait_start
+                    self.stats["requests"] += 1
+                    response = await openai.ChatCompletion.acreate(
+                        model=self.model,
+                        messages=[
+                            {"role": "system", "content": sys_content},
+                            {"role": "user", "content": user_content}
+                        ],
+                        request_timeout=self.request_timeout,
+                        **params
+                    )
+            except RETRYABLE_ERRORS as e:
+                # The reservation was not spent by a completed request
+                self.token_bucket.adjust(-taken)
+                if isinstance(e, openai.error.RateLimitError):
+                    self.stats["rate_limited"] += 1
+                if attempt == self.max_retries:
+                    self.stats["failed"] += 1
+                    self._record(start, retries=attempt, wait=wait, error=type(e).__name__)
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt, e))
+                continue
+            except Exception as e:
+                # Not worth retrying (e.g. an APIError 500 or a bad request)
+                self.token_bucket.adjust(-taken)
+                self.stats["failed"] += 1
+                self._record(start, retries=attempt, wait=wait, error=type(e).__name__)
+                raise
+
+            token_usage = response.usage
+            # Charge the difference between the real usage and the reservation
+            self.token_bucket.adjust(token_usage["total_tokens"] - taken)
+            result = response.choices[0].message.content
+            if cache_key is not None:
+                self.cache.put(cache_key, self.model, result, token_usage)
+            self._record(start, token_usage, retries=attempt, wait=wait)
+            return result, token_usage
+
+    def forget(self, user_content, sys_content="", **params):
+        """Drop the cached response to a prompt whose output could not be parsed."""
+        if self.cache is not None:
+            self.cache.delete(self.cache.key(self.model, sys_content, user_content, params))
+
+    def _record(self, start, token_usage=None, **kwargs):
+        if self.telemetry is not None:
+            self.telemetry.record(self.model, time.perf_counter() - start, token_usage, **kwargs)
+
+    def _bind_loop(self):
+        """asyncio primitives belong to one event loop: recreate them for the running one."""
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._loop = asyncio.get_running_loop()
+        self.request_bucket.reset_lock()
+        self.token_bucket.reset_lock()
+
+    async def __aenter__(self):
+        """Share one HTTP session (connection pool) across all requests made inside the block."""
+        self._bind_loop()
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_in_flight))
+        self._session_token = openai.aiosession.set(self._session)
+        return self
+
+    async def __aexit__(self, *exc):
+        openai.aiosession.reset(self._session_token)
+        await self._session.close()
+
+    async def gather(self, requests, return_exceptions=True):
+        """
+        Run (user_content, sys_content) pairs concurrently over one HTTP session.
+
+        Returns:
+            list: (result, token_usage) per request in input order, or the
+            exception raised for it when return_exceptions is True
+        """
+        async with self:
+            return await asyncio.gather(
+                *[self.chat(user_content, sys_content) for user_content, sys_content in requests],
+                return_exceptions=return_exceptions
+            )
+
+    def run(self, requests, return_exceptions=True):
+        """Blocking wrapper around gather() for use from synchronous scripts."""
+        return asyncio.run(self.gather(requests, return_exceptions))
+
+
+def benchmark(num_requests=200, max_in_flight=32, latency=0.1, rate_limit_prob=0.05):
+    """Throughput of AsyncLLMClient against the local stub server."""
+    from llm_stub_server import StubLLMServer
+
+    with StubLLMServer(latency=latency, rate_limit_prob=rate_limit_prob) as server:
+        openai.api_base = server.api_base
+        openai.api_key = "stub"
+        client = AsyncLLMClient(model="stub", max_in_flight=max_in_flight, base_delay=0.05, max_delay=1.0,
+                                cache=LLMCache(":memory:"), telemetry=LLMTelemetry(":memory:"))
+        requests = [(f"Action List: ['mark bar', 'column c{i}']", "You are an intelligent assistant.")
+                    for i in range(num_requests)]
+        start = time.perf_counter()
+        results = client.run(requests)
+        elapsed = time.perf_counter() - start
+
+    errors = sum(isinstance(r, Exception) for r in results)
+    print(f"{num_requests} requests, {max_in_flight} in flight: {elapsed:.2f}s "
+          f"({num_requests / elapsed:.1f} req/s), errors={errors}, stats={client.stats}")
+    print(client.telemetry.stage_totals())
+    return client.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark AsyncLLMClient against the local stub server")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--rate_limit_prob", type=float, default=0.05)
+    args = parser.parse_args()
+    benchmark(args.requests, args.concurrency, args.latency, args.rate_limit_prob)
@@ -0,0 +1,137 @@
+# Content-addressed cache of LLM responses, shared by every pipeline stage.
+# A rerun after a crash or a prompt change in one stage only pays for the
+# prompts that actually changed.
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+from llm_telemetry import get_default_telemetry, reset_attempts, get_attempts
+
+default_cache_path = os.getenv("LLM_CACHE_PATH", "./llm_cache.sqlite")
+# Set LLM_CACHE=0 to disable the cache, LLM_CACHE_REFRESH=1 to ignore stored
+# responses (new responses are still written)
+CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+CACHE_REFRESH = os.getenv("LLM_CACHE_REFRESH", "0") == "1"
+
+
+class LLMCache(object):
+    """
+    SQLite-backed map from hash(model, system prompt, user prompt, params) to
+    (response, token_usage).
+
+    The database runs in WAL mode with a busy timeout, so the worker processes
+    of a ProcessPoolExecutor can read and write it concurrently. Each process
+    opens its own connection on first use.
+    """
+    def __init__(self, path=default_cache_path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, token_usage TEXT, created REAL);"
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def key(model, sys_content, user_content, params=None):
+        payload = json.dumps([model, sys_content, user_content, params or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return (response, token_usage) or None."""
+        if CACHE_REFRESH:
+            self.misses += 1
+            return None
+        row = self.connection.execute(
+            "SELECT response, token_usage FROM llm_cache WHERE key = ?;", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], json.loads(row[1])
+
+    def put(self, key, model, response, token_usage):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, model, response, token_usage, created) VALUES (?, ?, ?, ?, ?);",
+            (key, model, response, json.dumps(dict(token_usage) if token_usage else {}), time.time())
+        )
+
+    def delete(self, key):
+        """Drop one entry, e.g. a response that could not be parsed."""
+        self.connection.execute("DELETE FROM llm_cache WHERE key = ?;", (key,))
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """Process-wide cache, or None when disabled with LLM_CACHE=0."""
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    if _default_cache is None:
+        _default_cache = LLMCache()
+    return _default_cache
+
+
+def forget_response(model, user_content, sys_content="", **params):
+    """
+    Drop the cached response to a prompt, e.g. one the caller could not parse,
+    so the next run asks the model again instead of replaying the bad output.
+    """
+    cache = get_default_cache()
+    if cache is not None:
+        cache.delete(cache.key(model, sys_content, user_content, params))
+
+
+def cached_llm_call(model, **params):
+    """
+    Decorator for call_gpt_* style functions taking (user_content, sys_content)
+    and returning (result, token_usage). Place it above @retry so cache hits
+    skip the retry machinery as well as the request. Every call, hit or miss,
+    is recorded in the telemetry log; retries are counted when the function
+    carries llm_telemetry.count_attempts below @retry.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(user_content, sys_content="", *args, **kwargs):
+            cache = get_default_cache()
+            telemetry = get_default_telemetry()
+            start = time.perf_counter()
+            key = None
+            if cache is not None:
+                key = cache.key(model, sys_content, user_content, params)
+                cached = cache.get(key)
+                if cached is not None:
+                    if telemetry is not None:
+                        telemetry.record(model, time.perf_counter() - start, cached[1], cache_hit=True)
+                    return cached
+            reset_attempts()
+            try:
+                result, token_usage = fn(user_content, sys_content, *args, **kwargs)
+            except Exception as e:
+                if telemetry is not None:
+                    telemetry.record(model, time.perf_counter() - start, retries=max(get_attempts() - 1, 0),
+                                     error=type(e).__name__)
+                raise
+            if telemetry is not None:
+                telemetry.record(model, time.perf_counter() - start, token_usage, retries=max(get_attempts() - 1, 0))
+            if key is not None:
+                cache.put(key, model, result, token_usage)
+            return result, token_usage
+        return wrapper
+    return decorator
@@ -3,11 +3,19 @@ import os
 import json
 import openai
 from retrying import retry
+from llm_cache import cached_llm_call
+from llm_telemetry import count_attempts
 
 openai.api_base = ''
 openai.api_key = ""
 
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token) used for budgeting."""
+    return len(text) // 4 + 1
+
+@cached_llm_call("gpt-3.5-turbo")
 @retry(stop_max_attempt_number=5, wait_fixed=2000)  # 重试3次，每次间隔2秒
+@count_attempts
 def call_gpt_3_5(user_content, sys_content):
     print("call gpt 3.5.", end=" ")
     response = openai.ChatCompletion.create(
@@ -21,7 +29,9 @@ def call_gpt_3_5(user_content, sys_content):
     token_usage = response.usage
     return result, token_usage
 
+@cached_llm_call("gpt-4")
 @retry(stop_max_attempt_number=3, wait_fixed=2000)  # 重试3次，每次间隔2秒
+@count_attempts
 def call_gpt_4(user_content, sys_content=""):
     print("call gpt 4.",end=" ")
     response = openai.ChatCompletion.create(
@@ -37,6 +47,7 @@ def call_gpt_4(user_content, sys_content=""):
     return result, token_usage
 
 
+@cached_llm_call("gpt-4")
 def call_gpt_4_1106(user_content, sys_content):
     response = openai.ChatCompletion.create(
         model="gpt-4",
@@ -0,0 +1,151 @@
+# Structured-output extraction shared by every stage that asks an LLM for JSON.
+# Finds the JSON object in a response wrapped in prose or code fences, and
+# repairs the usual near-misses (trailing commas, single quotes, Python
+# literals, truncated output) instead of paying for a re-request.
+import ast
+import json
+
+CLOSER = {"{": "}", "[": "]"}
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def scan_balanced(text, openers="{"):
+    """
+    Single pass over text yielding the top-level bracketed blocks.
+
+    Brackets inside string literals (single or double quoted) are ignored.
+
+    Args:
+        text: Text to scan
+        openers: Characters that can open a block, "{" and/or "["
+
+    Yields:
+        tuple: (begin, end, closing) - text[begin:end] is the block; closing is
+        "" for a complete block, or the quote/brackets needed to close a block
+        that is cut off at the end of the text
+    """
+    stack = []
+    quote = None
+    escape = False
+    begin = None
+    for i, ch in enumerate(text):
+        if not stack:
+            if ch in openers:
+                stack.append(CLOSER[ch])
+                begin = i
+            continue
+        if quote:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == quote:
+                quote = None
+        elif ch in ('"', "'"):
+            quote = ch
+        elif ch in CLOSER:
+            stack.append(CLOSER[ch])
+        elif ch in "}]":
+            stack.pop()  # a mismatched closer still closes the innermost block
+            if not stack:
+                yield begin, i + 1, ""
+    if stack:
+        yield begin, len(text), (quote or "") + "".join(reversed(stack))
+
+
+def repair_json(text):
+    """
+    Rewrite near-JSON into JSON in one pass: single-quoted strings become
+    double-quoted, trailing commas are dropped, True/False/None become
+    true/false/null and curly double quotes become straight ones.
+    """
+    text = text.replace("“", '"').replace("”", '"')
+    out = []
+    quote = None
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if quote:
+            if ch == "\\" and i + 1 < n:
+                # \' is not a JSON escape; an escaped quote inside '...' needs no escape in "..."
+                out.append("'" if text[i + 1] == "'" else text[i:i + 2])
+                i += 2
+                continue
+            if ch == quote:
+                out.append('"')
+                quote = None
+            elif ch == '"':
+                out.append('\\"')  # only reachable inside a single-quoted string
+            else:
+                out.append(ch)
+        elif ch in ('"', "'"):
+            out.append('"')
+            quote = ch
+        elif ch == ",":
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j == n or text[j] not in "}]":
+                out.append(ch)
+        elif ch.isalpha():
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(PYTHON_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def parse_candidate(candidate):
+    """Parse one block as JSON, then as repaired JSON, then as a Python literal; None if all fail."""
+    try:
+        return json.loads(candidate, strict=False)
+    except ValueError:
+        pass
+    try:
+        return json.loads(repair_json(candidate), strict=False)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(candidate)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def extract_json(response, marker=None, openers="{"):
+    """
+    Extract the JSON value from an LLM response.
+
+    Args:
+        response: Raw response text
+        marker: Optional tag such as "#OUTPUT:"; when present, only the text
+            after its last occurrence is scanned
+        openers: "{" for objects, "{[" to also accept top-level lists
+
+    Returns:
+        The first non-empty parsed value (an empty one if that is all there is)
+
+    Raises:
+        json.JSONDecodeError: If no block in the response can be parsed
+    """
+    text = response
+    if marker and marker in response:
+        text = response.rpartition(marker)[2]
+    empty = None
+    for begin, end, closing in scan_balanced(text, openers):
+        parsed = parse_candidate(text[begin:end] + closing)
+        if not isinstance(parsed, (dict, list)):
+            continue
+        if parsed:
+            return parsed
+        if empty is None:
+            empty = parsed
+    if empty is not None:
+        return empty
+    raise json.JSONDecodeError("No JSON object found in response", response, 0)
@@ -0,0 +1,122 @@
+# Local stand-in for the chat completions API, used to test and benchmark
+# llm_async_call.py without spending tokens.
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = '#OUTPUT: {"command": "Show a bar chart.", "question": "What does the chart show?", "statement": "A bar chart."}'
+
+
+class StubLLMServer(object):
+    """
+    Minimal OpenAI-compatible /chat/completions endpoint.
+
+    Args:
+        port: Port to listen on (0 picks a free port)
+        latency: Seconds to wait before answering each request
+        rate_limit_prob: Probability of answering with HTTP 429
+        reply: Assistant message content, or a function of the request body
+    """
+    def __init__(self, port=0, latency=0.05, rate_limit_prob=0.0, reply=DEFAULT_REPLY):
+        self.latency = latency
+        self.rate_limit_prob = rate_limit_prob
+        self.reply = reply
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                with stub._lock:
+                    stub.request_count += 1
+                    rate_limited = random.random() < stub.rate_limit_prob
+                    if rate_limited:
+                        stub.rate_limited_count += 1
+                if rate_limited:
+                    self._send_json(
+                        429,
+                        {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                        headers={"Retry-After": "0.1"},
+                    )
+                    return
+
+                time.sleep(stub.latency)
+                content = stub.reply(request) if callable(stub.reply) else stub.reply
+                prompt_tokens = sum(len(m.get("content", "")) for m in request.get("messages", [])) // 4
+                completion_tokens = len(content) // 4
+                self._send_json(200, {
+                    "id": f"chatcmpl-stub-{stub.request_count}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                })
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stub of the chat completions API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rate_limit_prob", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubLLMServer(args.port, args.latency, args.rate_limit_prob)
+    print(f"Stub server listening on {server.api_base}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,206 @@
+# Per-call LLM telemetry (latency, tokens, retries, cache hits, cost), tagged
+# by pipeline stage and written to a SQLite file that can be queried while a
+# job is running:
+#   python llm_telemetry.py                 per-stage totals + last-minute throughput
+#   python llm_telemetry.py --watch 10      refresh every 10 seconds
+#   python llm_telemetry.py --csv calls.csv export every call
+import os
+import sys
+import csv
+import time
+import sqlite3
+import argparse
+import threading
+import functools
+
+default_telemetry_path = os.getenv("LLM_TELEMETRY_PATH", "./llm_telemetry.sqlite")
+# Set LLM_TELEMETRY=0 to disable recording
+TELEMETRY_ENABLED = os.getenv("LLM_TELEMETRY", "1") != "0"
+
+# USD per 1K (prompt, completion) tokens
+PRICE_PER_1K_TOKENS = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+# Tokens of cache hits are not billed, so they are left out of the token totals
+STAGE_TOTALS_QUERY = (
+    "SELECT stage, model, COUNT(*) AS calls, SUM(cache_hit) AS cache_hits, "
+    "SUM(error IS NOT NULL) AS errors, SUM(retries) AS retries, "
+    "SUM(CASE WHEN cache_hit = 0 THEN prompt_tokens ELSE 0 END) AS prompt_tokens, "
+    "SUM(CASE WHEN cache_hit = 0 THEN completion_tokens ELSE 0 END) AS completion_tokens, "
+    "ROUND(SUM(cost), 4) AS cost, ROUND(AVG(latency), 3) AS avg_latency, "
+    "ROUND(SUM(latency), 1) AS total_latency, ROUND(SUM(wait), 1) AS total_wait "
+    "FROM llm_calls GROUP BY stage, model ORDER BY stage, model;"
+)
+
+
+def get_stage():
+    """Stage tag: LLM_STAGE if set, else the name of the running script."""
+    return os.getenv("LLM_STAGE") or os.path.splitext(os.path.basename(sys.argv[0]))[0] or "interactive"
+
+
+def set_stage(stage):
+    """Tag calls made from now on, including those of worker processes started afterwards."""
+    os.environ["LLM_STAGE"] = stage
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = PRICE_PER_1K_TOKENS.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class LLMTelemetry(object):
+    """
+    Append-only SQLite log with one row per LLM call.
+
+    Like LLMCache, the database runs in WAL mode and every process opens its
+    own connection, so ProcessPoolExecutor workers can all write to it and a
+    reader can query it at the same time.
+    """
+    def __init__(self, path=default_telemetry_path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_calls ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, stage TEXT, model TEXT, "
+                "latency REAL, wait REAL, prompt_tokens INTEGER, completion_tokens INTEGER, "
+                "retries INTEGER, cache_hit INTEGER, cost REAL, error TEXT);"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_calls_created ON llm_calls (created);")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def record(self, model, latency, token_usage=None, retries=0, cache_hit=False, wait=0.0, error=None, stage=None):
+        """
+        Args:
+            model: Model name the call was made for
+            latency: Wall time of the call in seconds, including retries
+            token_usage: Usage dict of the response (or of the cached response)
+            retries: Attempts after the first one
+            cache_hit: Whether the response came from the LLM cache (costs nothing)
+            wait: Seconds spent waiting for rate limits / concurrency slots
+            error: Exception type name when the call failed
+            stage: Stage tag, defaults to get_stage()
+        """
+        token_usage = token_usage or {}
+        prompt_tokens = int(token_usage.get("prompt_tokens", 0))
+        completion_tokens = int(token_usage.get("completion_tokens", 0))
+        cost = 0.0 if cache_hit else estimate_cost(model, prompt_tokens, completion_tokens)
+        self.connection.execute(
+            "INSERT INTO llm_calls (created, stage, model, latency, wait, prompt_tokens, completion_tokens, "
+            "retries, cache_hit, cost, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            (time.time(), stage or get_stage(), model, latency, wait, prompt_tokens, completion_tokens,
+             retries, int(cache_hit), cost, error)
+        )
+
+    def _rows(self, query, params=()):
+        cursor = self.connection.execute(query, params)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def stage_totals(self):
+        """Per-stage and per-model totals over the whole log."""
+        return self._rows(STAGE_TOTALS_QUERY)
+
+    def throughput(self, window=60):
+        """Per-stage calls/min and tokens/min over the last `window` seconds."""
+        rows = self._rows(
+            "SELECT stage, COUNT(*) AS calls, "
+            "SUM(CASE WHEN cache_hit = 0 THEN prompt_tokens + completion_tokens ELSE 0 END) AS tokens, "
+            "ROUND(AVG(latency), 3) AS avg_latency "
+            "FROM llm_calls WHERE created >= ? GROUP BY stage ORDER BY stage;",
+            (time.time() - window,)
+        )
+        for row in rows:
+            row["calls_per_min"] = round(row.pop("calls") * 60 / window, 1)
+            row["tokens_per_min"] = round(row.pop("tokens") * 60 / window, 1)
+        return rows
+
+    def export_csv(self, csv_path, query="SELECT * FROM llm_calls ORDER BY id;"):
+        cursor = self.connection.execute(query)
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow([c[0] for c in cursor.description])
+            writer.writerows(cursor)
+
+
+_default_telemetry = None
+
+
+def get_default_telemetry():
+    """Process-wide telemetry log, or None when disabled with LLM_TELEMETRY=0."""
+    global _default_telemetry
+    if not TELEMETRY_ENABLED:
+        return None
+    if _default_telemetry is None:
+        _default_telemetry = LLMTelemetry()
+    return _default_telemetry
+
+
+_attempts = threading.local()
+
+
+def count_attempts(fn):
+    """
+    Decorator placed below @retry so the retries of a call_gpt_* function can
+    be recorded by the decorator above it (see llm_cache.cached_llm_call).
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _attempts.count = getattr(_attempts, "count", 0) + 1
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def reset_attempts():
+    _attempts.count = 0
+
+
+def get_attempts():
+    return getattr(_attempts, "count", 0)
+
+
+def print_table(rows):
+    if not rows:
+        print("(no calls recorded)")
+        return
+    columns = list(rows[0])
+    widths = [max(len(str(c)), *(len(str(row[c])) for row in rows)) for c in columns]
+    print("  ".join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise the LLM telemetry log")
+    parser.add_argument("--path", default=default_telemetry_path)
+    parser.add_argument("--window", type=int, default=60, help="Throughput window in seconds")
+    parser.add_argument("--watch", type=float, default=0, help="Refresh interval in seconds (0 prints once)")
+    parser.add_argument("--csv", default=None, help="Export every recorded call to this CSV file")
+    parser.add_argument("--totals_csv", default=None, help="Export per-stage totals to this CSV file")
+    args = parser.parse_args()
+
+    telemetry = LLMTelemetry(args.path)
+    if args.csv:
+        telemetry.export_csv(args.csv)
+    if args.totals_csv:
+        telemetry.export_csv(args.totals_csv, query=STAGE_TOTALS_QUERY)
+    while True:
+        print("# Per-stage totals")
+        print_table(telemetry.stage_totals())
+        print(f"\n# Throughput over the last {args.window}s")
+        print_table(telemetry.throughput(args.window))
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+        print()
@@ -0,0 +1,240 @@
+# Near-duplicate detection for generated NL queries, with MinHash signatures
+# and LSH banding per table, so the corpus is processed in one streaming pass
+# without comparing every pair of queries.
+#   python nl_dedup.py --input ./nl_generation_output_gpt_35_0227 --output ./nl_generation_output_dedup
+#   python nl_dedup.py --input ../../../data/nvbench2.0/train.json --output ./train_dedup.json
+import os
+import re
+import json
+import zlib
+import argparse
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+NUM_PERM = 128
+BANDS = 16  # 16 bands of 8 rows: pairs above ~0.7 Jaccard usually share a band
+THRESHOLD = 0.8  # estimated Jaccard similarity above which two queries are near-duplicates
+SHINGLE_SIZE = 4  # character n-grams of the normalised query
+MAX_REPORTED_PAIRS = 200
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_query(text):
+    return " ".join(re.sub(r"[^a-z0-9 ]", " ", str(text).lower()).split())
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = normalize_query(text)
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHasher(object):
+    """MinHash signatures from NUM_PERM universal hash functions over crc32 shingle hashes."""
+    def __init__(self, num_perm=NUM_PERM, seed=0):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+
+    def signature(self, text):
+        hashes = np.array([zlib.crc32(s.encode("utf-8")) for s in shingles(text)], dtype=np.int64)
+        hashes %= MERSENNE_PRIME
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+class LSHIndex(object):
+    """
+    Banded LSH index over the signatures of the queries kept so far for one table.
+
+    Only kept queries are inserted, so every duplicate is matched against the
+    query that represents it.
+    """
+    def __init__(self, bands=BANDS, threshold=THRESHOLD):
+        self.bands = bands
+        self.threshold = threshold
+        self.buckets = defaultdict(list)
+        self.entries = []  # (key, group, target signature, signature)
+
+    def _band_keys(self, signature):
+        rows = len(signature) // self.bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+    def query(self, signature):
+        """Kept entries whose estimated Jaccard similarity is at least the threshold, best first."""
+        seen = set()
+        matches = []
+        for band_key in self._band_keys(signature):
+            for idx in self.buckets.get(band_key, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                key, group, target_signature, other = self.entries[idx]
+                similarity = float(np.mean(signature == other))
+                if similarity >= self.threshold:
+                    matches.append((similarity, key, group, target_signature))
+        return sorted(matches, key=lambda m: -m[0])
+
+    def insert(self, key, group, target_signature, signature):
+        idx = len(self.entries)
+        self.entries.append((key, group, target_signature, signature))
+        for band_key in self._band_keys(signature):
+            self.buckets[band_key].append(idx)
+
+
+class NearDuplicateFilter(object):
+    """
+    Streaming filter: feed (table, key, query, target, group) one at a time.
+
+    A query is dropped when it is a near-duplicate of an earlier kept query of
+    the same table from another group (solution) whose target (action list or
+    gold answer) is also a near-duplicate, both at the same threshold. Queries
+    of one group, e.g. the command/question/statement variants of a solution,
+    never remove each other. A near-duplicate query with a dissimilar target
+    is a different training example, so it is kept and only reported as a
+    conflict.
+    """
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, threshold=THRESHOLD):
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.threshold = threshold
+        self.indexes = {}
+        self.per_table = defaultdict(lambda: {"queries": 0, "duplicates": 0, "conflicts": 0})
+        self.duplicate_pairs = []
+        self.conflict_pairs = []
+
+    def add(self, table, key, query, target, group=None):
+        """Returns True if the query should be kept."""
+        index = self.indexes.get(table)
+        if index is None:
+            index = self.indexes[table] = LSHIndex(self.bands, self.threshold)
+        stats = self.per_table[table]
+        stats["queries"] += 1
+        signature = self.hasher.signature(query)
+        target_signature = self.hasher.signature(target if isinstance(target, str) else json.dumps(target))
+        matches = [m for m in index.query(signature) if group is None or m[2] != group]
+        for similarity, other_key, _, other_target_signature in matches:
+            target_similarity = float(np.mean(target_signature == other_target_signature))
+            if target_similarity >= self.threshold:
+                stats["duplicates"] += 1
+                if len(self.duplicate_pairs) < MAX_REPORTED_PAIRS:
+                    self.duplicate_pairs.append({"table": table, "dropped": key, "kept": other_key,
+                                                 "similarity": similarity, "target_similarity": target_similarity,
+                                                 "query": query})
+                return False
+        if matches:
+            stats["conflicts"] += 1
+            if len(self.conflict_pairs) < MAX_REPORTED_PAIRS:
+                self.conflict_pairs.append({"table": table, "key": key, "similar_to": matches[0][1],
+                                            "similarity": matches[0][0], "query": query})
+        index.insert(key, group, target_signature, signature)
+        return True
+
+    def close_table(self, table):
+        """Free a table's index once all of its queries have been seen."""
+        self.indexes.pop(table, None)
+
+    def report(self):
+        queries = sum(s["queries"] for s in self.per_table.values())
+        duplicates = sum(s["duplicates"] for s in self.per_table.values())
+        return {
+            "threshold": self.threshold,
+            "num_perm": len(self.hasher.a),
+            "bands": self.bands,
+            "tables": len(self.per_table),
+            "queries": queries,
+            "duplicates_removed": duplicates,
+            "duplicate_ratio": duplicates / queries if queries else None,
+            "conflicts_kept": sum(s["conflicts"] for s in self.per_table.values()),
+            "per_table": {t: s for t, s in self.per_table.items() if s["duplicates"] or s["conflicts"]},
+            "duplicate_examples": self.duplicate_pairs,
+            "conflict_examples": self.conflict_pairs,
+        }
+
+
+def dedup_generation_output(input_dir, output_dir, dedup):
+    """
+    Filter the per-table files written by nl_generation_multiproess.py; each
+    solution's nl_query_list loses the queries that duplicate another
+    solution's, and solutions left without queries are dropped.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    json_files = sorted(f for f in os.listdir(input_dir) if f.endswith(".json") and "@" in f)
+    for json_file in tqdm(json_files, desc="Deduplicating tables"):
+        with open(os.path.join(input_dir, json_file), "r") as f:
+            json_dict = json.load(f)
+        filtered = {}
+        for s_idx, solution in json_dict.items():
+            nl_query_list = solution.get("nl_query_list")
+            if not isinstance(nl_query_list, dict) or "error" in nl_query_list:
+                filtered[s_idx] = solution  # failed parses are left for the caller to handle
+                continue
+            target = json.dumps(solution.get("action_list", []))
+            kept = {
+                query_type: query for query_type, query in nl_query_list.items()
+                if dedup.add(json_file, f"{s_idx}/{query_type}", query, target, group=s_idx)
+            }
+            if kept:
+                filtered[s_idx] = dict(solution, nl_query_list=kept)
+        dedup.close_table(json_file)
+        with open(os.path.join(output_dir, json_file), "w") as f:
+            json.dump(filtered, f, indent=4)
+
+
+def iter_records(path):
+    """Records of a dataset file: a JSON list, or JSON Lines read one line at a time."""
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+
+
+def dedup_dataset(input_path, output_path, dedup):
+    """
+    Filter a dataset file (csv_file / nl_query / gold_answer records, e.g.
+    data/nvbench2.0/*.json). Records carry no solution id, so the records of a
+    table with the same gold answer are taken as the variants of one solution.
+    """
+    kept = []
+    for idx, record in enumerate(tqdm(iter_records(input_path), desc="Deduplicating records")):
+        gold_answer = record.get("gold_answer")
+        group = gold_answer if isinstance(gold_answer, str) else json.dumps(gold_answer, sort_keys=True)
+        if dedup.add(record["csv_file"], idx, record["nl_query"], gold_answer, group=group):
+            kept.append(record)
+    with open(output_path, "w", encoding="utf-8") as f:
+        if output_path.endswith(".jsonl"):
+            for record in kept:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            json.dump(kept, f, indent=4, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove near-duplicate NL queries per table")
+    parser.add_argument("--input", required=True, help="NL generation output directory, or a dataset .json/.jsonl file")
+    parser.add_argument("--output", required=True, help="Filtered directory or file")
+    parser.add_argument("--report", default=None, help="Report path (default: next to the output)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--num_perm", type=int, default=NUM_PERM)
+    parser.add_argument("--bands", type=int, default=BANDS)
+    args = parser.parse_args()
+
+    dedup = NearDuplicateFilter(args.num_perm, args.bands, args.threshold)
+    if os.path.isdir(args.input):
+        dedup_generation_output(args.input, args.output, dedup)
+        report_path = args.report or os.path.join(args.output, "dedup_report.json")
+    else:
+        dedup_dataset(args.input, args.output, dedup)
+        report_path = args.report or os.path.splitext(args.output)[0] + "_dedup_report.json"
+
+    report = dedup.report()
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    print(f"{report['duplicates_removed']} of {report['queries']} queries removed as near-duplicates "
+          f"({report['conflicts_kept']} near-duplicates with a different target kept); report: {report_path}")
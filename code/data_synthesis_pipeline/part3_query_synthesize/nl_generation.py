@@ -1,5 +1,6 @@
-import ast
 from llm_gpt_call import call_gpt_3_5, call_gpt_4
+from llm_output_parser import extract_json
+from llm_cache import forget_response
 sys_content = "You are an intelligent assistant. You only answer with #OUTPUT."
 prompt = """#Task: generate 4 different Natural Language Queries for the data-to-chart problem, as command(plot/show/etc.), question(what/how/etc.), requirement(please/can you/etc.), statement(I want/I'd like/lets/etc.), etc. action_list may have "mark chart_type", "column column_name", "bin bin_size column_name", "aggregation para column_name", "sort order column_name", "filter column_name operation value". Since it's natural language query, do not refer to column_name = 'name' as column 'name', just as name.
 Every the NL Queries MUST reflect ALL information in the INPUT action_list, but MUST NOT introduce extra information NOT in input action_list.
@@ -39,9 +40,11 @@ for json_file in tqdm(os.listdir(input_dir)):
         # exit()
 
         save_dict[s_idx] = solution
-        nl_query_list_str = result.split("#OUTPUT:")[1]
-        
-        nl_query_list = ast.literal_eval(nl_query_list_str)
+        try:
+            nl_query_list = extract_json(result, marker="#OUTPUT:")
+        except Exception:
+            forget_response("gpt-3.5-turbo", input_str, sys_content)  # ask again on the next run
+            raise
         save_dict[s_idx]["nl_query_list"] =  nl_query_list
 
     
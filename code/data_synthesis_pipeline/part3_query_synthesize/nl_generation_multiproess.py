@@ -1,9 +1,12 @@
-import ast
 import os
 import json
+import asyncio
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
-from llm_gpt_call import call_gpt_3_5, call_gpt_4
+from llm_gpt_call import call_gpt_3_5, call_gpt_4, estimate_tokens
+from llm_async_call import AsyncLLMClient
+from llm_output_parser import extract_json
+from llm_cache import forget_response
 
 sys_content = "You are an intelligent assistant."
 prompt = """#Task: Generate 3 Natural Language Query for a data-to-chart problem based on a given Data Schema and Action List.
@@ -53,9 +56,129 @@ etc.
 
 input_dir = "../part2.vis_asp/nl_generation_input_multiprocess"
 output_dir = "./nl_generation_output_gpt_35_0227"
+# Append-only log of finished solutions per table, so an interrupted run resumes per solution
+checkpoint_dir = os.path.join(output_dir, "checkpoints")
+
+# Fan out (table, solution) work units on one event loop instead of one process per table
+USE_ASYNC = True
+MAX_IN_FLIGHT = 32
+
+# Only send the schema and value examples of the columns the action list uses,
+# plus a short summary of the rest of the table
+COMPACT_PROMPT = True
+MAX_SUMMARY_COLUMNS = 20
 
 # Make sure the output directory exists
 os.makedirs(output_dir, exist_ok=True)
+os.makedirs(checkpoint_dir, exist_ok=True)
+
+def build_input_str(basename, solution):
+    action_list = solution["action_list"]
+    data_schema = solution["data_schema"]
+    ambiguous_pairs = solution["ambiguous_pairs"]
+    data_value_example = solution["data_value_example"]
+    info = f"""\nDatabase: {basename}\nData Columns: {data_schema}\nData Value Examples:{data_value_example}\nAmbiguous Column Pairs:{ambiguous_pairs}\nAction List:{action_list}"""
+    return prompt + info
+
+def relevant_columns(solution):
+    """Columns named in the action list, plus the columns behind its [AMBI] references, in schema order."""
+    data_schema = solution["data_schema"]
+    used = {column for columns in solution["ambiguous_pairs"].values() for column in columns}
+    for action in solution["action_list"]:
+        used.update(token for token in action.split(" ") if token in data_schema)
+    return [column for column in data_schema if column in used]
+
+def build_compact_input_str(basename, solution):
+    """
+    Same prompt as build_input_str, restricted to the relevant columns.
+
+    The instructions stay a byte-identical prefix, and the table-level lines
+    come before the solution-level ones, so requests share the longest
+    possible prefix for provider-side prompt caching.
+    """
+    data_schema = solution["data_schema"]
+    columns = relevant_columns(solution)
+    others = [column for column in data_schema if column not in columns]
+    summary = f"{len(data_schema)} columns"
+    if others:
+        summary += "; other columns: " + ", ".join(others[:MAX_SUMMARY_COLUMNS])
+        if len(others) > MAX_SUMMARY_COLUMNS:
+            summary += f", ... ({len(others) - MAX_SUMMARY_COLUMNS} more)"
+    examples = {column: solution["data_value_example"][column]
+                for column in columns if column in solution["data_value_example"]}
+    info = f"""\nDatabase: {basename}\nTable Summary: {summary}\nData Columns: {columns}\nData Value Examples:{examples}\nAmbiguous Column Pairs:{solution["ambiguous_pairs"]}\nAction List:{solution["action_list"]}"""
+    return prompt + info
+
+def build_prompt(basename, solution):
+    if COMPACT_PROMPT:
+        return build_compact_input_str(basename, solution)
+    return build_input_str(basename, solution)
+
+def compaction_report(units):
+    """Estimated prompt tokens per request with the full and the compact builder."""
+    requests = []
+    for json_file, s_idx, solution in units:
+        basename = os.path.basename(json_file)
+        full = estimate_tokens(sys_content) + estimate_tokens(build_input_str(basename, solution))
+        compact = estimate_tokens(sys_content) + estimate_tokens(build_compact_input_str(basename, solution))
+        requests.append({"file": json_file, "s_idx": s_idx, "full_tokens": full, "compact_tokens": compact})
+    total_full = sum(r["full_tokens"] for r in requests)
+    total_compact = sum(r["compact_tokens"] for r in requests)
+    return {
+        "requests": len(requests),
+        "full_tokens": total_full,
+        "compact_tokens": total_compact,
+        "reduction": 1 - total_compact / total_full if total_full else None,
+        "static_prefix_tokens": estimate_tokens(sys_content) + estimate_tokens(prompt),
+        "per_request": requests,
+    }
+
+def parse_result(json_file, s_idx, result, forget=None):
+    try:
+        return extract_json(result, marker="#OUTPUT:")
+    except Exception as e:
+        print(f"Error parsing result for {json_file}, solution {s_idx}: {e}")
+        if forget is not None:
+            forget()  # drop the cached response so a rerun asks again
+        # Provide a fallback or handle the error appropriately
+        return {"error": str(result)}
+
+def checkpoint_path(json_file):
+    return os.path.join(checkpoint_dir, json_file + "l")
+
+def load_checkpoint(json_file):
+    """Solutions already finished for a table, keyed by solution id."""
+    done = {}
+    path = checkpoint_path(json_file)
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r') as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # partial last line from an interrupted write
+            done[record["s_idx"]] = record["solution"]
+    return done
+
+def append_checkpoint(json_file, s_idx, solution):
+    with open(checkpoint_path(json_file), 'a') as log_file:
+        log_file.write(json.dumps({"s_idx": s_idx, "solution": solution}) + "\n")
+
+def finalize_file(json_file, solution_ids):
+    """Write the table's output file once every solution is in its checkpoint log."""
+    done = load_checkpoint(json_file)
+    if any(s_idx not in done for s_idx in solution_ids):
+        return False
+    save_dict = {s_idx: done[s_idx] for s_idx in solution_ids}
+    with open(os.path.join(output_dir, json_file), 'w') as output_file:
+        json.dump(save_dict, output_file, indent=4)
+    return True
+
+def process_solution(json_file, s_idx, solution, result, forget=None):
+    solution = dict(solution)
+    solution["nl_query_list"] = parse_result(json_file, s_idx, result, forget)
+    append_checkpoint(json_file, s_idx, solution)
 
 def process_file(json_file):
     output_file_path = os.path.join(output_dir, json_file)
@@ -66,14 +189,11 @@ def process_file(json_file):
     with open(os.path.join(input_dir, json_file), 'r') as file:
         json_dict = json.load(file)
     
-    save_dict = {}
+    done = load_checkpoint(json_file)
     for s_idx, solution in json_dict.items():
-        action_list = solution["action_list"]
-        data_schema = solution["data_schema"]
-        ambiguous_pairs = solution["ambiguous_pairs"]
-        data_value_example = solution["data_value_example"]
-        info = f"""\nDatabase: {basename}\nData Columns: {data_schema}\nData Value Examples:{data_value_example}\nAmbiguous Column Pairs:{ambiguous_pairs}\nAction List:{action_list}"""
-        input_str = prompt + info
+        if s_idx in done:
+            continue
+        input_str = build_prompt(basename, solution)
 
         # print(input_str)
         # exit()
@@ -85,23 +205,59 @@ def process_file(json_file):
         result, token_usage = call_gpt_3_5(input_str, sys_content)
         # result, token_usage = call_gpt_4(input_str, sys_content)
         
-        save_dict[s_idx] = solution
-        nl_query_list_str = result.split("#OUTPUT:")[1]
-        
-        try:
-            nl_query_list = ast.literal_eval(nl_query_list_str)
-            save_dict[s_idx]["nl_query_list"] = nl_query_list
-        except Exception as e:
-            print(f"Error parsing result for {json_file}, solution {s_idx}: {e}")
-            # Provide a fallback or handle the error appropriately
-            save_dict[s_idx]["nl_query_list"] = {"error": str(result)}
+        process_solution(json_file, s_idx, solution, result,
+                         lambda: forget_response("gpt-3.5-turbo", input_str, sys_content))
     
     # Write results to output file
-    with open(output_file_path, 'w') as output_file:
-        json.dump(save_dict, output_file, indent=4)
+    finalize_file(json_file, list(json_dict))
     
     return json_file
 
+def get_work_units(files_to_process):
+    """(table, solution) pairs that are not yet in a checkpoint log."""
+    units = []
+    solution_ids = {}
+    for json_file in files_to_process:
+        with open(os.path.join(input_dir, json_file), 'r') as file:
+            json_dict = json.load(file)
+        solution_ids[json_file] = list(json_dict)
+        done = load_checkpoint(json_file)
+        for s_idx, solution in json_dict.items():
+            if s_idx not in done:
+                units.append((json_file, s_idx, solution))
+    return units, solution_ids
+
+async def process_units(units, solution_ids):
+    client = AsyncLLMClient(model="gpt-3.5-turbo", max_in_flight=MAX_IN_FLIGHT)
+    remaining = {json_file: 0 for json_file in solution_ids}
+    for json_file, _, _ in units:
+        remaining[json_file] += 1
+
+    # Tables whose solutions were all checkpointed by an earlier run
+    for json_file, count in remaining.items():
+        if count == 0:
+            finalize_file(json_file, solution_ids[json_file])
+
+    async def run_unit(json_file, s_idx, solution):
+        input_str = build_prompt(os.path.basename(json_file), solution)
+        try:
+            result, token_usage = await client.chat(input_str, sys_content)
+        except Exception as e:
+            return json_file, s_idx, solution, e, None
+        return json_file, s_idx, solution, result, lambda: client.forget(input_str, sys_content)
+
+    async with client:
+        tasks = [run_unit(*unit) for unit in units]
+        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing solutions"):
+            json_file, s_idx, solution, result, forget = await future
+            if isinstance(result, Exception):
+                print(f"Error processing {json_file}, solution {s_idx}: {result}")
+                continue
+            process_solution(json_file, s_idx, solution, result, forget)
+            remaining[json_file] -= 1
+            if remaining[json_file] == 0 and finalize_file(json_file, solution_ids[json_file]):
+                print(f"Processed: {json_file}")
+
 def main():
     # Get list of files to process
     json_files = [f for f in os.listdir(input_dir) if f.endswith('.json')]
@@ -113,6 +269,19 @@ def main():
             files_to_process.append(json_file)
     
     print(f"Found {len(files_to_process)} files to process out of {len(json_files)} total")
+
+    units, solution_ids = get_work_units(files_to_process)
+    report = compaction_report(units)
+    with open(os.path.join(output_dir, "prompt_compaction_report.json"), 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+    if report["requests"]:
+        print(f"Prompt tokens: {report['full_tokens']} full, {report['compact_tokens']} compact "
+              f"({report['reduction']:.1%} reduction, compact builder {'on' if COMPACT_PROMPT else 'off'})")
+
+    if USE_ASYNC:
+        print(f"Found {len(units)} solutions to process")
+        asyncio.run(process_units(units, solution_ids))
+        return
     
     # Maximum number of workers
     max_workers = min(os.cpu_count(), 8)  # Limit to 8 or CPU count, whichever is smaller
@@ -133,4 +302,4 @@ def main():
                 print(f"Error processing {json_file}: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
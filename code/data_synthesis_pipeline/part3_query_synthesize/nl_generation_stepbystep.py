@@ -1,9 +1,10 @@
-import ast
 import os
 import json
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from llm_gpt_call import call_gpt_3_5, call_gpt_4
+from llm_output_parser import extract_json
+from llm_cache import forget_response
 from nl_prompt import step_prompt
 from utils.print_utils import suppress_stdout
 
@@ -47,15 +48,16 @@ def process_file(json_file):
         save_dict[s_idx] = solution
         save_dict[s_idx]["nl_generate_gpt_result_full"] = result
 
-        nl_query_list_str = result.split("## Final Output:")[1]
+        nl_query_list_str = result.rpartition("## Final Output:")[2]
 
         save_dict[s_idx]["nl_query_list_str"] = nl_query_list_str
         
         try:
-            nl_query_list = ast.literal_eval(nl_query_list_str)
+            nl_query_list = extract_json(result, marker="## Final Output:")
             save_dict[s_idx]["nl_query_list"] = nl_query_list
         except Exception as e:
             print(f"Error parsing result for {json_file}, solution {s_idx}: {e}")
+            forget_response("gpt-3.5-turbo", input_str, sys_content)  # ask again on the next run
             # Provide a fallback or handle the error appropriately
             save_dict[s_idx]["nl_query_list"] = {"error": str(result)}
     
@@ -0,0 +1,394 @@
+import copy
+import time
+import argparse
+from collections import defaultdict
+
+import torch
+from transformers import DynamicCache, StoppingCriteria, StoppingCriteriaList
+
+# GenerationConfig fields that change what greedy decoding emits, with their
+# neutral values; generate_batch implements none of them
+DECODING_SETTINGS = {
+    "do_sample": False,
+    "num_beams": 1,
+    "penalty_alpha": None,
+    "repetition_penalty": 1.0,
+    "encoder_repetition_penalty": 1.0,
+    "no_repeat_ngram_size": 0,
+    "bad_words_ids": None,
+    "sequence_bias": None,
+    "suppress_tokens": None,
+    "begin_suppress_tokens": None,
+    "forced_bos_token_id": None,
+    "min_length": 0,
+    "min_new_tokens": None,
+}
+
+
+def length_buckets(lengths, batch_size, max_batch_tokens=None):
+    """
+    Group sample indices into batches of similar prompt length.
+
+    Samples are sorted longest first, so an out-of-memory batch shows up at the
+    start of a run rather than at the end.
+
+    Args:
+        lengths: Prompt length in tokens of each sample
+        batch_size: Maximum samples per batch
+        max_batch_tokens: Optional cap on batch size * longest prompt in the batch
+
+    Returns:
+        list: Batches of sample indices
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches, batch = [], []
+    for idx in order:
+        full = len(batch) == batch_size
+        over_budget = max_batch_tokens and batch and (len(batch) + 1) * lengths[batch[0]] > max_batch_tokens
+        if batch and (full or over_budget):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def common_prefix_length(input_ids_list):
+    """Number of leading tokens shared by all lists."""
+    shortest = min(input_ids_list, key=len)
+    for position, token in enumerate(shortest):
+        if any(ids[position] != token for ids in input_ids_list):
+            return position
+    return len(shortest)
+
+
+def left_pad(input_ids_list, pad_token_id):
+    """Left-pad token id lists into (input_ids, attention_mask, position_ids) tensors."""
+    max_len = max(len(ids) for ids in input_ids_list)
+    input_ids = torch.full((len(input_ids_list), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids_list), max_len), dtype=torch.long)
+    for row, ids in enumerate(input_ids_list):
+        input_ids[row, max_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, max_len - len(ids):] = 1
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    return input_ids, attention_mask, position_ids
+
+
+class JsonCompletionStop(object):
+    """
+    Per-row stopping criterion: stop once the JSON value of the final answer is closed.
+
+    The generated text is scanned token by token for the anchors in order
+    (e.g. "<step_6>" then "<answer>"; none for the plain template, whose output
+    is the chart list itself). After the last anchor, bracket depth is tracked
+    outside JSON strings, and the row stops when the first top-level value closes.
+
+    Args:
+        tokenizer: Tokenizer used to decode single tokens
+        anchors: Tags that precede the final JSON value in the output
+    """
+    def __init__(self, tokenizer, anchors=()):
+        self.tokenizer = tokenizer
+        self.anchors = list(anchors)
+        self.window = ""
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.stopped = False
+
+    def update(self, token_id):
+        """Feed one generated token; returns True when the row should stop."""
+        return self.update_text(self.tokenizer.decode([token_id]))
+
+    def update_text(self, text):
+        while self.anchors:
+            self.window += text
+            position = self.window.find(self.anchors[0])
+            if position < 0:
+                # Keep just enough text to match an anchor split across tokens
+                self.window = self.window[-len(self.anchors[0]):]
+                return False
+            text = self.window[position + len(self.anchors[0]):]
+            self.window = ""
+            self.anchors.pop(0)
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.depth:
+                self.in_string = True
+            elif ch in "[{":
+                self.depth += 1
+            elif ch in "]}" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.stopped = True
+                    return True
+        return False
+
+
+@torch.no_grad()
+def build_prefix_cache(model, prefix_ids, cache=None, start=0):
+    """
+    KV cache (batch size 1) of prefix_ids.
+
+    Args:
+        cache: Optional cache already holding prefix_ids[:start]; it is copied,
+            not modified, and only prefix_ids[start:] is run through the model
+    """
+    cache = copy.deepcopy(cache) if cache is not None else DynamicCache()
+    if start < len(prefix_ids):
+        device = model.device
+        model(input_ids=torch.tensor([prefix_ids[start:]], device=device),
+              attention_mask=torch.ones((1, len(prefix_ids)), dtype=torch.long, device=device),
+              position_ids=torch.arange(start, len(prefix_ids), device=device)[None],
+              past_key_values=cache, use_cache=True, logits_to_keep=1)
+    return cache
+
+
+def check_greedy(generation_config):
+    """Raise ValueError if generation_config asks for more than plain greedy decoding."""
+    changed = {}
+    for name, neutral in DECODING_SETTINGS.items():
+        value = getattr(generation_config, name, None)
+        if value is not None and value != neutral:
+            changed[name] = value
+    if changed:
+        raise ValueError(f"Batched decoding is greedy only, but the model's generation_config sets {changed}; "
+                         f"decode one prompt at a time with model.generate (generate_sequential) instead")
+
+
+def get_eos_token_ids(model, tokenizer):
+    eos = model.generation_config.eos_token_id
+    if eos is None:
+        eos = tokenizer.eos_token_id
+    return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+
+@torch.no_grad()
+def generate_batch(model, input_ids_list, pad_token_id, eos_token_ids, max_new_tokens=2048, stoppers=None,
+                   prefix_cache=None, prefix_length=0):
+    """
+    Greedy decoding of a batch of prompts (generate_all checks that the
+    model's generation_config asks for nothing else).
+
+    Prompts are left-padded. A row that emits EOS or reaches max_new_tokens is
+    removed from the batch and its slice of the KV cache is dropped, so later
+    steps only run the rows that are still generating.
+
+    Args:
+        model: Causal LM
+        input_ids_list: Token ids of each prompt
+        pad_token_id: Padding token id
+        eos_token_ids: Set of token ids that end a sequence
+        max_new_tokens: Generation budget per row
+        stoppers: Optional per-row objects whose update(token_id) returns True
+            to end the row early (see JsonCompletionStop)
+        prefix_cache: Optional cache (batch size 1, from build_prefix_cache) of
+            prefix_length tokens that every prompt starts with; input_ids_list
+            then only holds the tokens after the prefix. The cache is copied
+            per row, so it can be reused for the next batch
+
+    Returns:
+        list: Generated token ids of each row (without EOS), in input order
+    """
+    device = model.device
+    input_ids, attention_mask, position_ids = left_pad(input_ids_list, pad_token_id)
+    input_ids, attention_mask, position_ids = input_ids.to(device), attention_mask.to(device), position_ids.to(device)
+
+    if prefix_cache is not None:
+        # [prefix][padding][prompt suffix]: padding sits between the shared prefix and each suffix
+        cache = copy.deepcopy(prefix_cache)
+        cache.batch_repeat_interleave(len(input_ids_list))
+        attention_mask = torch.cat([attention_mask.new_ones((len(input_ids_list), prefix_length)), attention_mask], dim=1)
+        position_ids = position_ids + prefix_length
+    else:
+        cache = DynamicCache()
+    outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                    past_key_values=cache, use_cache=True, logits_to_keep=1)
+    cache = outputs.past_key_values
+    next_positions = position_ids[:, -1] + 1
+    rows = list(range(len(input_ids_list)))  # input row of each active batch position
+    generated = [[] for _ in input_ids_list]
+
+    for step in range(max_new_tokens):
+        next_tokens = outputs.logits[:, -1, :].argmax(dim=-1)
+        active = []
+        for position, (row, token) in enumerate(zip(rows, next_tokens.tolist())):
+            if token in eos_token_ids:
+                continue
+            generated[row].append(token)
+            if stoppers is not None and stoppers[row].update(token):
+                continue
+            if len(generated[row]) < max_new_tokens:
+                active.append(position)
+        if not active:
+            break
+        if len(active) < len(rows):
+            keep = torch.tensor(active, device=device)
+            cache.batch_select_indices(keep)
+            attention_mask = attention_mask[keep]
+            next_tokens = next_tokens[keep]
+            next_positions = next_positions[keep]
+            rows = [rows[position] for position in active]
+
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1)
+        outputs = model(input_ids=next_tokens[:, None], attention_mask=attention_mask,
+                        position_ids=next_positions[:, None], past_key_values=cache, use_cache=True)
+        cache = outputs.past_key_values
+        next_positions = next_positions + 1
+    return generated
+
+
+def generate_all(model, tokenizer, texts, batch_size=16, max_new_tokens=2048, max_batch_tokens=None,
+                 answer_anchors=None, group_keys=None, input_ids_list=None):
+    """
+    Batched generation over a list of prompts.
+
+    Args:
+        answer_anchors: When not None, rows stop as soon as the JSON value after
+            these anchors is closed (JsonCompletionStop)
+        group_keys: Optional key per prompt (e.g. its csv_file). When given, the
+            prefix shared by all prompts (the instruction block) is prefilled
+            once, each group extends a copy of it with the prefix its prompts
+            share (the table schema), and batches are formed within groups so
+            that only the rest of each prompt is prefilled
+        input_ids_list: Token ids of the prompts when already tokenised (preprocess.py)
+
+    Yields:
+        tuple: (sample index, prompt token ids, generated token ids, whether the
+        row was stopped at the end of its answer), batch by batch in length
+        order; callers put results back in input order
+    """
+    if not texts:
+        return
+    check_greedy(model.generation_config)
+    if input_ids_list is None:
+        input_ids_list = tokenizer(texts)["input_ids"]
+    eos_token_ids = get_eos_token_ids(model, tokenizer)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else next(iter(eos_token_ids))
+    lengths = [len(ids) for ids in input_ids_list]
+
+    if group_keys is None:
+        batches = [(batch, None, 0) for batch in length_buckets(lengths, batch_size, max_batch_tokens)]
+    else:
+        batches = prefix_batches(model, input_ids_list, group_keys, batch_size, max_batch_tokens)
+
+    for batch, prefix_cache, prefix_length in batches:
+        batch_ids = [input_ids_list[idx][prefix_length:] for idx in batch]
+        stoppers = None
+        if answer_anchors is not None:
+            stoppers = [JsonCompletionStop(tokenizer, answer_anchors) for _ in batch]
+        generated = generate_batch(model, batch_ids, pad_token_id, eos_token_ids, max_new_tokens, stoppers,
+                                   prefix_cache, prefix_length)
+        for row, (idx, output_ids) in enumerate(zip(batch, generated)):
+            yield idx, input_ids_list[idx], output_ids, stoppers is not None and stoppers[row].stopped
+
+
+class AnswerEndCriteria(StoppingCriteria):
+    """model.generate stopping criterion for one sequence, ending it when its JsonCompletionStop fires."""
+    def __init__(self, stopper):
+        self.stopper = stopper
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = self.stopper.update(input_ids[0, -1].item())
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+def generate_sequential(model, tokenizer, texts, max_new_tokens=2048, answer_anchors=None, input_ids_list=None):
+    """
+    One prompt at a time with model.generate, so every setting of the model's
+    generation_config (sampling, beams, penalties) applies.
+
+    Args:
+        answer_anchors: When not None, generation stops as soon as the JSON
+            value after these anchors is closed (ignored with beam search,
+            whose beams can disagree)
+
+    Yields:
+        tuple: (sample index, prompt token ids, generated token ids, whether the
+        sample was stopped at the end of its answer), as generate_all does
+    """
+    if input_ids_list is None:
+        input_ids_list = tokenizer(texts)["input_ids"]
+    eos_token_ids = get_eos_token_ids(model, tokenizer)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else next(iter(eos_token_ids))
+    single_beam = (model.generation_config.num_beams or 1) == 1
+    for idx, prompt_ids in enumerate(input_ids_list):
+        input_ids = torch.tensor([prompt_ids], device=model.device)
+        stopper = JsonCompletionStop(tokenizer, answer_anchors) if answer_anchors is not None and single_beam else None
+        outputs = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                 max_new_tokens=max_new_tokens, pad_token_id=pad_token_id,
+                                 stopping_criteria=StoppingCriteriaList([AnswerEndCriteria(stopper)]) if stopper else None)
+        output_ids = [t for t in outputs[0, len(prompt_ids):].tolist() if t not in eos_token_ids]
+        yield idx, list(prompt_ids), output_ids, stopper is not None and stopper.stopped
+
+
+def prefix_batches(model, input_ids_list, group_keys, batch_size, max_batch_tokens=None):
+    """
+    Length-bucketed batches within each group, each with the KV cache of its group's shared prefix.
+
+    Yields:
+        tuple: (sample indices, prefix cache, prefix length); a group's cache is
+        built lazily and dropped once the group's batches are done
+    """
+    groups = defaultdict(list)
+    for idx, key in enumerate(group_keys):
+        groups[key].append(idx)
+    # Every prompt keeps at least one token of its own, whose logits start generation
+    template_length = min(common_prefix_length(input_ids_list), min(len(ids) for ids in input_ids_list) - 1)
+    template_ids = input_ids_list[0][:template_length]
+    template_cache = build_prefix_cache(model, template_ids)
+
+    for members in groups.values():
+        member_ids = [input_ids_list[idx] for idx in members]
+        prefix_length = min(common_prefix_length(member_ids), min(len(ids) for ids in member_ids) - 1)
+        group_cache = None
+        if prefix_length:
+            group_cache = build_prefix_cache(model, member_ids[0][:prefix_length], template_cache, template_length)
+        suffix_lengths = [len(ids) - prefix_length for ids in member_ids]
+        for batch in length_buckets(suffix_lengths, batch_size, max_batch_tokens):
+            yield [members[i] for i in batch], group_cache, prefix_length
+
+
+def check_against_generate(model_name, num_prompts=8, batch_size=4, max_new_tokens=32):
+    """CPU check: batched greedy decoding matches one-at-a-time model.generate."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32).eval()
+    texts = [f"Sample {i}: " + "show the data " * (i % 5 + 1) + "# Output:" for i in range(num_prompts)]
+
+    start = time.perf_counter()
+    batched = {idx: output_ids for idx, _, output_ids, _ in
+               generate_all(model, tokenizer, texts, batch_size=batch_size, max_new_tokens=max_new_tokens)}
+    batched_time = time.perf_counter() - start
+
+    eos_token_ids = get_eos_token_ids(model, tokenizer)
+    start = time.perf_counter()
+    mismatches = 0
+    for idx, text in enumerate(texts):
+        inputs = tokenizer(text, return_tensors="pt")
+        outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False,
+                                 pad_token_id=tokenizer.pad_token_id or next(iter(eos_token_ids)))
+        reference = [t for t in outputs[0, inputs["input_ids"].shape[1]:].tolist() if t not in eos_token_ids]
+        mismatches += reference != batched[idx]
+    sequential_time = time.perf_counter() - start
+    print(f"{num_prompts} prompts: batched {batched_time:.2f}s, sequential {sequential_time:.2f}s, "
+          f"{mismatches} mismatching outputs")
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare batched greedy decoding with model.generate on CPU")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--num_prompts", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=32)
+    args = parser.parse_args()
+    check_against_generate(args.model, args.num_prompts, args.batch_size, args.max_new_tokens)
@@ -6,34 +6,97 @@ from trl import (
     SFTConfig,
     TrlParser
 )
-from sft_template import SFT_PROMPT_STEP_TEMPLATE, SFT_PROMPT_TEMPLATE, STEP_BY_STEP_OUTPUT_TEMPLATE
+from sft_template import GENERATION_CONFIG
+from generation import generate_all, generate_sequential
+from preprocess import format_batch, load_or_build, template_name
 import json
 from tqdm import tqdm
 import os
+import time
 
 WITH_THINKING = os.getenv("SFT_WITH_THINKING", False)
+# SFT_COMPACT_SCHEMA=1 renders the table one line per column; SFT_MAX_EXAMPLE_CHARS=<n> cuts long string examples
+COMPACT_SCHEMA = os.getenv("SFT_COMPACT_SCHEMA", "0") == "1"
+MAX_EXAMPLE_CHARS = int(os.getenv("SFT_MAX_EXAMPLE_CHARS", 0)) or None
+# Memory-map formatted and tokenised prompts from this directory (built by preprocess.py on first use)
+DATA_CACHE = os.getenv("SFT_DATA_CACHE")
 
-PROMPT_TEMPLATE = SFT_PROMPT_STEP_TEMPLATE if WITH_THINKING else SFT_PROMPT_TEMPLATE
+GENERATION_SETTINGS = GENERATION_CONFIG[template_name(WITH_THINKING, COMPACT_SCHEMA)]
+
+# INFER_BATCH_SIZE=<n> decodes prompts of similar length together (greedy only, not yet checked
+# under unsloth); by default prompts go one at a time through model.generate and its generation_config
+BATCH_SIZE = int(os.getenv("INFER_BATCH_SIZE", 0))
+MAX_BATCH_TOKENS = int(os.getenv("INFER_MAX_BATCH_TOKENS", 0)) or None
+MAX_NEW_TOKENS = int(os.getenv("INFER_MAX_NEW_TOKENS", 0)) or GENERATION_SETTINGS["max_new_tokens"]
+# INFER_SHARE_PREFIX=1 prefills the instruction block once and each table's schema once per csv_file (needs INFER_BATCH_SIZE)
+SHARE_PREFIX = os.getenv("INFER_SHARE_PREFIX", "0") == "1"
+# Stop each sample once its final chart list is closed instead of decoding to EOS
+STOP_AT_ANSWER_END = os.getenv("INFER_STOP_AT_ANSWER_END", "1") != "0"
+# INFER_QUIET=1 prints throughput (samples/s, tokens/s) instead of every prompt and prediction
+QUIET = os.getenv("INFER_QUIET", "0") == "1"
+# Predictions are appended to predictions.partial.jsonl as they finish and fsynced every FSYNC_EVERY lines
+FSYNC_EVERY = 32
+
+class PredictionWriter(object):
+    """
+    Streams predictions to <output_dir>/predictions.partial.jsonl, keyed by
+    sample index, and writes predictions.jsonl in sample order once every
+    sample is done. A rerun skips the samples already in the partial file.
+    """
+    def __init__(self, output_dir, texts, fsync_every=FSYNC_EVERY):
+        self.partial_path = os.path.join(output_dir, "predictions.partial.jsonl")
+        self.final_path = os.path.join(output_dir, "predictions.jsonl")
+        self.texts = texts
+        self.fsync_every = fsync_every
+        self.pending = 0
+        self.done = self._load()
+        self.file = open(self.partial_path, "a")
+
+    def _load(self):
+        done = {}
+        if not os.path.exists(self.partial_path):
+            return done
+        with open(self.partial_path, "rb+") as f:
+            data = f.read()
+            # Drop a line torn by a crash, so appended records start on a fresh line
+            f.truncate(data.rfind(b"\n") + 1)
+        for line in data[:data.rfind(b"\n") + 1].decode("utf-8").splitlines():
+            record = json.loads(line)
+            idx = record["idx"]
+            if idx < len(self.texts) and record["text"] == self.texts[idx]:
+                done[idx] = record["prediction"]
+        return done
+
+    def write(self, idx, prediction):
+        self.file.write(json.dumps({"idx": idx, "text": self.texts[idx], "prediction": prediction}) + "\n")
+        self.done[idx] = prediction
+        self.pending += 1
+        if self.pending >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+        if len(self.done) < len(self.texts):
+            return False
+        with open(self.final_path, "w") as f:
+            for idx, text in enumerate(self.texts):
+                f.write(json.dumps({"text": text, "prediction": self.done[idx]}) + "\n")
+        return True
 
 def dataset_preprocess(examples, tokenizer):
-    nl_query_list = examples["nl_query"]
-    table_schema_list = examples["table_schema"]
-    gold_answer_list = examples["gold_answer"]
-    texts = []
-    EOS_TOKEN = tokenizer.eos_token
-    for nl_query, table_schema, gold_answer in zip(nl_query_list, table_schema_list, gold_answer_list):
-        table_schema = json.loads(table_schema)
-        text = PROMPT_TEMPLATE.format(
-            table_columns=table_schema["table_columns"],
-            column_examples="\n".join([f"{k}: {v}" for k, v in table_schema["column_examples"].items()]),
-            unique_value_counts="\n".join([f"{k}: {v}" for k, v in table_schema["unique_value_counts"].items()]),
-            nl_query=nl_query,
-            output="" # leave the output for model generation
-        ) # do not add EOS_TOKEN for model input
-        texts.append(text)
-    return {"text": texts}
+    return format_batch(examples, tokenizer, WITH_THINKING, for_inference=True,
+                        compact_schema=COMPACT_SCHEMA, max_example_chars=MAX_EXAMPLE_CHARS)
 
 def main(script_args, training_args, model_args):
+    if SHARE_PREFIX and not BATCH_SIZE:
+        raise ValueError("INFER_SHARE_PREFIX=1 needs batched decoding: set INFER_BATCH_SIZE")
+
     ################
     # Model & Tokenizer
     ################
@@ -50,31 +113,68 @@ def main(script_args, training_args, model_args):
     ################
     # Dataset
     ################
-    dataset = load_dataset("json", data_files={"eval": script_args.dataset_test_split})
-    dataset = dataset.map(lambda x: dataset_preprocess(x, tokenizer), batched=True)
+    if DATA_CACHE:
+        dataset = {"eval": load_or_build(script_args.dataset_test_split, tokenizer, training_args.max_seq_length,
+                                         WITH_THINKING, DATA_CACHE, for_inference=True,
+                                         compact_schema=COMPACT_SCHEMA, max_example_chars=MAX_EXAMPLE_CHARS)}
+    else:
+        dataset = load_dataset("json", data_files={"eval": script_args.dataset_test_split})
+        dataset = dataset.map(lambda x: dataset_preprocess(x, tokenizer), batched=True)
     print("************ SAMPLE ***********")
     print(dataset["eval"][0]["text"])
     print("*******************************")
     
-    predictions = []
+    texts = list(dataset["eval"]["text"])
+    csv_files = list(dataset["eval"]["csv_file"])
+    writer = PredictionWriter(training_args.output_dir, texts)
+    remaining = [idx for idx in range(len(texts)) if idx not in writer.done]
+    print(f"{len(texts) - len(remaining)} predictions found in {writer.partial_path}, {len(remaining)} to generate")
     
-    for text in tqdm(dataset["eval"]["text"]):
-        inputs = tokenizer(text, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(model.device)
-        attention_mask = inputs["attention_mask"].to(model.device)
-        outputs = model.generate(input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=2048)
-        prediction = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    input_ids_list = None
+    if "input_ids" in dataset["eval"].column_names:
+        all_input_ids = dataset["eval"]["input_ids"]
+        input_ids_list = [list(all_input_ids[idx]) for idx in remaining]
+    answer_anchors = GENERATION_SETTINGS["answer_anchors"] if STOP_AT_ANSWER_END else None
+    if BATCH_SIZE:
+        batches = generate_all(model, tokenizer, [texts[idx] for idx in remaining], batch_size=BATCH_SIZE,
+                               max_new_tokens=MAX_NEW_TOKENS, max_batch_tokens=MAX_BATCH_TOKENS,
+                               answer_anchors=answer_anchors,
+                               group_keys=[csv_files[idx] for idx in remaining] if SHARE_PREFIX else None,
+                               input_ids_list=input_ids_list)
+    else:
+        batches = generate_sequential(model, tokenizer, [texts[idx] for idx in remaining],
+                                      max_new_tokens=MAX_NEW_TOKENS, answer_anchors=answer_anchors,
+                                      input_ids_list=input_ids_list)
+    start = time.perf_counter()
+    num_samples = num_tokens = 0
+    progress = tqdm(batches, total=len(remaining))
+    for position, prompt_ids, output_ids, stopped in progress:
+        idx = remaining[position]
+        text = texts[idx]
+        prediction = tokenizer.decode(prompt_ids + output_ids, skip_special_tokens=True)
         prediction = prediction.split("# Output:")[-1].strip()
-        predictions.append(json.dumps({"text": text, "prediction": prediction}))
-        print("************ TEXT ***********")
-        print(text)
-        print("************ PREDICTION ***********")
-        print(prediction)
-        print("*******************************")
+        if stopped:
+            # Drop whatever the last token carried past the closing bracket, and restore the template's tail
+            prediction = prediction[:max(prediction.rfind("]"), prediction.rfind("}")) + 1] + GENERATION_SETTINGS["answer_suffix"]
+        writer.write(idx, prediction)
+        num_samples += 1
+        num_tokens += len(output_ids)
+        elapsed = time.perf_counter() - start
+        if QUIET:
+            progress.set_postfix(samples_s=f"{num_samples / elapsed:.2f}", tokens_s=f"{num_tokens / elapsed:.1f}", refresh=False)
+        else:
+            print("************ TEXT ***********")
+            print(text)
+            print("************ PREDICTION ***********")
+            print(prediction)
+            print("*******************************")
     
-    with open(training_args.output_dir + "/predictions.jsonl", "w") as f:
-        for prediction in predictions:
-            f.write(prediction + "\n")
+    elapsed = time.perf_counter() - start
+    if num_samples:
+        print(f"Generated {num_samples} samples, {num_tokens} tokens in {elapsed:.1f}s "
+              f"({num_samples / elapsed:.2f} samples/s, {num_tokens / elapsed:.1f} tokens/s)")
+    if writer.close():
+        print(f"Wrote {writer.final_path}")
 
 def make_parser():
     dataclass_types = (ScriptArguments, SFTConfig, ModelConfig)
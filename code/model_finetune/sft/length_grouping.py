@@ -0,0 +1,127 @@
+import random
+
+from torch.utils.data import DataLoader
+from datasets import Dataset
+
+# Samples are sorted by length within groups of this many shuffled samples;
+# larger groups pad less but make batches less random
+GROUP_SIZE = 1024
+
+
+class TokenBudgetBatchSampler(object):
+    """
+    Batches of similar-length samples sized to a token budget.
+
+    Samples are shuffled, cut into groups of group_size, and sorted by length
+    within each group; each batch then takes samples while batch size * its
+    longest sample stays within max_batch_tokens, so short samples travel in
+    large batches and long ones in small batches. The batches are fixed (so the
+    number of steps per epoch is too) and their order is reshuffled every
+    epoch, with the batch holding the longest sample first so an out-of-memory
+    batch shows up at the start of a run.
+
+    Args:
+        lengths: Cost of each sample in tokens (padded length of one row)
+        max_batch_tokens: Budget for batch size * longest sample in the batch
+        max_batch_size: Optional cap on samples per batch
+        group_size: Samples sorted together, see GROUP_SIZE
+        seed: Seed of the grouping and of the per-epoch batch order
+    """
+    def __init__(self, lengths, max_batch_tokens, max_batch_size=None, group_size=GROUP_SIZE, seed=42):
+        self.lengths = list(lengths)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.seed = seed
+        self.epoch = 0
+        order = list(range(len(self.lengths)))
+        random.Random(seed).shuffle(order)
+        self.batches = []
+        for start in range(0, len(order), group_size):
+            group = sorted(order[start:start + group_size], key=lambda i: -self.lengths[i])
+            batch = []
+            for idx in group:
+                full = self.max_batch_size and len(batch) == self.max_batch_size
+                # Sorted longest first, so the batch's padded length is that of its first sample
+                over_budget = batch and (len(batch) + 1) * self.lengths[batch[0]] > max_batch_tokens
+                if batch and (full or over_budget):
+                    self.batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if batch:
+                self.batches.append(batch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = list(self.batches)
+        random.Random(self.seed + self.epoch).shuffle(batches)
+        longest = max(range(len(batches)), key=lambda b: self.lengths[batches[b][0]], default=0)
+        if batches:
+            batches.insert(0, batches.pop(longest))
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def padded_tokens(lengths, batches):
+    """Tokens of the given batches once each is padded to its longest sample."""
+    return sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+
+
+def batching_report(lengths, batches, batch_size, seed=42):
+    """
+    Padding efficiency (real tokens / padded tokens) of token-budget batches
+    against fixed-size batches of batch_size over a random shuffle.
+
+    Returns:
+        dict: Batch counts and sizes, padded tokens and efficiency of both
+    """
+    order = list(range(len(lengths)))
+    random.Random(seed).shuffle(order)
+    fixed = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    tokens = sum(lengths)
+    sizes = [len(batch) for batch in batches]
+    return {
+        "samples": len(lengths),
+        "tokens": tokens,
+        "batch_size_fixed": batch_size,
+        "batches_fixed": len(fixed),
+        "padded_tokens_fixed": padded_tokens(lengths, fixed),
+        "efficiency_fixed": tokens / padded_tokens(lengths, fixed) if fixed else None,
+        "batches_grouped": len(batches),
+        "batch_size_grouped": {"min": min(sizes), "mean": sum(sizes) / len(sizes), "max": max(sizes)} if sizes else None,
+        "max_padded_batch_tokens": max((max(lengths[i] for i in b) * len(b) for b in batches), default=0),
+        "padded_tokens_grouped": padded_tokens(lengths, batches),
+        "efficiency_grouped": tokens / padded_tokens(lengths, batches) if batches else None,
+    }
+
+
+class TokenBudgetTrainerMixin(object):
+    """
+    Trainer mixin: when train_batch_sampler is set, training batches come from
+    it instead of per_device_train_batch_size samples drawn at random.
+
+    DPOTrainer precomputes the reference log-probs (precompute_ref_log_probs)
+    inside get_train_dataloader, so that call still runs first and only its
+    dataloader is replaced.
+    """
+    train_batch_sampler = None
+
+    def get_train_dataloader(self):
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+        if getattr(self, "precompute_ref_log_probs", False) and not getattr(self, "_precomputed_train_ref_log_probs", True):
+            super().get_train_dataloader()
+        train_dataset = self.train_dataset
+        if isinstance(train_dataset, Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        return self.accelerator.prepare(DataLoader(
+            train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        ))
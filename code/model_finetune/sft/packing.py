@@ -0,0 +1,177 @@
+import sys
+import json
+import random
+import bisect
+import argparse
+
+import torch
+from datasets import Dataset
+
+
+def pack_lengths(lengths, max_length):
+    """
+    Best-fit decreasing bin packing of samples into rows of at most max_length tokens.
+
+    Args:
+        lengths: Token count of each sample (already truncated to max_length)
+        max_length: Capacity of a packed row
+
+    Returns:
+        list: Rows, each a list of sample indices
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    rows = []
+    free = []  # sorted (remaining capacity, row index)
+    for idx in order:
+        length = min(lengths[idx], max_length)
+        position = bisect.bisect_left(free, (length, -1))
+        if position < len(free):
+            remaining, row = free.pop(position)
+        else:
+            remaining, row = max_length, len(rows)
+            rows.append([])
+        rows[row].append(idx)
+        if remaining - length > 0:
+            bisect.insort(free, (remaining - length, row))
+    return rows
+
+
+def pack_dataset(dataset, max_length):
+    """
+    Concatenate tokenised samples into packed rows.
+
+    Each row keeps the position_ids of its samples (restarting at 0 for every
+    sample), which is all PackedCollator needs to rebuild the sample boundaries.
+
+    Args:
+        dataset: datasets.Dataset with an input_ids column (see preprocess.tokenize_batch)
+        max_length: Capacity of a packed row
+
+    Returns:
+        tuple: (packed datasets.Dataset with input_ids and position_ids, rows)
+    """
+    all_input_ids = dataset["input_ids"]
+    lengths = [len(ids) for ids in all_input_ids]
+    rows = pack_lengths(lengths, max_length)
+    packed = {"input_ids": [], "position_ids": []}
+    for row in rows:
+        input_ids, position_ids = [], []
+        for idx in row:
+            ids = list(all_input_ids[idx])[:max_length]
+            input_ids.extend(ids)
+            position_ids.extend(range(len(ids)))
+        packed["input_ids"].append(input_ids)
+        packed["position_ids"].append(position_ids)
+    return Dataset.from_dict(packed), rows
+
+
+def check_attention_isolation():
+    """
+    Raise ValueError when PackedCollator cannot keep packed samples apart.
+
+    Importing unsloth patches the transformers model classes with fast
+    forwards that drop the attention mask during training, so the block mask
+    never reaches attention and samples in a row attend to each other; its
+    handling of restarting position_ids is unverified as well. Packed runs
+    must load the model with plain transformers (sft.py does when
+    SFT_PACKING=1) in a process that never imported unsloth.
+    """
+    if "unsloth" in sys.modules:
+        raise ValueError("Packing is not supported under unsloth: its training forward drops the block-diagonal "
+                         "attention mask, so packed samples would attend to each other. Load the model with "
+                         "transformers without importing unsloth, or train without packing.")
+
+
+class PackedCollator(object):
+    """
+    Pads packed rows into a batch that keeps the samples of a row apart.
+
+    Labels are the input ids, with -100 on padding and on the first token of
+    every sample, so no sample is trained to continue the one before it.
+    Attention is restricted to each sample either with a block-diagonal 4D
+    mask in the model's "inverted" form (0 to attend, dtype minimum to mask),
+    or, for flash_attention_2, by the restarting position_ids alone.
+
+    Args:
+        pad_token_id: Id used to pad rows to the longest row of the batch
+        attention: "block" for a 4D mask, "position_ids" for flash_attention_2
+        mask_dtype: dtype of the 4D mask, the model's compute dtype
+    """
+    def __init__(self, pad_token_id, attention="block", mask_dtype=torch.float32):
+        self.pad_token_id = pad_token_id
+        self.attention = attention
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        max_len = max(len(f["input_ids"]) for f in features)
+        input_ids = torch.full((len(features), max_len), self.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((len(features), max_len), dtype=torch.long)
+        segments = torch.zeros((len(features), max_len), dtype=torch.long)  # 0 marks padding
+        for row, f in enumerate(features):
+            length = len(f["input_ids"])
+            input_ids[row, :length] = torch.tensor(f["input_ids"], dtype=torch.long)
+            position_ids[row, :length] = torch.tensor(f["position_ids"], dtype=torch.long)
+            segments[row, :length] = (position_ids[row, :length] == 0).cumsum(-1)
+        labels = input_ids.masked_fill((segments == 0) | (position_ids == 0), -100)
+        batch = {"input_ids": input_ids, "position_ids": position_ids, "labels": labels}
+        if self.attention == "block":
+            causal = torch.tril(torch.ones((max_len, max_len), dtype=torch.bool))
+            # Padding attends only to padding, so no query row is fully masked
+            allowed = (segments[:, :, None] == segments[:, None, :]) & causal
+            mask = torch.zeros(allowed.shape, dtype=self.mask_dtype)
+            batch["attention_mask"] = mask.masked_fill(~allowed, torch.finfo(self.mask_dtype).min)[:, None]
+        return batch
+
+
+def packing_report(lengths, rows, max_length, batch_size, seed=42):
+    """
+    Padding of one shuffled epoch with one sample per row versus packed rows,
+    both padded to the longest row of each batch of batch_size rows.
+
+    Returns:
+        dict: Token, row and padding counts, and the share of padding removed
+    """
+    def padded_tokens(row_lengths):
+        order = list(range(len(row_lengths)))
+        random.Random(seed).shuffle(order)
+        return sum(max(row_lengths[i] for i in order[start:start + batch_size]) * len(order[start:start + batch_size])
+                   for start in range(0, len(order), batch_size))
+
+    lengths = [min(length, max_length) for length in lengths]
+    tokens = sum(lengths)
+    padded_unpacked = padded_tokens(lengths)
+    padded_packed = padded_tokens([sum(lengths[i] for i in row) for row in rows])
+    return {
+        "max_length": max_length,
+        "batch_size": batch_size,
+        "samples": len(lengths),
+        "tokens": tokens,
+        "rows_unpacked": len(lengths),
+        "rows_packed": len(rows),
+        "steps_unpacked": -(-len(lengths) // batch_size),
+        "steps_packed": -(-len(rows) // batch_size),
+        "padding_unpacked": padded_unpacked - tokens,
+        "padding_packed": padded_packed - tokens,
+        "padding_removed": 1 - (padded_packed - tokens) / (padded_unpacked - tokens) if padded_unpacked > tokens else None,
+        "tokens_per_row_unpacked": tokens / len(lengths) if lengths else None,
+        "tokens_per_row_packed": tokens / len(rows) if rows else None,
+    }
+
+
+if __name__ == "__main__":
+    import os
+    from transformers import AutoTokenizer
+    from preprocess import load_or_build
+
+    parser = argparse.ArgumentParser(description="Report how much padding packing removes from an SFT split")
+    parser.add_argument("--data_file", required=True)
+    parser.add_argument("--tokenizer", required=True, help="Model name or path whose tokenizer is used")
+    parser.add_argument("--max_length", type=int, default=4096)
+    parser.add_argument("--batch_size", type=int, default=8, help="per_device_train_batch_size of the run")
+    parser.add_argument("--cache_dir", default=os.getenv("SFT_DATA_CACHE", "./data_cache"))
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    dataset = load_or_build(args.data_file, tokenizer, args.max_length, os.getenv("SFT_WITH_THINKING", False), args.cache_dir)
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    print(json.dumps(packing_report(lengths, pack_lengths(lengths, args.max_length), args.max_length, args.batch_size), indent=2))
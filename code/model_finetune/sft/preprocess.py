@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+
+from datasets import load_dataset, load_from_disk
+from sft_template import (
+    SFT_PROMPT_STEP_TEMPLATE,
+    SFT_PROMPT_TEMPLATE,
+    SFT_PROMPT_STEP_COMPACT_TEMPLATE,
+    SFT_PROMPT_COMPACT_TEMPLATE,
+    STEP_BY_STEP_OUTPUT_TEMPLATE
+)
+
+# Version of the formatting code below; bump it to invalidate cached datasets
+PREPROCESS_VERSION = 2
+
+TEMPLATES = {
+    "SFT_PROMPT_TEMPLATE": SFT_PROMPT_TEMPLATE,
+    "SFT_PROMPT_STEP_TEMPLATE": SFT_PROMPT_STEP_TEMPLATE,
+    "SFT_PROMPT_COMPACT_TEMPLATE": SFT_PROMPT_COMPACT_TEMPLATE,
+    "SFT_PROMPT_STEP_COMPACT_TEMPLATE": SFT_PROMPT_STEP_COMPACT_TEMPLATE,
+}
+DATE_PATTERN = re.compile(r"^\d{4}(-\d{1,2}){1,2}([ T]\d{1,2}:\d{2}(:\d{2})?)?$")
+
+
+def template_name(with_thinking, compact_schema=False):
+    """Name of the sft_template prompt (also the GENERATION_CONFIG key) for these settings."""
+    return f"SFT_PROMPT{'_STEP' if with_thinking else ''}{'_COMPACT' if compact_schema else ''}_TEMPLATE"
+
+
+def truncate_example(value, max_chars):
+    """Cut string examples longer than max_chars, marking the cut with "..."."""
+    if max_chars and isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars] + "..."
+    return value
+
+
+def column_type(examples):
+    """number, date or text, from a column's example values."""
+    def is_number(value):
+        if isinstance(value, bool):
+            return False
+        if isinstance(value, (int, float)):
+            return True
+        try:
+            float(value)
+            return True
+        except (TypeError, ValueError):
+            return False
+    if examples and all(is_number(v) for v in examples):
+        return "number"
+    if examples and all(isinstance(v, str) and DATE_PATTERN.match(v.strip()) for v in examples):
+        return "date"
+    return "text"
+
+
+def render_compact_schema(table_schema, max_example_chars=None):
+    """One line per column: "name (type, N unique): example | example"."""
+    lines = []
+    for column in table_schema["table_columns"]:
+        examples = table_schema["column_examples"].get(column, [])
+        rendered = " | ".join(str(truncate_example(v, max_example_chars)) for v in examples)
+        lines.append(f"{column} ({column_type(examples)}, "
+                     f"{table_schema['unique_value_counts'].get(column, '?')} unique): {rendered}")
+    return "\n".join(lines)
+
+
+def format_sample(nl_query, table_schema, steps, gold_answer, with_thinking, eos_token=None,
+                  compact_schema=False, max_example_chars=None):
+    """
+    Fill the SFT prompt template for one sample.
+
+    Args:
+        table_schema, steps: JSON strings as stored in the dataset
+        eos_token: Appended after the output for training; None for inference,
+            where the output is left empty for the model to generate
+        compact_schema: Render the table one line per column (the *_COMPACT_TEMPLATE prompts)
+        max_example_chars: Cut string examples longer than this; None keeps them whole
+
+    Returns:
+        str: The formatted text
+    """
+    table_schema = json.loads(table_schema)
+    if compact_schema:
+        inputs = dict(table_schema=render_compact_schema(table_schema, max_example_chars), nl_query=nl_query)
+    else:
+        column_examples = {
+            k: [truncate_example(v, max_example_chars) for v in values]
+            for k, values in table_schema["column_examples"].items()
+        }
+        inputs = dict(
+            table_columns=table_schema["table_columns"],
+            column_examples="\n".join([f"{k}: {v}" for k, v in column_examples.items()]),
+            unique_value_counts="\n".join([f"{k}: {v}" for k, v in table_schema["unique_value_counts"].items()]),
+            nl_query=nl_query,
+        )
+    template = TEMPLATES[template_name(with_thinking, compact_schema)]
+    if eos_token is None:
+        return template.format(output="", **inputs)  # leave the output for model generation
+    if not with_thinking:
+        return template.format(output=gold_answer, **inputs) + eos_token
+    steps = json.loads(steps)
+    output = STEP_BY_STEP_OUTPUT_TEMPLATE.format(**{
+        f"step_{i}_{part}": value
+        for i in range(1, 7)
+        for part, value in (("thinking", steps[f"step_{i}"]["reasoning"].strip()),
+                            ("answer", json.dumps(steps[f"step_{i}"]["answer"])))
+    })
+    return template.format(output=output, **inputs) + eos_token
+
+
+def format_batch(examples, tokenizer, with_thinking, for_inference=False, compact_schema=False, max_example_chars=None):
+    """datasets.map function producing the "text" column used by sft.py (training) and infer.py (inference)."""
+    eos_token = None if for_inference else tokenizer.eos_token
+    steps_list = examples["steps"] if "steps" in examples else [None] * len(examples["nl_query"])
+    texts = [
+        format_sample(nl_query, table_schema, steps, gold_answer, with_thinking, eos_token,
+                      compact_schema, max_example_chars)
+        for nl_query, table_schema, steps, gold_answer in zip(
+            examples["nl_query"], examples["table_schema"], steps_list, examples["gold_answer"])
+    ]
+    return {"text": texts}
+
+
+def tokenize_batch(examples, tokenizer, max_length, for_inference=False):
+    """
+    Tokenise "text" the way SFTTrainer does (special tokens added, truncated to
+    max_length). Training rows also get prompt_length, the number of tokens
+    before the output.
+    """
+    if for_inference:
+        return {"input_ids": tokenizer(examples["text"], add_special_tokens=True)["input_ids"]}
+    tokenized = tokenizer(examples["text"], add_special_tokens=True, truncation=True, max_length=max_length)
+    prompts = [text[:text.index("# Output:") + len("# Output:")] for text in examples["text"]]
+    prompt_lengths = [len(ids) for ids in tokenizer(prompts, add_special_tokens=True)["input_ids"]]
+    tokenized["prompt_length"] = [min(n, len(ids)) for n, ids in zip(prompt_lengths, tokenized["input_ids"])]
+    return tokenized
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(data_file, tokenizer, max_length, with_thinking, for_inference, compact_schema=False,
+              max_example_chars=None):
+    """Hash of everything the cached dataset depends on."""
+    templates = "".join(TEMPLATES.values()) + STEP_BY_STEP_OUTPUT_TEMPLATE
+    key = {
+        "version": PREPROCESS_VERSION,
+        "template": hashlib.sha256(templates.encode("utf-8")).hexdigest(),
+        "tokenizer": [tokenizer.name_or_path, len(tokenizer), tokenizer.eos_token, type(tokenizer).__name__],
+        "max_length": max_length,
+        "with_thinking": bool(with_thinking),
+        "for_inference": for_inference,
+        "compact_schema": compact_schema,
+        "max_example_chars": max_example_chars,
+        "data": file_digest(data_file),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16], key
+
+
+def load_or_build(data_file, tokenizer, max_length, with_thinking, cache_dir, for_inference=False, num_proc=None,
+                  compact_schema=False, max_example_chars=None):
+    """
+    Memory-map the formatted, tokenised dataset for data_file from cache_dir,
+    building it first if no artifact matches the cache key.
+
+    Returns:
+        datasets.Dataset with text, input_ids (+ attention_mask and
+        prompt_length for training) and the original columns
+    """
+    key, key_fields = cache_key(data_file, tokenizer, max_length, with_thinking, for_inference,
+                                compact_schema, max_example_chars)
+    name = os.path.splitext(os.path.basename(data_file))[0]
+    path = os.path.join(cache_dir, f"{name}-{'infer' if for_inference else 'train'}-{key}")
+    if os.path.exists(os.path.join(path, "preprocess_key.json")):
+        print(f"Loading preprocessed dataset from {path}")
+        return load_from_disk(path)
+
+    dataset = load_dataset("json", data_files={"data": data_file})["data"]
+    dataset = dataset.map(lambda x: format_batch(x, tokenizer, with_thinking, for_inference,
+                                                 compact_schema, max_example_chars),
+                          batched=True, num_proc=num_proc, desc="Formatting")
+    dataset = dataset.map(lambda x: tokenize_batch(x, tokenizer, max_length, for_inference),
+                          batched=True, num_proc=num_proc, desc="Tokenizing")
+    dataset.save_to_disk(path)
+    # Written last: its presence marks a complete artifact
+    with open(os.path.join(path, "preprocess_key.json"), "w") as f:
+        json.dump(key_fields, f, indent=2)
+    print(f"Saved preprocessed dataset to {path}")
+    return load_from_disk(path)
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Format and tokenise nvBench splits into cached Arrow datasets")
+    parser.add_argument("--data_files", nargs="+", required=True, help="e.g. data/nvbench2.0/train.json data/nvbench2.0/test.json")
+    parser.add_argument("--tokenizer", required=True, help="Model name or path whose tokenizer is used")
+    parser.add_argument("--max_length", type=int, default=4096)
+    parser.add_argument("--cache_dir", default=os.getenv("SFT_DATA_CACHE", "./data_cache"))
+    parser.add_argument("--inference", action="store_true", help="Build prompt-only datasets for infer.py")
+    parser.add_argument("--num_proc", type=int, default=None)
+    parser.add_argument("--compact_schema", action="store_true", help="One line per column (SFT_COMPACT_SCHEMA=1)")
+    parser.add_argument("--max_example_chars", type=int, default=None, help="Cut longer string examples (SFT_MAX_EXAMPLE_CHARS)")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    with_thinking = os.getenv("SFT_WITH_THINKING", False)
+    for data_file in args.data_files:
+        dataset = load_or_build(data_file, tokenizer, args.max_length, with_thinking, args.cache_dir,
+                                for_inference=args.inference, num_proc=args.num_proc,
+                                compact_schema=args.compact_schema, max_example_chars=args.max_example_chars)
+        lengths = [len(ids) for ids in dataset["input_ids"]]
+        print(f"{data_file}: {len(dataset)} samples, {sum(lengths)} tokens, max length {max(lengths)}")
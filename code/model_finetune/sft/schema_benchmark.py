@@ -0,0 +1,129 @@
+# Benchmark of the table rendering in SFT prompts: tokens per sample of the
+# full and compact schema renderings, and the evaluation.py metrics of models
+# trained and run with each.
+#   python schema_benchmark.py tokens --data_file ../../../data/nvbench2.0/test.json --tokenizer <model>
+#   python schema_benchmark.py export --data_file ../../../data/nvbench2.0/test.json \
+#       --predictions <infer output_dir>/predictions.jsonl --output_dir <results>/sftcompact_ex1
+#   cd ../../evaluation && python evaluation.py <results>/sftcompact_ex1
+import os
+import json
+import argparse
+
+import numpy as np
+
+from preprocess import format_sample
+
+# (name, compact_schema, max_example_chars)
+VARIANTS = [
+    ("full", False, None),
+    ("full_truncated", False, 40),
+    ("compact", True, None),
+    ("compact_truncated", True, 40),
+]
+
+
+def token_stats(records, tokenizer, with_thinking, variants=VARIANTS, max_seq_length=None):
+    """
+    Prompt tokens per sample of each rendering.
+
+    Returns:
+        dict: Per variant, mean / median / p95 / max prompt tokens, the mean
+        reduction against the first variant and, with max_seq_length, the
+        number of training samples that would be truncated
+    """
+    stats = {}
+    baseline = None
+    for name, compact_schema, max_example_chars in variants:
+        prompts = [format_sample(r["nl_query"], r["table_schema"], r.get("steps"), r["gold_answer"], with_thinking,
+                                 compact_schema=compact_schema, max_example_chars=max_example_chars)
+                   for r in records]
+        lengths = np.array([len(ids) for ids in tokenizer(prompts, add_special_tokens=True)["input_ids"]])
+        if baseline is None:
+            baseline = lengths
+        stats[name] = {
+            "compact_schema": compact_schema,
+            "max_example_chars": max_example_chars,
+            "mean": float(lengths.mean()),
+            "median": float(np.median(lengths)),
+            "p95": float(np.percentile(lengths, 95)),
+            "max": int(lengths.max()),
+            "reduction": float(1 - lengths.sum() / baseline.sum()),
+        }
+        if max_seq_length:
+            outputs = [format_sample(r["nl_query"], r["table_schema"], r.get("steps"), r["gold_answer"], with_thinking,
+                                     tokenizer.eos_token, compact_schema, max_example_chars)
+                       for r in records]
+            full_lengths = [len(ids) for ids in tokenizer(outputs, add_special_tokens=True)["input_ids"]]
+            stats[name]["over_max_seq_length"] = sum(n > max_seq_length for n in full_lengths)
+    return stats
+
+
+def final_answer(prediction):
+    """The chart list of an infer.py prediction: the whole output, or step 6's answer for the step template."""
+    if "<step_6>" in prediction:
+        prediction = prediction.rpartition("<step_6>")[2]
+        if "<answer>" in prediction:
+            prediction = prediction.rpartition("<answer>")[2].partition("</answer>")[0]
+    try:
+        charts = json.loads(prediction.strip())
+    except ValueError:
+        return []
+    return charts if isinstance(charts, list) else [charts]
+
+
+def export_for_evaluation(records, predictions_file, output_dir):
+    """
+    Write infer.py predictions as the per-sample files evaluation.py reads
+    (csv_file, gold_answer and "<model>_json"), the model name being the part
+    of output_dir's name before the first "_".
+    """
+    model_name = os.path.basename(os.path.normpath(output_dir)).split("_")[0]
+    with open(predictions_file, "r") as f:
+        predictions = [json.loads(line)["prediction"] for line in f if line.strip()]
+    if len(predictions) != len(records):
+        raise ValueError(f"{predictions_file} has {len(predictions)} predictions for {len(records)} samples")
+    os.makedirs(output_dir, exist_ok=True)
+    for idx, (record, prediction) in enumerate(zip(records, predictions)):
+        with open(os.path.join(output_dir, f"{idx}.json"), "w") as f:
+            json.dump({
+                "csv_file": record["csv_file"],
+                "nl_query": record["nl_query"],
+                "gold_answer": record["gold_answer"],
+                f"{model_name}_json": final_answer(prediction),
+            }, f, indent=4, ensure_ascii=False)
+    return model_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full and compact table schemas in SFT prompts")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    tokens_parser = subparsers.add_parser("tokens", help="Prompt tokens per sample of each rendering")
+    tokens_parser.add_argument("--data_file", required=True)
+    tokens_parser.add_argument("--tokenizer", required=True, help="Model name or path whose tokenizer is used")
+    tokens_parser.add_argument("--max_seq_length", type=int, default=None)
+    tokens_parser.add_argument("--max_example_chars", type=int, default=40, help="Truncation of the *_truncated variants")
+    tokens_parser.add_argument("--report", default=None, help="Write the stats to this JSON file")
+    export_parser = subparsers.add_parser("export", help="Convert infer.py predictions for evaluation.py")
+    export_parser.add_argument("--data_file", required=True, help="The split infer.py was run on")
+    export_parser.add_argument("--predictions", required=True, help="predictions.jsonl written by infer.py")
+    export_parser.add_argument("--output_dir", required=True, help="e.g. results/sftcompact_ex1")
+    args = parser.parse_args()
+
+    with open(args.data_file, "r") as f:
+        records = json.load(f)
+    if args.command == "tokens":
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        variants = [(name, compact, args.max_example_chars if chars else None) for name, compact, chars in VARIANTS]
+        stats = token_stats(records, tokenizer, os.getenv("SFT_WITH_THINKING", False), variants, args.max_seq_length)
+        print(f"{'rendering':20}{'mean':>10}{'median':>10}{'p95':>10}{'max':>8}{'reduction':>11}")
+        for name, s in stats.items():
+            print(f"{name:20}{s['mean']:10.1f}{s['median']:10.1f}{s['p95']:10.1f}{s['max']:8d}{s['reduction']:11.1%}")
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(stats, f, indent=2)
+    else:
+        model_name = export_for_evaluation(records, args.predictions, args.output_dir)
+        print(f"Wrote {len(records)} files for model {model_name} to {args.output_dir}; "
+              f"run evaluation.py on it and compare with the full-schema run")
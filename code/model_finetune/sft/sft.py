@@ -1,105 +1,158 @@
+import os
+import json
+
+# SFT_PACKING=1 bin-packs samples into rows of max_seq_length, keeping their attention and loss apart.
+# unsloth's training forward drops the attention mask, so packed runs load the model with plain
+# transformers + peft and unsloth is not imported at all (it patches transformers on import)
+PACKING = os.getenv("SFT_PACKING", "0") == "1"
+if not PACKING:
+    from unsloth import FastLanguageModel
+import torch
 from datasets import load_dataset
-from unsloth import FastLanguageModel
+from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from trl import (
     ModelConfig,
     ScriptArguments,
     SFTConfig,
     SFTTrainer,
-    TrlParser
+    TrlParser,
+    get_quantization_config
 )
-from sft_template import SFT_PROMPT_STEP_TEMPLATE, SFT_PROMPT_TEMPLATE, STEP_BY_STEP_OUTPUT_TEMPLATE
-import json
-
-import os
+from preprocess import format_batch, load_or_build, tokenize_batch
+from packing import pack_dataset, packing_report, PackedCollator, check_attention_isolation
+from length_grouping import TokenBudgetBatchSampler, TokenBudgetTrainerMixin, batching_report
 
 WITH_THINKING = os.getenv("SFT_WITH_THINKING", False)
+# SFT_COMPACT_SCHEMA=1 renders the table one line per column; SFT_MAX_EXAMPLE_CHARS=<n> cuts long string examples
+COMPACT_SCHEMA = os.getenv("SFT_COMPACT_SCHEMA", "0") == "1"
+MAX_EXAMPLE_CHARS = int(os.getenv("SFT_MAX_EXAMPLE_CHARS", 0)) or None
+# Memory-map formatted and tokenised datasets from this directory (built by preprocess.py on first use)
+DATA_CACHE = os.getenv("SFT_DATA_CACHE")
+# SFT_MAX_BATCH_TOKENS=<n> batches samples of similar length with batch size * longest sample <= n,
+# instead of per_device_train_batch_size random samples
+MAX_BATCH_TOKENS = int(os.getenv("SFT_MAX_BATCH_TOKENS", 0)) or None
+# LoRA targets of FastLanguageModel.get_peft_model, reused for the plain transformers model
+LORA_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+class TokenBudgetSFTTrainer(TokenBudgetTrainerMixin, SFTTrainer):
+    pass
 
 def dataset_preprocess(examples, tokenizer):
-    nl_query_list = examples["nl_query"]
-    table_schema_list = examples["table_schema"]
-    steps_list = examples["steps"]
-    gold_answer_list = examples["gold_answer"]
-    texts = []
-    EOS_TOKEN = tokenizer.eos_token
-    for nl_query, table_schema, steps, gold_answer in zip(nl_query_list, table_schema_list, steps_list, gold_answer_list):
-        assert isinstance(table_schema, str) and isinstance(gold_answer, str)
-        table_schema = json.loads(table_schema)
-        if not WITH_THINKING:
-            text = SFT_PROMPT_TEMPLATE.format(
-                table_columns=table_schema["table_columns"],
-                column_examples="\n".join([f"{k}: {v}" for k, v in table_schema["column_examples"].items()]),
-                unique_value_counts="\n".join([f"{k}: {v}" for k, v in table_schema["unique_value_counts"].items()]),
-                nl_query=nl_query,
-                output=gold_answer
-            ) + EOS_TOKEN
-        else:
-            steps = json.loads(steps)
-            output = STEP_BY_STEP_OUTPUT_TEMPLATE.format(
-                step_1_thinking=steps["step_1"]["reasoning"].strip(),
-                step_1_answer=json.dumps(steps["step_1"]["answer"]),
-                step_2_thinking=steps["step_2"]["reasoning"].strip(),
-                step_2_answer=json.dumps(steps["step_2"]["answer"]),
-                step_3_thinking=steps["step_3"]["reasoning"].strip(),
-                step_3_answer=json.dumps(steps["step_3"]["answer"]),
-                step_4_thinking=steps["step_4"]["reasoning"].strip(),
-                step_4_answer=json.dumps(steps["step_4"]["answer"]),
-                step_5_thinking=steps["step_5"]["reasoning"].strip(),
-                step_5_answer=json.dumps(steps["step_5"]["answer"]),
-                step_6_thinking=steps["step_6"]["reasoning"].strip(),
-                step_6_answer=json.dumps(steps["step_6"]["answer"]),
-            )
-            text = SFT_PROMPT_STEP_TEMPLATE.format(
-                table_columns=table_schema["table_columns"],
-                column_examples="\n".join([f"{k}: {v}" for k, v in table_schema["column_examples"].items()]),
-                unique_value_counts="\n".join([f"{k}: {v}" for k, v in table_schema["unique_value_counts"].items()]),
-                nl_query=nl_query,
-                output=output
-            ) + EOS_TOKEN
-        texts.append(text)
-    return {"text": texts}
+    return format_batch(examples, tokenizer, WITH_THINKING, compact_schema=COMPACT_SCHEMA, max_example_chars=MAX_EXAMPLE_CHARS)
+
+def load_transformers_model(training_args, model_args):
+    """The LoRA model of the unsloth path, loaded with transformers and peft so the 4D attention mask is honoured."""
+    torch_dtype = (
+        model_args.torch_dtype if model_args.torch_dtype in ["auto", None] else getattr(torch, model_args.torch_dtype)
+    )
+    quantization_config = get_quantization_config(model_args)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_args.model_name_or_path,
+        revision=model_args.model_revision,
+        trust_remote_code=model_args.trust_remote_code,
+        attn_implementation=model_args.attn_implementation,
+        torch_dtype=torch_dtype,
+        quantization_config=quantization_config,
+        use_cache=False if training_args.gradient_checkpointing else True
+    )
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_args.model_name_or_path, trust_remote_code=model_args.trust_remote_code
+    )
+    if quantization_config is not None:
+        model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=training_args.gradient_checkpointing)
+    model = get_peft_model(model, LoraConfig(
+        r=model_args.lora_r,
+        lora_alpha=model_args.lora_alpha,
+        lora_dropout=model_args.lora_dropout,
+        target_modules=model_args.lora_target_modules or LORA_TARGET_MODULES,
+        use_rslora=model_args.use_rslora,
+        task_type="CAUSAL_LM"
+    ))
+    return model, tokenizer
 
 def main(script_args, training_args, model_args):
     ################
     # Model & Tokenizer
     ################
-    model, tokenizer = FastLanguageModel.from_pretrained(
-        model_name=model_args.model_name_or_path,
-        load_in_4bit=model_args.load_in_4bit,
-        max_seq_length=training_args.max_seq_length,
-    )
+    if PACKING:
+        check_attention_isolation()
+        model, tokenizer = load_transformers_model(training_args, model_args)
+    else:
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=model_args.model_name_or_path,
+            load_in_4bit=model_args.load_in_4bit,
+            max_seq_length=training_args.max_seq_length,
+        )
+        model = FastLanguageModel.get_peft_model(
+            model=model,
+            r=model_args.lora_r,
+            lora_alpha=model_args.lora_alpha,
+            lora_dropout=model_args.lora_dropout,
+            use_gradient_checkpointing=training_args.gradient_checkpointing,
+            max_seq_length=training_args.max_seq_length,
+            use_rslora=model_args.use_rslora
+        )
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-
-    model = FastLanguageModel.get_peft_model(
-        model=model,
-        r=model_args.lora_r,
-        lora_alpha=model_args.lora_alpha,
-        lora_dropout=model_args.lora_dropout,
-        use_gradient_checkpointing=training_args.gradient_checkpointing,
-        max_seq_length=training_args.max_seq_length,
-        use_rslora=model_args.use_rslora
-    )
     ################
     # Dataset
     ################
-    dataset = load_dataset("json", data_files={"train": script_args.dataset_train_split, "eval": script_args.dataset_test_split})
-    dataset = dataset.map(lambda x: dataset_preprocess(x, tokenizer), batched=True)
+    if DATA_CACHE:
+        dataset = {
+            split: load_or_build(data_file, tokenizer, training_args.max_seq_length, WITH_THINKING, DATA_CACHE,
+                                 compact_schema=COMPACT_SCHEMA, max_example_chars=MAX_EXAMPLE_CHARS)
+            for split, data_file in (("train", script_args.dataset_train_split), ("eval", script_args.dataset_test_split))
+        }
+        # Already tokenised and truncated to max_seq_length
+        training_args.dataset_kwargs = {"skip_prepare_dataset": True}
+    else:
+        dataset = load_dataset("json", data_files={"train": script_args.dataset_train_split, "eval": script_args.dataset_test_split})
+        dataset = dataset.map(lambda x: dataset_preprocess(x, tokenizer), batched=True)
     print("************ SAMPLE ***********")
     print(dataset["train"][0])
     print("*******************************")
+
+    data_collator = None
+    if PACKING:
+        if not DATA_CACHE:
+            dataset = dataset.map(lambda x: tokenize_batch(x, tokenizer, training_args.max_seq_length), batched=True)
+        lengths = [len(ids) for ids in dataset["train"]["input_ids"]]
+        packed_train, rows = pack_dataset(dataset["train"], training_args.max_seq_length)
+        dataset = {"train": packed_train, "eval": pack_dataset(dataset["eval"], training_args.max_seq_length)[0]}
+        report = packing_report(lengths, rows, training_args.max_seq_length, training_args.per_device_train_batch_size)
+        print(json.dumps(report, indent=2))
+        os.makedirs(training_args.output_dir, exist_ok=True)
+        with open(os.path.join(training_args.output_dir, "packing_report.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        flash = getattr(model.config, "_attn_implementation", None) == "flash_attention_2"
+        data_collator = PackedCollator(tokenizer.pad_token_id, attention="position_ids" if flash else "block",
+                                       mask_dtype=model.dtype)
+        training_args.packing = False  # trl's own packing would let samples attend to each other
+        training_args.dataset_kwargs = {"skip_prepare_dataset": True}
     
     ################
     # Training
     ################
-    trainer = SFTTrainer(
+    trainer = TokenBudgetSFTTrainer(
         model=model,
         tokenizer=tokenizer,
         args=training_args,
         train_dataset=dataset["train"],
         eval_dataset=dataset["eval"] if training_args.eval_strategy != "no" else None,
+        data_collator=data_collator,
         dataset_text_field="text",
         max_seq_length=training_args.max_seq_length
     )
+    if MAX_BATCH_TOKENS:
+        lengths = [len(ids) for ids in trainer.train_dataset["input_ids"]]
+        trainer.train_batch_sampler = TokenBudgetBatchSampler(lengths, MAX_BATCH_TOKENS, seed=training_args.seed)
+        report = batching_report(lengths, trainer.train_batch_sampler.batches, training_args.per_device_train_batch_size,
+                                 seed=training_args.seed)
+        print(json.dumps(report, indent=2))
+        os.makedirs(training_args.output_dir, exist_ok=True)
+        with open(os.path.join(training_args.output_dir, "batching_report.json"), "w") as f:
+            json.dump(report, f, indent=2)
 
     trainer.train()
 
@@ -91,3 +91,53 @@ You are a good data visualization expert. Given an ambiguous/incomplete Natural
 # Output:
 {output}
 """
+
+# Same prompts with the table rendered one line per column ("name (type, N unique): a | b | c"),
+# see preprocess.render_compact_schema
+SFT_PROMPT_STEP_COMPACT_TEMPLATE = """
+You are a good data visualization expert. Given an ambiguous/incomplete Natural Language Query, a Data Table, your task is to recommend visualization charts corresponding to the ambiguous/incomplete NL Query. You need to think step by step in xml format and output the step-answer in JSON format.
+
+# Input:
+## Data Table:
+### Columns (name (type, unique values): examples):
+{table_schema}
+
+## Natural Language Query:
+{nl_query}
+
+# Output:
+{output}
+"""
+
+SFT_PROMPT_COMPACT_TEMPLATE = """
+You are a good data visualization expert. Given an ambiguous/incomplete Natural Language Query, a Data Table, your task is to recommend visualization charts corresponding to the ambiguous/incomplete NL Query. You need to output in JSON format.
+
+# Input:
+## Data Table:
+### Columns (name (type, unique values): examples):
+{table_schema}
+
+## Natural Language Query:
+{nl_query}
+
+# Output:
+{output}
+"""
+
+# Decoding settings per prompt template: the new-token budget, the tags that
+# come before the final chart list in the output, and the text the template
+# puts after it (restored when generation stops at the end of the chart list)
+GENERATION_CONFIG = {
+    "SFT_PROMPT_TEMPLATE": {
+        "max_new_tokens": 2048,
+        "answer_anchors": [],
+        "answer_suffix": "",
+    },
+    "SFT_PROMPT_STEP_TEMPLATE": {
+        "max_new_tokens": 2048,
+        "answer_anchors": ["<step_6>", "<answer>"],
+        "answer_suffix": "\n</answer>\n</step_6>",
+    },
+}
+GENERATION_CONFIG["SFT_PROMPT_COMPACT_TEMPLATE"] = GENERATION_CONFIG["SFT_PROMPT_TEMPLATE"]
+GENERATION_CONFIG["SFT_PROMPT_STEP_COMPACT_TEMPLATE"] = GENERATION_CONFIG["SFT_PROMPT_STEP_TEMPLATE"]
@@ -6,7 +6,29 @@ from trl import (
     DPOConfig,
     TrlParser
 )
-from stepdpo_trainer import StepDPOTrainer
+import hashlib
+import json
+import os
+import sys
+
+# length_grouping lives with the SFT scripts (model_finetune/sft)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "sft"))
+from stepdpo_trainer import StepDPOTrainer, pretokenize_dataset
+from length_grouping import TokenBudgetBatchSampler, batching_report
+
+# DPO_REF_LOGPS=<file.npy> scores the train pairs with the reference model once, stores the
+# log-probs there (memory-mapped) and trains without reference forwards
+REF_LOGPS = os.getenv("DPO_REF_LOGPS")
+# DPO_MAX_BATCH_TOKENS=<n> batches pairs of similar length with batch size * padded pair length <= n,
+# instead of per_device_train_batch_size random pairs
+MAX_BATCH_TOKENS = int(os.getenv("DPO_MAX_BATCH_TOKENS", 0)) or None
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def dataset_preprocess(example):
     prompt = example["prompt"]
@@ -46,6 +68,12 @@ def main(script_args, training_args, model_args):
     print("************ SAMPLE ***********")
     print(dataset["train"][0])
     print("*******************************")
+    # Batched, with each distinct prompt tokenised once; StepDPOTrainer.tokenize_row then passes rows through
+    dataset["train"] = pretokenize_dataset(
+        dataset["train"], tokenizer, training_args.max_length, training_args.max_prompt_length,
+        truncation_mode=training_args.truncation_mode, label_pad_token_id=training_args.label_pad_token_id,
+        num_proc=training_args.dataset_num_proc,
+    )
     
     ################
     # Training
@@ -61,6 +89,25 @@ def main(script_args, training_args, model_args):
         max_prompt_length=training_args.max_prompt_length,
         loss_type=training_args.loss_type
     )
+    if REF_LOGPS:
+        trainer.load_or_precompute_reference_logps(REF_LOGPS, key={
+            "data": file_digest(script_args.dataset_train_split),
+            "model": model_args.model_name_or_path,
+            "max_length": training_args.max_length,
+            "max_prompt_length": training_args.max_prompt_length,
+            "truncation_mode": training_args.truncation_mode,
+        })
+    if MAX_BATCH_TOKENS:
+        # Chosen and rejected are padded to the same length and run as two rows
+        lengths = [2 * max(len(c), len(r)) for c, r in zip(trainer.train_dataset["chosen_input_ids"],
+                                                           trainer.train_dataset["rejected_input_ids"])]
+        trainer.train_batch_sampler = TokenBudgetBatchSampler(lengths, MAX_BATCH_TOKENS, seed=training_args.seed)
+        report = batching_report(lengths, trainer.train_batch_sampler.batches, training_args.per_device_train_batch_size,
+                                 seed=training_args.seed)
+        print(json.dumps(report, indent=2))
+        os.makedirs(training_args.output_dir, exist_ok=True)
+        with open(os.path.join(training_args.output_dir, "batching_report.json"), "w") as f:
+            json.dump(report, f, indent=2)
 
     trainer.train()
 
@@ -1,12 +1,261 @@
 # Modified from trl/trl/trainer/dpo_trainer.py
-from typing import Dict, Optional, Union
+import os
+import sys
+import json
+import hashlib
+from typing import Dict, List, Optional, Union
 
+import numpy as np
 import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
 from transformers import PreTrainedModel
 from trl import DPOTrainer
 
+# length_grouping is shared with the SFT scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sft"))
+from length_grouping import TokenBudgetTrainerMixin
 
-class StepDPOTrainer(DPOTrainer):
+# Columns written by tokenize_row / tokenize_rows; rows that already have them are not tokenised again
+TOKENIZED_COLUMNS = [
+    f"{prefix}{key}"
+    for prefix, keys in (("chosen_", ["input_ids", "attention_mask", "labels"]),
+                         ("rejected_", ["input_ids", "attention_mask", "labels"]),
+                         ("prompt_", ["input_ids", "attention_mask"]))
+    for key in keys
+]
+
+
+class PromptTokenCache(object):
+    """
+    input_ids of each distinct prompt, keyed by its hash.
+
+    Step-DPO rows share prompt + initial_reason_steps prefixes, so a prompt is
+    tokenised once however many chosen/rejected pairs are built on it.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.cache = {}
+
+    @staticmethod
+    def key(prompt):
+        return hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+
+    def get_many(self, prompts: List[str]) -> List[List[int]]:
+        keys = [self.key(prompt) for prompt in prompts]
+        missing = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in self.cache and key not in missing:
+                missing[key] = prompt
+        if missing:
+            encoded = self.tokenizer(list(missing.values()), add_special_tokens=False)["input_ids"]
+            self.cache.update(zip(missing.keys(), encoded))
+        return [self.cache[key] for key in keys]
+
+
+def split_answer(prompt_input_ids, full_input_ids, full_attention_mask) -> Dict:
+    """
+    Split the tokens of prompt + answer into prompt and answer parts, the way
+    DPOTrainer.build_tokenized_answer does: when the tokenizer merges the last
+    prompt token with the start of the answer, the merged token goes to the answer.
+    """
+    if len(full_input_ids) < len(prompt_input_ids):
+        raise ValueError("Prompt input ids and answer input ids should have the same length.")
+    response_token_ids_start_idx = len(prompt_input_ids)
+    if prompt_input_ids != full_input_ids[:response_token_ids_start_idx]:
+        response_token_ids_start_idx -= 1
+    return dict(
+        prompt_input_ids=full_input_ids[:response_token_ids_start_idx],
+        prompt_attention_mask=full_attention_mask[:response_token_ids_start_idx],
+        input_ids=full_input_ids[response_token_ids_start_idx:],
+        attention_mask=full_attention_mask[response_token_ids_start_idx:],
+    )
+
+
+def build_row(prompt_input_ids, chosen_tokens, rejected_tokens, max_length, max_prompt_length,
+              truncation_mode, label_pad_token_id) -> Dict:
+    """
+    Truncate one tokenised chosen/rejected pair and build its labels.
+
+    Args:
+        prompt_input_ids: Tokens of the prompt on its own
+        chosen_tokens, rejected_tokens: Output of split_answer for prompt + chosen and prompt + rejected
+
+    Returns:
+        dict: The TOKENIZED_COLUMNS of the row
+    """
+    prompt_tokens = {"prompt_input_ids": prompt_input_ids, "prompt_attention_mask": [1] * len(prompt_input_ids)}
+
+    # Last prompt token might get merged by tokenizer and
+    # it should not be included for generation if that happens
+    chosen_prompt_len_input_ids = len(chosen_tokens["prompt_input_ids"])
+    rejected_prompt_len_input_ids = len(rejected_tokens["prompt_input_ids"])
+    prompt_len_input_ids = min(chosen_prompt_len_input_ids, rejected_prompt_len_input_ids)
+
+    for k, v in prompt_tokens.items():
+        prompt_tokens[k] = v[:prompt_len_input_ids]
+
+    # Make sure prompts only have one different token at most an
+    # and length only differs by 1 at most
+    num_diff_tokens = sum(
+        [a != b for a, b in zip(chosen_tokens["prompt_input_ids"], rejected_tokens["prompt_input_ids"])]
+    )
+    num_diff_len = abs(chosen_prompt_len_input_ids - rejected_prompt_len_input_ids)
+    if num_diff_tokens > 1 or num_diff_len > 1:
+        raise ValueError(
+            "Chosen and rejected prompt_input_ids might only differ on the "
+            "last token due to tokenizer merge ops."
+        )
+
+    longer_response_length = max(len(chosen_tokens["input_ids"]), len(rejected_tokens["input_ids"]))
+
+    # if combined sequence is too long, truncate the prompt
+    for answer_tokens in [chosen_tokens, rejected_tokens, prompt_tokens]:
+        if len(answer_tokens["prompt_input_ids"]) + longer_response_length > max_length:
+            if truncation_mode == "keep_start":
+                for k in ["prompt_input_ids", "prompt_attention_mask"]:
+                    answer_tokens[k] = answer_tokens[k][: max_prompt_length]
+            elif truncation_mode == "keep_end":
+                for k in ["prompt_input_ids", "prompt_attention_mask"]:
+                    answer_tokens[k] = answer_tokens[k][-max_prompt_length :]
+            else:
+                raise ValueError(f"Unknown truncation mode: {truncation_mode}")
+
+    # if that's still too long, truncate the response
+    for answer_tokens in [chosen_tokens, rejected_tokens]:
+        if len(answer_tokens["prompt_input_ids"]) + longer_response_length > max_length:
+            for k in ["input_ids", "attention_mask"]:
+                answer_tokens[k] = answer_tokens[k][: max_length - max_prompt_length]
+
+    # Create labels
+    batch = {}
+    for prefix, answer_tokens in (("chosen_", chosen_tokens), ("rejected_", rejected_tokens)):
+        prompt_length = len(answer_tokens["prompt_input_ids"])
+        for k in ["input_ids", "attention_mask"]:
+            batch[f"{prefix}{k}"] = answer_tokens[f"prompt_{k}"] + answer_tokens[k]
+        batch[f"{prefix}labels"] = [label_pad_token_id] * prompt_length + batch[f"{prefix}input_ids"][prompt_length:]
+    batch.update(prompt_tokens)
+    return batch
+
+
+def tokenize_rows(examples, tokenizer, prompt_cache, max_length, max_prompt_length,
+                  truncation_mode="keep_end", label_pad_token_id=-100) -> Dict:
+    """
+    Batched tokenize_row for datasets.map(batched=True): each distinct prompt is
+    tokenised once through prompt_cache, and every prompt + chosen and
+    prompt + rejected of the batch in a single tokenizer call.
+    """
+    prompts, chosens, rejecteds = examples["prompt"], examples["chosen"], examples["rejected"]
+    for name, values in (("prompt", prompts), ("chosen", chosens), ("rejected", rejecteds)):
+        for value in values:
+            if not isinstance(value, str):
+                raise ValueError(f"{name} should be an str but got {type(value)}")
+    prompt_ids = prompt_cache.get_many(prompts)
+    full = tokenizer([p + a for p, a in zip(prompts, chosens)] + [p + a for p, a in zip(prompts, rejecteds)],
+                     add_special_tokens=False)
+    num_rows = len(prompts)
+    batch = {column: [] for column in TOKENIZED_COLUMNS}
+    for i in range(num_rows):
+        chosen_tokens = split_answer(prompt_ids[i], full["input_ids"][i], full["attention_mask"][i])
+        rejected_tokens = split_answer(prompt_ids[i], full["input_ids"][num_rows + i], full["attention_mask"][num_rows + i])
+        row = build_row(prompt_ids[i], chosen_tokens, rejected_tokens, max_length, max_prompt_length,
+                        truncation_mode, label_pad_token_id)
+        for column in TOKENIZED_COLUMNS:
+            batch[column].append(row[column])
+    return batch
+
+
+def pretokenize_dataset(dataset, tokenizer, max_length, max_prompt_length, truncation_mode="keep_end",
+                        label_pad_token_id=-100, batch_size=1000, num_proc=None):
+    """
+    Add the TOKENIZED_COLUMNS to a prompt/chosen/rejected dataset ahead of
+    StepDPOTrainer, whose tokenize_row then passes the rows through.
+    """
+    prompt_cache = PromptTokenCache(tokenizer)
+    return dataset.map(
+        lambda x: tokenize_rows(x, tokenizer, prompt_cache, max_length, max_prompt_length, truncation_mode, label_pad_token_id),
+        batched=True, batch_size=batch_size, num_proc=num_proc, desc="Tokenizing chosen/rejected pairs",
+    )
+
+
+class StepDPOTrainer(TokenBudgetTrainerMixin, DPOTrainer):
+
+    def load_or_precompute_reference_logps(self, path, key: Optional[Dict] = None):
+        """
+        Attach reference-model log-probs of every train pair, so training runs no reference forwards.
+
+        The log-probs are computed once into a memory-mapped float32 array of
+        shape (num_rows, 2) (chosen, rejected) saved as a .npy file at path;
+        path + ".json" records what they were computed from. Later runs with the
+        same key memory-map the file instead of running the reference model.
+
+        Args:
+            path: .npy file for the log-probs
+            key: What the log-probs depend on (data file digest, model, lengths);
+                the row count is added to it
+        """
+        key = dict(key or {}, rows=len(self.train_dataset))
+        meta_path = path + ".json"
+        logps = None
+        if os.path.exists(meta_path) and os.path.exists(path):
+            with open(meta_path, "r") as f:
+                if json.load(f) == key:
+                    logps = np.load(path, mmap_mode="r")
+                    print(f"Loaded reference log-probs from {path}")
+        if logps is None:
+            # Drop the old record first: a crash after the new array replaces the old one
+            # must not leave the old key describing it
+            self.accelerator.wait_for_everyone()
+            if self.accelerator.is_main_process and os.path.exists(meta_path):
+                os.remove(meta_path)
+            logps = self._precompute_reference_logps(path)
+            if self.accelerator.is_main_process:
+                # Written last: its presence marks a complete array
+                with open(meta_path, "w") as f:
+                    json.dump(key, f, indent=2)
+
+        self.train_dataset = self.train_dataset.add_column(name="reference_chosen_logps", column=logps[:, 0].tolist())
+        self.train_dataset = self.train_dataset.add_column(name="reference_rejected_logps", column=logps[:, 1].tolist())
+        self._precomputed_train_ref_log_probs = True
+        if self.eval_dataset is None:
+            # Nothing left that needs the reference model
+            self.ref_model = None
+            torch.cuda.empty_cache()
+
+    def _precompute_reference_logps(self, path):
+        """Score every train pair with the reference model, in dataset order, into a .npy memmap at path."""
+        data_loader = self.accelerator.prepare(DataLoader(
+            self.train_dataset,
+            batch_size=self.args.per_device_eval_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            shuffle=False,
+        ))
+        # Dropout off: the log-probs must be the reference model's deterministic scores
+        for module in (self.model, self.ref_model):
+            if module is not None:
+                module.eval()
+        logps = None
+        if self.accelerator.is_main_process:
+            logps = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=np.float32,
+                                              shape=(len(self.train_dataset), 2))
+        offset = 0
+        for padded_batch in tqdm(iterable=data_loader, desc="Reference log-probs"):
+            reference_chosen_logp, reference_rejected_logp = self.compute_reference_log_probs(padded_batch)
+            reference_chosen_logp, reference_rejected_logp = self.accelerator.gather_for_metrics(
+                (reference_chosen_logp, reference_rejected_logp)
+            )
+            if logps is not None:
+                rows = torch.stack([reference_chosen_logp, reference_rejected_logp], dim=-1).float().cpu().numpy()
+                logps[offset:offset + len(rows)] = rows
+            offset += len(reference_chosen_logp)
+        if logps is not None:
+            logps.flush()
+            del logps
+            os.replace(path + ".tmp", path)
+        self.accelerator.wait_for_everyone()
+        return np.load(path, mmap_mode="r")
 
     def tokenize_row(self, feature, model: Optional[Union[PreTrainedModel, torch.nn.Module]] = None) -> Dict:
         """Tokenize a single row from a DPO specific dataset.
@@ -18,6 +267,9 @@ class StepDPOTrainer(DPOTrainer):
         We also create the labels for the chosen/rejected responses, which are of length equal to
             the sum of the length of the prompt and the chosen/rejected response, with
             label_pad_token_id  for the prompt tokens.
+
+        The prompt is tokenised once and shared by chosen and rejected (see
+        tokenize_rows); rows prepared by pretokenize_dataset are passed through.
         """
         batch = {}
         prompt = feature["prompt"]
@@ -31,106 +283,16 @@ class StepDPOTrainer(DPOTrainer):
             #  2. https://github.com/EleutherAI/lm-evaluation-harness/pull/531#issuecomment-1595586257
             #  3. https://github.com/LianjiaTech/BELLE/issues/337
 
-            if not isinstance(prompt, str):
-                raise ValueError(f"prompt should be an str but got {type(prompt)}")
-            prompt_tokens = self.tokenizer(prompt, add_special_tokens=False)
-            prompt_tokens = {f"prompt_{k}": v for k, v in prompt_tokens.items()}
-
-            if not isinstance(chosen, str):
-                raise ValueError(f"chosen should be an str but got {type(chosen)}")
-            chosen_tokens = self.build_tokenized_answer(prompt, chosen)
-
-            if not isinstance(rejected, str):
-                raise ValueError(f"rejected should be an str but got {type(rejected)}")
-            rejected_tokens = self.build_tokenized_answer(prompt, rejected)
-
-            # Last prompt token might get merged by tokenizer and
-            # it should not be included for generation if that happens
-            prompt_len_input_ids = len(prompt_tokens["prompt_input_ids"])
-
-            chosen_prompt_len_input_ids = len(chosen_tokens["prompt_input_ids"])
-            rejected_prompt_len_input_ids = len(rejected_tokens["prompt_input_ids"])
-            prompt_len_input_ids = min(chosen_prompt_len_input_ids, rejected_prompt_len_input_ids)
-
-            for k, v in prompt_tokens.items():
-                prompt_tokens[k] = v[:prompt_len_input_ids]
-
-            # Make sure prompts only have one different token at most an
-            # and length only differs by 1 at most
-            num_diff_tokens = sum(
-                [a != b for a, b in zip(chosen_tokens["prompt_input_ids"], rejected_tokens["prompt_input_ids"])]
+            if all(column in feature for column in TOKENIZED_COLUMNS):
+                # Already tokenised by pretokenize_dataset
+                return {column: feature[column] for column in TOKENIZED_COLUMNS}
+            if not hasattr(self, "_prompt_cache"):
+                self._prompt_cache = PromptTokenCache(self.tokenizer)
+            batch = tokenize_rows(
+                {"prompt": [prompt], "chosen": [chosen], "rejected": [rejected]}, self.tokenizer, self._prompt_cache,
+                self.max_length, self.max_prompt_length, self.truncation_mode, self.label_pad_token_id,
             )
-            num_diff_len = abs(chosen_prompt_len_input_ids - rejected_prompt_len_input_ids)
-            if num_diff_tokens > 1 or num_diff_len > 1:
-                raise ValueError(
-                    "Chosen and rejected prompt_input_ids might only differ on the "
-                    "last token due to tokenizer merge ops."
-                )
-
-            # add BOS token to head of prompt
-            # if self.tokenizer.bos_token_id is not None:
-            #     prompt_tokens["prompt_input_ids"] = [self.tokenizer.bos_token_id] + prompt_tokens["prompt_input_ids"]
-            #     chosen_tokens["prompt_input_ids"] = [self.tokenizer.bos_token_id] + chosen_tokens["prompt_input_ids"]
-            #     rejected_tokens["prompt_input_ids"] = [self.tokenizer.bos_token_id] + rejected_tokens["prompt_input_ids"]
-
-            #     prompt_tokens["prompt_attention_mask"] = [1] + prompt_tokens["prompt_attention_mask"]
-            #     chosen_tokens["prompt_attention_mask"] = [1] + chosen_tokens["prompt_attention_mask"]
-            #     rejected_tokens["prompt_attention_mask"] = [1] + rejected_tokens["prompt_attention_mask"]
-
-            # # add EOS token to end of answer
-            # chosen_tokens["input_ids"].append(self.tokenizer.eos_token_id)
-            # chosen_tokens["attention_mask"].append(1)
-
-            # rejected_tokens["input_ids"].append(self.tokenizer.eos_token_id)
-            # rejected_tokens["attention_mask"].append(1)
-
-            longer_response_length = max(len(chosen_tokens["input_ids"]), len(rejected_tokens["input_ids"]))
-
-            # if combined sequence is too long, truncate the prompt
-            for answer_tokens in [chosen_tokens, rejected_tokens, prompt_tokens]:
-                if len(answer_tokens["prompt_input_ids"]) + longer_response_length > self.max_length:
-                    if self.truncation_mode == "keep_start":
-                        for k in ["prompt_input_ids", "prompt_attention_mask"]:
-                            answer_tokens[k] = answer_tokens[k][: self.max_prompt_length]
-                    elif self.truncation_mode == "keep_end":
-                        for k in ["prompt_input_ids", "prompt_attention_mask"]:
-                            answer_tokens[k] = answer_tokens[k][-self.max_prompt_length :]
-                    else:
-                        raise ValueError(f"Unknown truncation mode: {self.truncation_mode}")
-
-            # if that's still too long, truncate the response
-            for answer_tokens in [chosen_tokens, rejected_tokens]:
-                if len(answer_tokens["prompt_input_ids"]) + longer_response_length > self.max_length:
-                    for k in ["input_ids", "attention_mask"]:
-                        answer_tokens[k] = answer_tokens[k][: self.max_length - self.max_prompt_length]
-
-            # Create labels
-            chosen_sequence_tokens = {
-                k: chosen_tokens[f"prompt_{k}"] + chosen_tokens[k] for k in ["input_ids", "attention_mask"]
-            }
-            rejected_sequence_tokens = {
-                k: rejected_tokens[f"prompt_{k}"] + rejected_tokens[k] for k in ["input_ids", "attention_mask"]
-            }
-            chosen_sequence_tokens["labels"] = chosen_sequence_tokens["input_ids"][:]
-            chosen_sequence_tokens["labels"][: len(chosen_tokens["prompt_input_ids"])] = [
-                self.label_pad_token_id
-            ] * len(chosen_tokens["prompt_input_ids"])
-            rejected_sequence_tokens["labels"] = rejected_sequence_tokens["input_ids"][:]
-            rejected_sequence_tokens["labels"][: len(rejected_tokens["prompt_input_ids"])] = [
-                self.label_pad_token_id
-            ] * len(rejected_tokens["prompt_input_ids"])
-
-            for k, toks in {
-                "chosen_": chosen_sequence_tokens,
-                "rejected_": rejected_sequence_tokens,
-                "": prompt_tokens,
-            }.items():
-                for type_key, tokens in toks.items():
-                    if type_key == "token_type_ids":
-                        continue
-                    batch[f"{k}{type_key}"] = tokens
-
-            # import pdb; pdb.set_trace()
+            batch = {k: v[0] for k, v in batch.items()}
 
         else:
             print("error")